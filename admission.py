@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+# MIT License
+#
+# Copyright (c) 2017 Ysard
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""This module handles the admission control of uploads.
+
+Two limits protect the workers from bursts of large uploads:
+
+    - a rate per client: token bucket of RATE_BURST uploads, refilled with
+      RATE_LIMIT uploads per second; requests of an empty bucket are refused
+      at once (429), before their body is read;
+    - a global number of requests converting files at once (MAX_IN_FLIGHT),
+      with a bounded queue of waiting requests (MAX_WAITING): requests which
+      find a full queue or wait more than ADMISSION_WAIT seconds are refused
+      (503), so they never reach the timeout of gunicorn.
+
+The state is stored in a SQLite database shared by all the workers (WAL mode,
+short transactions); slots of dead processes are released by the next
+transactions.
+"""
+
+# Standard imports
+import os
+import time
+import sqlite3
+from contextlib import contextmanager
+from werkzeug.exceptions import TooManyRequests, ServiceUnavailable
+
+# Custom imports
+from metrics import process_alive
+
+# Time between 2 checks of a waiting request (seconds)
+POLL_INTERVAL = 0.1
+# Slots & buckets older than this are released (seconds)
+STALE_DELAY = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS buckets (
+    client TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS buckets_updated ON buckets (updated);
+CREATE TABLE IF NOT EXISTS slots (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    pid INTEGER NOT NULL,
+    running INTEGER NOT NULL,
+    updated REAL NOT NULL
+);
+"""
+
+
+class RateLimited(TooManyRequests):
+    """Client over its rate of uploads"""
+
+    def __init__(self, retry_after):
+        """
+        :param: Seconds before the next token of the client.
+        :type: <float>
+        """
+
+        super().__init__(
+            "Too many uploads: please retry in {} s !".format(
+                int(retry_after) + 1)
+        )
+        self.retry_after = int(retry_after) + 1
+
+
+class Overloaded(ServiceUnavailable):
+    """No conversion slot available in time"""
+
+    def __init__(self, retry_after):
+        """
+        :param: Suggested delay before a new attempt (seconds).
+        :type: <float>
+        """
+
+        super().__init__(
+            "The server is busy: please retry in a few seconds !"
+        )
+        self.retry_after = int(retry_after) + 1
+
+
+class DatabaseLocked(Overloaded):
+    """Database of the admission control locked by other requests for too
+    long (busy timeout of SQLite)
+    """
+
+
+class Admission():
+    """Rate limits & conversion slots shared by the processes"""
+
+    def __init__(self, db_filepath, rate, burst, max_in_flight, max_waiting,
+                 wait_timeout, run_blocking=None):
+        """
+        :param arg1: Filepath of the SQLite database (created if needed);
+            None disables the admission control.
+        :param arg2: Uploads per second of each client (token bucket).
+        :param arg3: Max number of uploads of a client in a burst.
+        :param arg4: Max number of requests converting files at once.
+        :param arg5: Max number of requests waiting for a slot.
+        :param arg6: Max waiting time of a request (seconds).
+        :param arg7: Function (func, *args) which runs the transactions
+            (blocking calls) & returns their result, ex: in the threadpool
+            of the gevent hub; default: transactions are run directly.
+        :type arg1: <str>
+        :type arg2: <float>
+        :type arg3: <int>
+        :type arg4: <int>
+        :type arg5: <int>
+        :type arg6: <float>
+        """
+
+        self.db_filepath = db_filepath
+        self.rate = rate
+        self.burst = burst
+        self.max_in_flight = max_in_flight
+        self.max_waiting = max_waiting
+        self.wait_timeout = wait_timeout
+        self._run = run_blocking or (lambda func, *args: func(*args))
+
+        if db_filepath:
+            os.makedirs(os.path.dirname(os.path.abspath(db_filepath)),
+                        exist_ok=True)
+            with self._connection() as connection:
+                connection.execute('PRAGMA journal_mode=WAL')
+                connection.executescript(SCHEMA)
+
+    @contextmanager
+    def _connection(self):
+        """Yield a connection in autocommit mode, closed on exit
+
+        .. note:: 1 connection per operation: no connection is shared by
+            threads, greenlets or forked processes.
+        """
+
+        connection = sqlite3.connect(self.db_filepath, timeout=1,
+                                     isolation_level=None)
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    @contextmanager
+    def _transaction(self):
+        """Yield a connection in a write transaction (committed on exit)
+
+        :raises DatabaseLocked: The lock of the database was not obtained
+            before the busy timeout of the connection.
+        """
+
+        try:
+            with self._connection() as connection:
+                # Write lock taken at once: no deadlock between readers
+                connection.execute('BEGIN IMMEDIATE')
+                try:
+                    yield connection
+                except:
+                    connection.execute('ROLLBACK')
+                    raise
+                connection.execute('COMMIT')
+        except sqlite3.OperationalError as error:
+            if 'locked' not in str(error) and 'busy' not in str(error):
+                raise
+            raise DatabaseLocked(self.wait_timeout) from error
+
+    def take_token(self, client):
+        """Take a token in the bucket of the given client.
+
+        :param: Client identifier (ex: IP address).
+        :type: <str>
+        :raises RateLimited: The bucket of the client is empty.
+        :raises DatabaseLocked: (Overloaded) The database is locked.
+        """
+
+        if not self.db_filepath:
+            return
+        self._run(self._take_token, client)
+
+    def _take_token(self, client):
+
+        now = time.time()
+        with self._transaction() as connection:
+            row = connection.execute(
+                'SELECT tokens, updated FROM buckets WHERE client = ?',
+                (client,)
+            ).fetchone()
+
+            if row is None:
+                tokens = self.burst
+            else:
+                tokens = min(self.burst,
+                             row[0] + (now - row[1]) * self.rate)
+
+            if tokens < 1:
+                raise RateLimited((1 - tokens) / self.rate)
+
+            connection.execute(
+                'INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)',
+                (client, tokens - 1, now)
+            )
+            # Buckets refilled long ago are full: they are not needed
+            connection.execute(
+                'DELETE FROM buckets WHERE updated < ?',
+                (now - max(STALE_DELAY, self.burst / self.rate),)
+            )
+
+    def acquire(self):
+        """Take a conversion slot.
+
+        The request waits for a slot in FIFO order if all of them are taken.
+
+        :return: Id of the slot (to give to :meth:`release`).
+        :rtype: <int>
+        :raises Overloaded: The queue is full or the wait is too long.
+        :raises DatabaseLocked: (Overloaded) The database is locked.
+        """
+
+        if not self.db_filepath:
+            return None
+        return self._acquire()
+
+    def release(self, slot_id):
+        """Give back a slot taken by :meth:`acquire`
+
+        .. note:: If the database stays locked, the slot is released later
+            as a stale slot (see :meth:`_release_stale`).
+        """
+
+        if slot_id is None:
+            return
+        try:
+            self._run(self._delete, slot_id)
+        except DatabaseLocked:
+            pass
+
+    def _delete(self, slot_id):
+
+        with self._transaction() as connection:
+            connection.execute('DELETE FROM slots WHERE id = ?', (slot_id,))
+
+    def _acquire(self):
+        """Return the id of a running slot, after a wait in the queue
+
+        .. note:: The wait is made by the caller (gevent: its greenlet),
+            only the transactions are given to :attr:`_run`.
+        """
+
+        slot_id, running = self._run(self._enqueue)
+        if running:
+            return slot_id
+
+        deadline = time.monotonic() + self.wait_timeout
+        while time.monotonic() < deadline:
+            # Cooperative with gevent (patched sleep)
+            time.sleep(POLL_INTERVAL)
+            try:
+                if self._run(self._promote, slot_id):
+                    return slot_id
+            except DatabaseLocked:
+                self.release(slot_id)
+                raise
+
+        self.release(slot_id)
+        raise Overloaded(self.wait_timeout)
+
+    def _enqueue(self):
+        """Insert a slot, running if possible, & return (id, running)"""
+
+        with self._transaction() as connection:
+            self._release_stale(connection)
+            running, waiting = self._counts(connection)
+
+            if running < self.max_in_flight and not waiting:
+                return self._insert(connection, running=True), True
+            if waiting >= self.max_waiting:
+                raise Overloaded(self.wait_timeout)
+            return self._insert(connection, running=False), False
+
+    def _promote(self, slot_id):
+        """Run the given waiting slot if it is its turn; return True if so"""
+
+        with self._transaction() as connection:
+            self._release_stale(connection)
+            running, _ = self._counts(connection)
+            first = connection.execute(
+                'SELECT MIN(id) FROM slots WHERE running = 0'
+            ).fetchone()[0]
+
+            if running < self.max_in_flight and first == slot_id:
+                connection.execute(
+                    'UPDATE slots SET running = 1, updated = ? '
+                    'WHERE id = ?', (time.time(), slot_id)
+                )
+                return True
+
+            connection.execute(
+                'UPDATE slots SET updated = ? WHERE id = ?',
+                (time.time(), slot_id)
+            )
+            return False
+
+    @staticmethod
+    def _insert(connection, running):
+        """Insert a slot of the current process & return its id"""
+
+        return connection.execute(
+            'INSERT INTO slots (pid, running, updated) VALUES (?, ?, ?)',
+            (os.getpid(), int(running), time.time())
+        ).lastrowid
+
+    @staticmethod
+    def _counts(connection):
+        """Return the numbers of running & waiting requests"""
+
+        counts = dict(connection.execute(
+            'SELECT running, COUNT(*) FROM slots GROUP BY running'
+        ))
+        return counts.get(1, 0), counts.get(0, 0)
+
+    @staticmethod
+    def _release_stale(connection):
+        """Delete slots of dead processes & slots not updated for long"""
+
+        connection.execute('DELETE FROM slots WHERE updated < ?',
+                           (time.time() - STALE_DELAY,))
+        pids = [pid for pid, in connection.execute(
+            'SELECT DISTINCT pid FROM slots')]
+        for pid in pids:
+            if not process_alive(pid):
+                connection.execute('DELETE FROM slots WHERE pid = ?', (pid,))
@@ -0,0 +1,401 @@
+# -*- coding: utf-8 -*-
+# MIT License
+#
+# Copyright (c) 2017 Ysard
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""This module converts many Firefox profiles at once with a pool of processes.
+
+Profiles are found in a directory tree (any directory holding at least one
+supported export) or are listed in a CSV manifest with the columns:
+name, permissions, requestpolicy, noscript (empty cells are allowed).
+
+One uMatrix ruleset is written per profile in the output directory.
+"""
+
+# Standard imports
+import os
+import sys
+import csv
+import time
+import argparse
+import tempfile
+from itertools import chain
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Custom imports
+from uMatrix_converter import FirefoxPermissionsParser, RequestPolicyParser, \
+    NoScriptParser, iter_rules, iter_streamed_rules, iter_merged_rules, \
+    write_rules
+from ruleset import CONFLICT_POLICIES
+from incremental import Snapshot, delta_rules, iter_patch, apply_patch
+
+# Kinds of exports in a profile, in order of conversion
+EXPORTS = (
+    ('permissions', FirefoxPermissionsParser),
+    ('requestpolicy', RequestPolicyParser),
+    ('noscript', NoScriptParser),
+)
+
+
+def guess_export_kind(filename):
+    """Return the kind of export of the given filename, based on its name.
+
+    :param: Filename.
+    :type: <str>
+    :return: 'permissions', 'requestpolicy', 'noscript' or None.
+    :rtype: <str>
+    """
+
+    filename = filename.lower()
+    if filename == 'permissions.sqlite':
+        return 'permissions'
+    if not filename.endswith('.txt'):
+        return None
+    if filename.startswith('requestpolicy'):
+        return 'requestpolicy'
+    if filename.startswith('noscript'):
+        return 'noscript'
+    return None
+
+
+def find_profiles(root_dir):
+    """Yield profiles found in the given directory tree.
+
+    A profile is a directory with at least one supported export; its name
+    is its path relative to root_dir.
+
+    :param: Root directory.
+    :type: <str>
+    :return: Generator of profiles (dict with 'name' key & kinds of exports
+        as keys of filepaths).
+    :rtype: <generator <dict>>
+    """
+
+    for dirpath, dirnames, filenames in os.walk(root_dir):
+        dirnames.sort()
+        profile = dict()
+        for filename in sorted(filenames):
+            kind = guess_export_kind(filename)
+            if kind is not None and kind not in profile:
+                profile[kind] = os.path.join(dirpath, filename)
+
+        if profile:
+            profile['name'] = os.path.relpath(dirpath, root_dir)
+            yield profile
+
+
+def read_manifest(manifest_filepath):
+    """Yield profiles listed in the given CSV manifest.
+
+    Relative filepaths are resolved from the directory of the manifest.
+
+    :param: Filepath of the manifest.
+    :type: <str>
+    :return: Generator of profiles (see :meth:`find_profiles`).
+    :rtype: <generator <dict>>
+    """
+
+    base_dir = os.path.dirname(os.path.abspath(manifest_filepath))
+
+    with open(manifest_filepath, newline='') as fd:
+        for line_number, row in enumerate(csv.DictReader(fd), 2):
+            profile = {
+                kind: os.path.join(base_dir, row[kind])
+                for kind, _ in EXPORTS if row.get(kind)
+            }
+            profile['name'] = row.get('name') or str(line_number)
+            yield profile
+
+
+def ruleset_filepath(output_dir, profile_name):
+    """Return the filepath of the uMatrix ruleset of the given profile
+
+    Subdirectories of the name are kept ('a/b' & 'a_b' don't share their
+    ruleset); the filepath never leaves the output directory.
+    """
+
+    parts = [part for part in os.path.normpath(profile_name).split(os.sep)
+             if part not in ('', os.curdir, os.pardir)]
+    if not parts:
+        parts = ['profile']
+    parts[-1] += '_uMatrix-rules.txt'
+    return os.path.join(output_dir, *parts)
+
+
+def snapshot_filepath(output_filepath, kind):
+    """Return the filepath of the snapshot of an export of a profile"""
+    return output_filepath + '.' + kind + '.snapshot'
+
+
+def convert_profile(profile, output_filepath, advanced=False, stream=False,
+                    optimize=False, conflicts='keep'):
+    """Convert all exports of a profile into 1 uMatrix ruleset.
+
+    .. note:: Executed in a worker process.
+
+    :param arg1: Profile (see :meth:`find_profiles`).
+    :param arg2: Filepath of the uMatrix ruleset (overwritten; removed if
+        the conversion fails).
+    :param arg3: Trigger advanced rules for request policy.
+    :param arg4: Convert exports while they are read.
+    :param arg5: Remove duplicated & redundant rules.
+    :param arg6: Policy of resolution of conflicts between exports
+        (see :meth:`ruleset.RuleSet.resolve_conflicts`).
+    :return: Name of the profile, number of rules, elapsed time (seconds).
+    :rtype: <tuple <str>, <int>, <float>>
+    """
+
+    def iter_exports_rules():
+        for kind, parser_class in EXPORTS:
+            filepath = profile.get(kind)
+            if not filepath:
+                continue
+
+            config = parser_class()
+            if stream:
+                yield iter_streamed_rules(config, filepath, advanced=advanced)
+            else:
+                config.read_file(filepath)
+                yield iter_rules(config, advanced=advanced)
+
+    start = time.perf_counter()
+
+    if optimize or conflicts != 'keep':
+        # 1 indexed ruleset, emitted in canonical order
+        rules = iter_merged_rules(iter_exports_rules(), conflicts, optimize)
+    else:
+        rules = chain.from_iterable(iter_exports_rules())
+
+    try:
+        with open(output_filepath, 'w') as fd:
+            count = write_rules(rules, fd)
+    except:
+        # Don't leave a partial ruleset (if the file was created at all)
+        try:
+            os.unlink(output_filepath)
+        except FileNotFoundError:
+            pass
+        raise
+
+    # Snapshots of a previous incremental update are outdated
+    for kind, _ in EXPORTS:
+        try:
+            os.unlink(snapshot_filepath(output_filepath, kind))
+        except FileNotFoundError:
+            pass
+
+    return profile['name'], count, time.perf_counter() - start
+
+
+def update_profile(profile, output_filepath, advanced=False):
+    """Update the uMatrix ruleset of a profile with the changes of its exports.
+
+    Exports are compared to the snapshots of the previous update; only rules
+    of added & removed entries are made, then they are applied on the
+    previous ruleset (see :mod:`incremental`).
+    Without previous ruleset, all the rules are made.
+
+    .. note:: Executed in a worker process.
+
+    :param arg1: Profile (dict with the name & the filepaths of exports).
+    :param arg2: Filepath of the uMatrix ruleset (replaced only when the
+        update succeeds).
+    :param arg3: Trigger advanced rules for request policy.
+    :return: Name of the profile, number of rules, elapsed time (seconds).
+    :rtype: <tuple <str>, <int>, <float>>
+    """
+
+    start = time.perf_counter()
+    ruleset_found = os.path.exists(output_filepath)
+    patch = list()
+    snapshots = list()
+
+    for kind, parser_class in EXPORTS:
+        filepath = profile.get(kind)
+
+        previous = Snapshot(parser_class.__name__, advanced)
+        if ruleset_found:
+            try:
+                previous = Snapshot.load(snapshot_filepath(output_filepath,
+                                                           kind))
+            except FileNotFoundError:
+                pass
+
+        if filepath:
+            snapshot = Snapshot.from_export(parser_class(), filepath, advanced)
+        elif not previous:
+            continue
+        else:
+            # The export was removed from the profile
+            snapshot = Snapshot(parser_class.__name__, advanced)
+
+        patch.extend(iter_patch(*delta_rules(snapshot, previous)))
+        snapshots.append((kind, snapshot))
+
+    lines = list()
+    if ruleset_found:
+        with open(output_filepath) as fd:
+            lines = fd.readlines()
+
+    # The previous ruleset is replaced only by a complete one
+    fd, tmp_filepath = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(output_filepath)), suffix='.tmp'
+    )
+    try:
+        with os.fdopen(fd, 'w') as tmp_fd:
+            count = write_rules(apply_patch(lines, patch), tmp_fd)
+        os.replace(tmp_filepath, output_filepath)
+    except:
+        os.unlink(tmp_filepath)
+        raise
+
+    for kind, snapshot in snapshots:
+        snapshot.save(snapshot_filepath(output_filepath, kind))
+
+    return profile['name'], count, time.perf_counter() - start
+
+
+def convert_profiles(profiles, output_dir, workers=None, advanced=False,
+                     stream=False, optimize=False, incremental=False,
+                     conflicts='keep'):
+    """Convert the given profiles in parallel.
+
+    :param arg1: Iterable of profiles (see :meth:`find_profiles`).
+    :param arg2: Output directory (created if needed).
+    :param arg3: Number of worker processes (default: number of CPUs).
+    :param arg4: Trigger advanced rules for request policy.
+    :param arg5: Convert exports while they are read.
+    :param arg6: Remove duplicated & redundant rules.
+    :param arg7: Only apply changes of exports on previous rulesets
+        (see :meth:`update_profile`).
+    :param arg8: Policy of resolution of conflicts between exports.
+    :return: Generator of results for each job as soon as it is finished:
+        (name, number of rules, elapsed time, error or None).
+        A profile with the same ruleset as a previous one is not converted.
+    :rtype: <generator <tuple>>
+    """
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+
+        futures = dict()
+        # Rulesets of submitted profiles => names of the profiles
+        output_filepaths = dict()
+        for profile in profiles:
+            output_filepath = ruleset_filepath(output_dir, profile['name'])
+            if output_filepath in output_filepaths:
+                # Jobs would overwrite each other's ruleset
+                yield profile['name'], 0, 0., ValueError(
+                    "Same ruleset as the profile " +
+                    output_filepaths[output_filepath])
+                continue
+            output_filepaths[output_filepath] = profile['name']
+            os.makedirs(os.path.dirname(output_filepath), exist_ok=True)
+
+            if incremental:
+                future = executor.submit(
+                    update_profile, profile, output_filepath, advanced
+                )
+            else:
+                future = executor.submit(
+                    convert_profile, profile, output_filepath,
+                    advanced, stream, optimize, conflicts
+                )
+            futures[future] = profile['name']
+
+        for future in as_completed(futures):
+            try:
+                name, count, elapsed = future.result()
+            except Exception as e:
+                yield futures[future], 0, 0., e
+            else:
+                yield name, count, elapsed, None
+
+
+def main():
+    """Convert a fleet of profiles and report timing & failures of each job"""
+
+    arg_parser = argparse.ArgumentParser(
+        description="Convert many Firefox profiles to uMatrix rulesets."
+    )
+    source = arg_parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('-d', '--directory',
+                        help="Directory tree of profiles")
+    source.add_argument('-m', '--manifest',
+                        help="CSV manifest of profiles (columns: name, "
+                             "permissions, requestpolicy, noscript)")
+    arg_parser.add_argument('-o', '--output-dir', required=True,
+                            help="Directory of uMatrix rulesets")
+    arg_parser.add_argument('-j', '--workers', type=int, default=None,
+                            help="Number of worker processes "
+                                 "(default: number of CPUs)")
+    arg_parser.add_argument('-a', '--advanced', action='store_true',
+                            help="Make restricted rules for RequestPolicy")
+    arg_parser.add_argument('-s', '--stream', action='store_true',
+                            help="Convert exports while they are read")
+    arg_parser.add_argument('-O', '--optimize', action='store_true',
+                            help="Remove duplicated & redundant rules")
+    arg_parser.add_argument('-c', '--conflicts', default='keep',
+                            choices=CONFLICT_POLICIES,
+                            help="Resolution of conflicting rules (opposite "
+                                 "actions on the same requests) "
+                                 "(default: keep)")
+    arg_parser.add_argument('-i', '--incremental', action='store_true',
+                            help="Only apply changes of exports since the "
+                                 "previous run on existing rulesets")
+    args = arg_parser.parse_args()
+
+    if args.incremental and (args.optimize or args.conflicts != 'keep'):
+        # Removed rules may have made other rules necessary
+        arg_parser.error("--optimize & --conflicts can't be used with "
+                         "--incremental")
+
+    if args.directory:
+        profiles = find_profiles(args.directory)
+    else:
+        profiles = read_manifest(args.manifest)
+
+    start = time.perf_counter()
+    done, failures = 0, 0
+
+    results = convert_profiles(profiles, args.output_dir, args.workers,
+                               args.advanced, args.stream, args.optimize,
+                               args.incremental, args.conflicts)
+    for name, count, elapsed, error in results:
+        if error is None:
+            done += 1
+            print("OK\t{}\t{} rules\t{:.3f}s".format(name, count, elapsed))
+        else:
+            failures += 1
+            # Keep 1 line per job
+            message = str(error).split('\n')[0]
+            print("FAIL\t{}\t{}: {}".format(
+                name, type(error).__name__, message))
+
+    print("{} profiles converted, {} failures in {:.3f}s".format(
+        done, failures, time.perf_counter() - start), file=sys.stderr)
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+
+    sys.exit(main())
@@ -0,0 +1,503 @@
+# -*- coding: utf-8 -*-
+# MIT License
+#
+# Copyright (c) 2017 Ysard
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Benchmarks of parsers, converters and of the website.
+
+Synthetic exports of configurable size are generated in a temporary
+directory, then each stage is timed several times:
+
+    - parse: read_file() of each parser;
+    - convert: consumption of the rules generators of each parser;
+    - website: POST of the 3 files through the Flask test client,
+      from several concurrent clients;
+    - import: import of the converter in new interpreters (-X importtime),
+      checked against a budget for the conversion of text exports.
+
+Throughput, p50/p99 latencies and peak memory (tracemalloc) are saved in a
+JSON file; a previous JSON file can be given as a baseline to show the
+differences and detect regressions.
+
+Usage:
+
+    python3 benchmark.py --size 100000 --output bench.json
+    python3 benchmark.py --size 100000 --compare bench.json
+"""
+
+# Standard imports
+import io
+import os
+import sys
+import json
+import time
+import random
+import sqlite3
+import argparse
+import tempfile
+import subprocess
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+# Custom imports
+from uMatrix_converter import RequestPolicyParser, NoScriptParser, \
+    FirefoxPermissionsParser, iter_rules
+
+# Default relative tolerance before a slowdown is reported as a regression
+TOLERANCE = 0.10
+# Max time of the import of the converter (seconds), for text exports
+IMPORT_TIME_BUDGET = 0.05
+# Modules which must not be imported to convert text exports
+HEAVY_MODULES = ('sqlalchemy', 'numpy', 'sqlite3')
+
+
+def generate_hosts(number, seed=0):
+    """Return a list of random hosts spread over a few domains
+
+    :param arg1: Number of hosts.
+    :param arg2: Seed of the random generator.
+    :return: List of hosts.
+    :rtype: <list <str>>
+    """
+
+    rand = random.Random(seed)
+    domains = max(1, number // 20)
+    return [
+        'h{}.d{}.{}'.format(i, rand.randrange(domains),
+                            rand.choice(('com', 'org', 'net', 'fr')))
+        for i in range(number)
+    ]
+
+
+def generate_request_policy(fd, pairs, hosts, seed=0):
+    """Write a RequestPolicy export with the given number of
+    origin|destination pairs (+ 10% of destinations & origins).
+
+    :param arg1: Text file object.
+    :param arg2: Number of origin => destination rules.
+    :param arg3: Hosts to pick from.
+    :param arg4: Seed of the random generator.
+    """
+
+    rand = random.Random(seed)
+    fd.write('[origins-to-destinations]\n')
+    fd.writelines(
+        '{}|{}\n'.format(rand.choice(hosts), rand.choice(hosts))
+        for _ in range(pairs)
+    )
+    for section in ('destinations', 'origins'):
+        fd.write('[{}]\n'.format(section))
+        fd.writelines(
+            rand.choice(hosts) + '\n' for _ in range(max(1, pairs // 10))
+        )
+
+
+def generate_noscript(fd, lines, hosts, seed=0):
+    """Write a NoScript whitelist with the given number of lines
+    (10% of them are untrusted hosts).
+
+    :param arg1: Text file object.
+    :param arg2: Number of hosts.
+    :param arg3: Hosts to pick from.
+    :param arg4: Seed of the random generator.
+    """
+
+    rand = random.Random(seed)
+    protocols = ('', 'http://', 'https://')
+    untrusted = lines // 10
+    fd.writelines(
+        rand.choice(protocols) + rand.choice(hosts) + '\n'
+        for _ in range(lines - untrusted)
+    )
+    fd.write('about:blank\n[UNTRUSTED]\n')
+    fd.writelines(rand.choice(hosts) + '\n' for _ in range(untrusted))
+
+
+def generate_permissions(filepath, rows, hosts, seed=0):
+    """Write a permissions.sqlite database with the given number of rows
+    in 'moz_perms' table (75% of them are cookies permissions).
+
+    :param arg1: Filepath of the database (overwritten).
+    :param arg2: Number of rows.
+    :param arg3: Hosts to pick from.
+    :param arg4: Seed of the random generator.
+    """
+
+    rand = random.Random(seed)
+    if os.path.exists(filepath):
+        os.unlink(filepath)
+
+    connection = sqlite3.connect(filepath)
+    connection.execute(
+        'CREATE TABLE moz_perms ('
+        'id INTEGER PRIMARY KEY, origin TEXT, type TEXT, permission INTEGER, '
+        'expireType INTEGER, expireTime INTEGER, modificationTime INTEGER)'
+    )
+    connection.executemany(
+        'INSERT INTO moz_perms (origin, type, permission, expireType, '
+        'expireTime, modificationTime) VALUES (?, ?, ?, 0, 0, 0)',
+        (
+            (
+                rand.choice(('http://', 'https://')) + rand.choice(hosts),
+                rand.choice(('cookie', 'cookie', 'cookie', 'image')),
+                rand.choice((1, 2, 8)),
+            )
+            for _ in range(rows)
+        )
+    )
+    connection.commit()
+    connection.close()
+
+
+def generate_exports(directory, size, seed=0):
+    """Generate the 3 kinds of exports in the given directory.
+
+    :param arg1: Directory.
+    :param arg2: Number of entries of each export.
+    :param arg3: Seed of the random generator.
+    :return: Filepaths of exports by kind.
+    :rtype: <dict>
+    """
+
+    hosts = generate_hosts(max(10, size // 5), seed)
+    exports = {
+        'requestpolicy': os.path.join(directory, 'requestpolicy.txt'),
+        'noscript': os.path.join(directory, 'noscript.txt'),
+        'permissions': os.path.join(directory, 'permissions.sqlite'),
+    }
+
+    with open(exports['requestpolicy'], 'w') as fd:
+        generate_request_policy(fd, size, hosts, seed)
+    with open(exports['noscript'], 'w') as fd:
+        generate_noscript(fd, size, hosts, seed)
+    generate_permissions(exports['permissions'], size, hosts, seed)
+    return exports
+
+
+def percentile(values, ratio):
+    """Return the percentile (nearest rank) of the given values"""
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(ratio * len(values)))]
+
+
+def measure(func, repeat, items=None):
+    """Time the given function & measure its peak memory.
+
+    .. note:: Peak memory is measured during an additional run, since
+        tracemalloc slows down the execution.
+
+    :param arg1: Function without argument.
+    :param arg2: Number of timed runs.
+    :param arg3: Number of items processed by each run (for throughput).
+    :return: Metrics: p50, p99, mean (seconds), throughput (items/s),
+        peak memory (bytes).
+    :rtype: <dict>
+    """
+
+    timings = list()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    mean = sum(timings) / len(timings)
+    metrics = {
+        'p50': percentile(timings, 0.50),
+        'p99': percentile(timings, 0.99),
+        'mean': mean,
+        'peak_memory': peak,
+    }
+    if items:
+        metrics['throughput'] = items / mean
+    return metrics
+
+
+def bench_import(repeat, module='uMatrix_converter'):
+    """Time the import of the converter in new interpreters
+
+    Cumulative times given by -X importtime exclude the startup of Python.
+
+    :param arg1: Number of timed imports.
+    :param arg2: Imported module.
+    :return: Metrics by name of benchmark: p50, p99, mean (seconds) & heavy
+        modules imported with it (see HEAVY_MODULES).
+    :rtype: <dict>
+    """
+
+    timings = list()
+    heavy_modules = set()
+    for _ in range(repeat):
+        process = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.PIPE, universal_newlines=True, check=True
+        )
+
+        # import time: self [us] | cumulative | imported package
+        for line in process.stderr.splitlines():
+            fields = line.split('|')
+            if len(fields) != 3 or not line.startswith('import time:'):
+                continue
+            name = fields[2].strip()
+            if name.split('.')[0] in HEAVY_MODULES:
+                heavy_modules.add(name.split('.')[0])
+            if name == module:
+                timings.append(int(fields[1]) / 1000000)
+
+    return {
+        'import_' + module: {
+            'p50': percentile(timings, 0.50),
+            'p99': percentile(timings, 0.99),
+            'mean': sum(timings) / len(timings),
+            'heavy_modules': sorted(heavy_modules),
+        }
+    }
+
+
+def bench_parsers(exports, size, repeat):
+    """Benchmark read_file() & conversion of each parser
+
+    :return: Metrics by name of benchmark.
+    :rtype: <dict>
+    """
+
+    parsers = (
+        ('requestpolicy', RequestPolicyParser),
+        ('noscript', NoScriptParser),
+        ('permissions', FirefoxPermissionsParser),
+    )
+
+    results = dict()
+    for kind, parser_class in parsers:
+
+        def parse():
+            parser = parser_class()
+            parser.read_file(exports[kind])
+            # Force lazy processing of sections
+            for name in parser.sections():
+                len(parser.section(name))
+            return parser
+
+        results['parse_' + kind] = measure(parse, repeat, size)
+
+        parser = parse()
+        for advanced in (False, True):
+            rules = sum(1 for _ in iter_rules(parser, advanced=advanced))
+
+            def convert():
+                for _ in iter_rules(parser, advanced=advanced):
+                    pass
+
+            name = 'convert_' + kind + ('_advanced' if advanced else '')
+            results[name] = measure(convert, repeat, rules)
+            results[name]['rules'] = rules
+
+    return results
+
+
+def bench_website(exports, repeat, clients):
+    """Benchmark POST requests of the 3 exports on the website.
+
+    .. note:: The website module is imported here since it needs Flask;
+        uploads bigger than the MAX_CONTENT_LENGTH setting are refused by
+        the website, keep the size of exports small for this benchmark.
+
+    :param arg1: Filepaths of exports by kind.
+    :param arg2: Number of requests per client.
+    :param arg3: Number of concurrent clients.
+    :return: Metrics by name of benchmark.
+    :rtype: <dict>
+    """
+
+    import commons as cm
+    # All the requests come from 1 address: the rate limit of the admission
+    # control would refuse them (set before the creation of its database)
+    cm.ADMISSION_DB = None
+    import website
+
+    # Don't measure the cache of results
+    website.RESULT_CACHE = type(website.RESULT_CACHE)(0)
+    website.ADMISSION.db_filepath = None
+
+    contents = dict()
+    for field, kind in (('ns_fic', 'noscript'), ('rp_fic', 'requestpolicy'),
+                        ('fp_fic', 'permissions')):
+        with open(exports[kind], 'rb') as fd:
+            contents[field] = (fd.read(), os.path.basename(exports[kind]))
+
+    def post(client):
+        start = time.perf_counter()
+        data = {
+            field: (io.BytesIO(content), filename)
+            for field, (content, filename) in contents.items()
+        }
+        response = client.post(cm.NGINX_PREFIX, data=data,
+                               content_type='multipart/form-data')
+        response.get_data()
+        assert response.status_code == 200 \
+            and response.mimetype == 'text/plain', "Website request failed"
+        return time.perf_counter() - start
+
+    def client_session(_):
+        client = website.app.test_client()
+        return [post(client) for _ in range(repeat)]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        latencies = [
+            latency for session in executor.map(client_session, range(clients))
+            for latency in session
+        ]
+    elapsed = time.perf_counter() - start
+
+    return {
+        'website': {
+            'p50': percentile(latencies, 0.50),
+            'p99': percentile(latencies, 0.99),
+            'mean': sum(latencies) / len(latencies),
+            'throughput': len(latencies) / elapsed,
+            'clients': clients,
+        }
+    }
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """Print differences with a baseline & return the list of regressions.
+
+    Latencies (p50, p99, mean) & peak memory are regressions if they grow
+    more than tolerance; throughput if it drops more than tolerance.
+
+    :param arg1: Current metrics by name of benchmark.
+    :param arg2: Baseline metrics by name of benchmark.
+    :param arg3: Relative tolerance.
+    :return: List of (benchmark, metric, baseline value, current value).
+    :rtype: <list <tuple>>
+    """
+
+    higher_is_better = ('throughput',)
+    regressions = list()
+
+    for name, metrics in sorted(results.items()):
+        reference = baseline.get(name)
+        if reference is None:
+            print("{:<35} new".format(name))
+            continue
+
+        for metric in ('p50', 'p99', 'mean', 'throughput', 'peak_memory'):
+            if metric not in metrics or not reference.get(metric):
+                continue
+            old, new = reference[metric], metrics[metric]
+            change = (new - old) / old
+            worse = -change if metric in higher_is_better else change
+            flag = ''
+            if worse > tolerance:
+                flag = ' REGRESSION'
+                regressions.append((name, metric, old, new))
+            print("{:<35} {:<12} {:>+8.1%}{}".format(name, metric, change,
+                                                     flag))
+
+    return regressions
+
+
+def main():
+    """Run benchmarks & save or compare results"""
+
+    arg_parser = argparse.ArgumentParser(
+        description="Benchmark parsers, converters and the website."
+    )
+    arg_parser.add_argument('-s', '--size', type=int, default=100000,
+                            help="Number of entries in each export "
+                                 "(default: 100000)")
+    arg_parser.add_argument('-r', '--repeat', type=int, default=5,
+                            help="Number of timed runs (default: 5)")
+    arg_parser.add_argument('--website', action='store_true',
+                            help="Also benchmark the website (needs Flask)")
+    arg_parser.add_argument('--website-size', type=int, default=1000,
+                            help="Number of entries in each uploaded export "
+                                 "(default: 1000)")
+    arg_parser.add_argument('--clients', type=int, default=4,
+                            help="Concurrent clients of the website "
+                                 "(default: 4)")
+    arg_parser.add_argument('--import-budget', type=float,
+                            default=IMPORT_TIME_BUDGET,
+                            help="Max time of the import of the converter "
+                                 "(default: 0.05s)")
+    arg_parser.add_argument('-o', '--output',
+                            help="Save results in this JSON file")
+    arg_parser.add_argument('-c', '--compare',
+                            help="Compare results with this JSON file")
+    arg_parser.add_argument('-t', '--tolerance', type=float,
+                            default=TOLERANCE,
+                            help="Relative tolerance before a regression "
+                                 "(default: 0.10)")
+    args = arg_parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+
+        exports = generate_exports(directory, args.size)
+        results = bench_parsers(exports, args.size, args.repeat)
+
+        if args.website:
+            exports = generate_exports(directory, args.website_size)
+            results.update(
+                bench_website(exports, args.repeat, args.clients)
+            )
+
+    results.update(bench_import(args.repeat))
+
+    for name, metrics in sorted(results.items()):
+        print("{:<35} p50: {:.4f}s p99: {:.4f}s throughput: {:.0f}/s".format(
+            name, metrics['p50'], metrics['p99'],
+            metrics.get('throughput', 0)))
+
+    # Conversions of text exports must start fast
+    failures = 0
+    import_metrics = results['import_uMatrix_converter']
+    if import_metrics['p50'] > args.import_budget:
+        print("Import of the converter over budget: {:.4f}s > {:.4f}s".format(
+            import_metrics['p50'], args.import_budget))
+        failures += 1
+    if import_metrics['heavy_modules']:
+        print("Heavy modules imported by the converter: " +
+              ", ".join(import_metrics['heavy_modules']))
+        failures += 1
+
+    if args.output:
+        with open(args.output, 'w') as fd:
+            json.dump(results, fd, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as fd:
+            baseline = json.load(fd)
+        if compare(results, baseline, args.tolerance):
+            return 1
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+
+    sys.exit(main())
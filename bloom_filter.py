@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+# MIT License
+#
+# Copyright (c) 2017 Ysard
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""This module provides a Bloom filter used to deduplicate huge exports with a
+bounded amount of memory."""
+
+# Standard imports
+import math
+
+
+class BloomFilter():
+    """Probabilistic set of hashable objects
+
+    Membership tests can give false positives (never false negatives);
+    the memory footprint is fixed at the creation of the filter.
+
+    .. note:: Hashes rely on the builtin hash() function which is salted
+        per process: a filter is not meant to be shared between processes.
+    """
+
+    def __init__(self, capacity, error_rate=0.0001):
+        """Size the filter for the given number of items.
+
+        :param arg1: Expected number of items.
+        :param arg2: Acceptable false positive rate when the filter is full.
+        :type arg1: <int>
+        :type arg2: <float>
+        """
+
+        capacity = max(1, capacity)
+        # Optimal number of bits & number of hashes
+        self._size = max(
+            8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2))
+        )
+        self._hashes = max(1, round(self._size / capacity * math.log(2)))
+        self._bits = bytearray((self._size + 7) // 8)
+
+    def _positions(self, item):
+        """Yield the positions of bits of the given item
+
+        .. note:: Double hashing: the 64 bits builtin hash is split into two
+            32 bits hashes combined k times.
+        """
+
+        item_hash = hash(item) & 0xFFFFFFFFFFFFFFFF
+        hash_1 = item_hash & 0xFFFFFFFF
+        hash_2 = (item_hash >> 32) | 1
+        size = self._size
+        for i in range(self._hashes):
+            yield (hash_1 + i * hash_2) % size
+
+    def add(self, item):
+        """Add the given item to the filter"""
+
+        bits = self._bits
+        for position in self._positions(item):
+            bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        """Return True if the item was probably added before"""
+
+        bits = self._bits
+        return all(
+            bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(item)
+        )
+
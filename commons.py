@@ -1,7 +1,11 @@
 # -*- coding: utf-8 -*-
 
+import os
+import sys
+import json
+import atexit
 import logging
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 
 # Directory paths
 DIR_LOGS        = 'logs/'
@@ -20,10 +24,75 @@ STATIC_PREFIX   = NGINX_PREFIX + '/static'
 # Upload size restriction
 # In case of client_max_body_size 100k; restriction not set in NGinx config
 MAX_CONTENT_LENGTH = 100 * 1024
+# Max size of each uploaded file by form field, checked while it is received
+# (see upload_guard.py)
+MAX_FILE_LENGTHS = {
+    'ns_fic': MAX_CONTENT_LENGTH,
+    'rp_fic': MAX_CONTENT_LENGTH,
+    'fp_fic': MAX_CONTENT_LENGTH,
+    'any_fic': MAX_CONTENT_LENGTH,
+}
+
+# Max number of concurrent conversions (parsing & rules generation)
+# in each worker
+CONVERSION_WORKERS = 4
+# Number of processes of each worker for conversions (0: threads only);
+# files of a request are converted in parallel despite the GIL
+CONVERSION_PROCESSES = 3
+
+# Admission control of uploads, shared by all workers through a SQLite
+# database (None to disable)
+ADMISSION_DB = DIR_WEBSITE + 'admission.sqlite'
+# Token bucket of each client: uploads per second & max burst
+RATE_LIMIT = 0.5
+RATE_BURST = 10
+# Max number of requests converting files at once in all workers, max number
+# of requests waiting for them & max waiting time in seconds (keep it below
+# the timeout of gunicorn)
+MAX_IN_FLIGHT = 4
+MAX_WAITING = 16
+ADMISSION_WAIT = 5
+# Native threads of each gevent worker which run the SQLite transactions of
+# the admission control (not the threads of conversions)
+ADMISSION_THREADS = 2
+
+# Cache of generated rules
+# Max number of characters of rules kept in memory by each worker
+RESULT_CACHE_SIZE = 10 * 1024 * 1024
+# Directory shared by all workers (None to disable), & its max size in bytes
+RESULT_CACHE_DIR = None # DIR_WEBSITE + 'cache'
+RESULT_CACHE_DISK_SIZE = 100 * 1024 * 1024
+
+# Remove duplicated & redundant rules from the generated ruleset
+OPTIMIZE_RULES = True
+# Resolution of conflicting rules of different files (opposite actions on the
+# same requests, see CONFLICT_POLICIES in ruleset.py)
+MERGE_CONFLICTS = 'keep'
+
+# Snapshots of the previous uploads of each session (None to disable);
+# they allow to download only the changes since the last upload
+SNAPSHOT_DIR = None # DIR_WEBSITE + 'snapshots'
+
+# Metrics of all the processes of the website (/metrics page);
+# directory emptied when the service starts (None: metrics of 1 process)
+METRICS_DIR = DIR_WEBSITE + 'metrics'
+
+# Conversion daemon for local scripts (see conversion_daemon.py)
+DAEMON_SOCKET = DIR_WEBSITE + 'daemon.sock'
+# Number of conversion processes, forked at start (0: threads only)
+DAEMON_PROCESSES = 3
+# Max size of a request (1 JSON line, base64 encoded export) in bytes
+DAEMON_MAX_REQUEST = 16 * 1024 * 1024
+# Max number of requests of a connection converted at once
+DAEMON_PIPELINE = 16
 
 # Logging
 LOGGER_NAME     = 'uMatrixConverter'
-LOG_LEVEL       = logging.DEBUG
+# Level & format ('text' or 'json') can be set by the environment
+LOG_LEVEL       = os.environ.get('UMATRIX_LOG_LEVEL', 'DEBUG').upper()
+LOG_FORMAT      = os.environ.get('UMATRIX_LOG_FORMAT', 'text')
+# Records are written by a background thread: no I/O in the request path
+LOG_QUEUE       = True
 
 # Piwik analytics
 PIWIK_SITE_ID   = '1'
@@ -40,33 +109,137 @@ def logger(name=LOGGER_NAME, logfilename=None):
 
 
 
+# Attributes of all records; others are given with the 'extra' argument
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {'message'}
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as JSON objects (1 per line)
+
+    Extra attributes of records (ex: LOGGER.info(msg, extra={'field': 'x'}))
+    are kept as keys of the object.
+    """
+
+    def format(self, record):
+
+        data = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'process': record.process,
+            'message': record.getMessage(),
+        }
+        data.update(
+            (key, value) for key, value in vars(record).items()
+            if key not in _RECORD_ATTRIBUTES
+        )
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
 _logger = logging.getLogger(LOGGER_NAME)
 _logger.setLevel(LOG_LEVEL)
 
 # log file
-formatter    = logging.Formatter(
-    '%(asctime)s :: %(levelname)s :: %(message)s'
-)
+if LOG_FORMAT == 'json':
+    formatter = JsonFormatter()
+else:
+    formatter = logging.Formatter(
+        '%(asctime)s :: %(levelname)s :: %(message)s'
+    )
 file_handler = RotatingFileHandler(
     DIR_LOGS + LOGGER_NAME + '.log',
     'a', 1000000, 1
 )
 file_handler.setLevel(LOG_LEVEL)
 file_handler.setFormatter(formatter)
-_logger.addHandler(file_handler)
 
 # terminal log
 stream_handler = logging.StreamHandler()
-formatter      = logging.Formatter('%(levelname)s: %(message)s')
+if LOG_FORMAT == 'json':
+    formatter = JsonFormatter()
+else:
+    formatter = logging.Formatter('%(levelname)s: %(message)s')
 stream_handler.setFormatter(formatter)
 stream_handler.setLevel(LOG_LEVEL)
-_logger.addHandler(stream_handler)
+
+def _native(module_name, name):
+    """Return an object of a module, the original one if gevent patched it"""
+
+    monkey = sys.modules.get('gevent.monkey')
+    if monkey is not None and monkey.is_module_patched(module_name):
+        return monkey.get_original(module_name, name)
+    return getattr(__import__(module_name), name)
+
+
+class NativeQueueListener(QueueListener):
+    """QueueListener running in a native thread, even with gevent
+
+    In a monkey-patched process, a regular thread is a greenlet: its writes
+    would block the event loop.
+    """
+
+    def start(self):
+
+        # Low level primitives: Event & Thread of threading would use the
+        # patched ones internally
+        self._stopped = _native('_thread', 'allocate_lock')()
+        self._stopped.acquire()
+
+        def monitor():
+            try:
+                self._monitor()
+            finally:
+                self._stopped.release()
+
+        _native('_thread', 'start_new_thread')(monitor, ())
+
+    def stop(self):
+
+        self.enqueue_sentinel()
+        self._stopped.acquire()
+
+
+_listener = None
+
+
+def _start_listener():
+    """Write queued records of the current process in a background thread
+
+    .. note:: Called again in forked processes (conversion processes):
+        the thread of the parent is not copied.
+    """
+
+    global _listener
+
+    # Never blocks, even between greenlets & a native thread
+    log_queue = _native('queue', 'SimpleQueue')()
+    for handler in list(_logger.handlers):
+        if isinstance(handler, QueueHandler):
+            _logger.removeHandler(handler)
+    _logger.addHandler(QueueHandler(log_queue))
+
+    _listener = NativeQueueListener(log_queue, file_handler, stream_handler,
+                              respect_handler_level=True)
+    _listener.start()
+
+
+def _stop_listener():
+    """Write the remaining records at exit"""
+
+    if _listener is not None:
+        _listener.stop()
+
+
+if LOG_QUEUE:
+    _start_listener()
+    os.register_at_fork(after_in_child=_start_listener)
+    atexit.register(_stop_listener)
+else:
+    _logger.addHandler(file_handler)
+    _logger.addHandler(stream_handler)
 
 
 def log_level(level):
     """Set terminal log level to given one"""
-    handlers = (_ for _ in _logger.handlers
-                if _.__class__ is logging.StreamHandler
-               )
-    for handler in handlers:
-        handler.setLevel(level.upper())
+    stream_handler.setLevel(level.upper())
@@ -0,0 +1,417 @@
+# -*- coding: utf-8 -*-
+# MIT License
+#
+# Copyright (c) 2017 Ysard
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""This module serves conversions to local scripts through a Unix socket.
+
+Scripts which convert many exports don't pay the startup of the interpreter
+& the HTML form for each of them: the daemon keeps a pool of conversion
+processes, all forked at start with all the modules already imported
+(a pool which is replaced after a crash is forked by the threaded server).
+
+The protocol is made of JSON lines; each request is 1 object:
+
+    {"id": 1, "format": "noscript", "data": "<base64>",
+     "options": {"advanced": false, "optimize": false}}
+
+    - id: optional, any JSON value given back in the response;
+    - format: 'permissions', 'requestpolicy', 'noscript' (see EXPORTS
+      in batch_converter.py), the name of another registered parser
+      (see PARSER_CLASSES) or null: the format is detected from the
+      first bytes of the export (see :meth:`guess_parser`);
+    - data: content of the export, encoded in base64;
+    - options: optional; 'advanced' rules for RequestPolicy, 'optimize'
+      the ruleset (remove duplicated & redundant rules).
+
+Each response is 1 object, in the order of the requests of the connection:
+
+    {"id": 1, "format": "noscript", "count": 42, "rules": "..."}
+    {"id": 1, "error": "..."}
+
+Requests of a connection are converted concurrently (DAEMON_PIPELINE at
+most): a client can send many requests before reading the responses.
+"""
+
+# Standard imports
+import os
+import sys
+import time
+import json
+import stat
+import queue
+import base64
+import signal
+import socket
+import argparse
+import binascii
+import threading
+import socketserver
+from sqlite3 import DatabaseError
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# Custom imports
+import commons as cm
+from uMatrix_converter import PARSER_CLASSES, SNIFF_SIZE, guess_parser, \
+    convert_export
+from batch_converter import EXPORTS
+
+LOGGER = cm.logger()
+
+# Parsers by name of format & names by parser
+FORMATS = dict(EXPORTS)
+FORMAT_NAMES = {parser_class: name for name, parser_class in EXPORTS}
+# Options of requests & their default values
+OPTIONS = {'advanced': False, 'optimize': False}
+
+
+class RequestError(ValueError):
+    """Erroneous request; its message is sent to the client"""
+    pass
+
+
+def parse_request(line):
+    """Return the parameters of a conversion from a line of the protocol.
+
+    :param: Line of the client (JSON object).
+    :type: <bytes>
+    :return: Id of the request, parser class, content of the export, options.
+    :rtype: <tuple>
+    :raises RequestError: The request is erroneous; the id of the request
+        is given with the 'id' attribute.
+    """
+
+    try:
+        request = json.loads(line.decode('utf-8'))
+    except ValueError:
+        raise RequestError("Request is not a JSON object")
+    if not isinstance(request, dict):
+        raise RequestError("Request is not a JSON object")
+
+    request_id = request.get('id')
+    try:
+        data = request.get('data')
+        if not isinstance(data, str):
+            raise RequestError("'data' must be a base64 string")
+        try:
+            data = base64.b64decode(data, validate=True)
+        except binascii.Error:
+            raise RequestError("'data' must be a base64 string")
+
+        name = request.get('format')
+        if name is None:
+            parser_class = guess_parser(data[:SNIFF_SIZE])
+            if parser_class is None:
+                raise RequestError("Data is not a supported export")
+        elif isinstance(name, str) and \
+                (name in FORMATS or name in PARSER_CLASSES):
+            parser_class = FORMATS.get(name) or PARSER_CLASSES[name]
+            if not parser_class.sniff(data[:SNIFF_SIZE]):
+                raise RequestError(
+                    "Data is not a " + parser_class.label + " export")
+        else:
+            raise RequestError("Unknown format: " + str(name))
+
+        options = request.get('options') or dict()
+        if not isinstance(options, dict) or \
+                any(option not in OPTIONS for option in options):
+            raise RequestError("Options must be among: " + ", ".join(OPTIONS))
+        options = {option: bool(options.get(option, default))
+                   for option, default in OPTIONS.items()}
+    except RequestError as e:
+        e.id = request_id
+        raise
+
+    return request_id, parser_class, data, options
+
+
+class ConversionServer(socketserver.ThreadingMixIn,
+                       socketserver.UnixStreamServer):
+    """Server of conversions; 1 thread per connection, conversions are made
+    in a pool shared by all the connections
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, processes=cm.DAEMON_PROCESSES):
+        """
+        :param arg1: Filepath of the Unix socket (a stale one is replaced).
+        :param arg2: Number of conversion processes (0: threads only).
+        :type arg1: <str>
+        :type arg2: <int>
+        """
+
+        self.processes = processes
+        self._pool = None
+        # Processes are forked before the first connection: no thread
+        # to copy & no fork in the path of the first requests.
+        # Pools may fork their processes on demand (Python 3.9+): 1 pending
+        # job per process forces the creation of all of them.
+        pool = self.conversion_pool()
+        jobs = [pool.submit(time.sleep, 0.05)
+                for _ in range(self.processes)]
+        for job in jobs:
+            job.result()
+
+        try:
+            if stat.S_ISSOCK(os.stat(socket_path).st_mode):
+                os.unlink(socket_path)
+        except FileNotFoundError:
+            pass
+
+        super().__init__(socket_path, ConversionHandler)
+        # Same access as the socket of the website (gunicorn -m 007)
+        os.chmod(socket_path, 0o660)
+
+    def conversion_pool(self, reset=False):
+        """Return the pool of conversions.
+
+        :param: Replace the current pool (ex: a process was killed).
+        :rtype: <ProcessPoolExecutor> or <ThreadPoolExecutor>
+        """
+
+        if reset or self._pool is None:
+            if self.processes:
+                self._pool = ProcessPoolExecutor(max_workers=self.processes)
+            else:
+                self._pool = ThreadPoolExecutor(
+                    max_workers=cm.CONVERSION_WORKERS)
+        return self._pool
+
+    def submit(self, line):
+        """Start the conversion of the given request.
+
+        :param: Line of the client (see :meth:`parse_request`).
+        :type: <bytes>
+        :return: Function without argument which waits for the response.
+        :rtype: <function>
+        """
+
+        try:
+            request_id, parser_class, data, options = parse_request(line)
+        except RequestError as e:
+            LOGGER.info("Daemon:: refused request: " + str(e))
+            response = {'id': getattr(e, 'id', None), 'error': str(e)}
+            return lambda: response
+
+        kind = parser_class.__name__
+        try:
+            future = self.conversion_pool().submit(
+                convert_export, kind, data, **options)
+        except BrokenProcessPool:
+            LOGGER.error("Daemon:: broken pool of processes")
+            future = self.conversion_pool(reset=True).submit(
+                convert_export, kind, data, **options)
+
+        def get_response():
+            try:
+                rules = future.result()
+            except DatabaseError:
+                return {'id': request_id,
+                        'error': "Sqlite file is not a database"}
+            except UnicodeDecodeError:
+                return {'id': request_id,
+                        'error': "File is not a text/plain file"}
+            except Exception as e:
+                LOGGER.error("Daemon:: conversion failed: " + repr(e))
+                return {'id': request_id,
+                        'error': "Conversion failed: " + type(e).__name__}
+
+            return {
+                'id': request_id,
+                'format': FORMAT_NAMES.get(parser_class,
+                                           parser_class.__name__),
+                'count': rules.count('\n'),
+                'rules': rules,
+            }
+
+        return get_response
+
+    def server_close(self):
+        """Remove the socket & stop the conversion processes"""
+
+        super().server_close()
+        try:
+            os.unlink(self.server_address)
+        except FileNotFoundError:
+            pass
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+
+
+class ConversionHandler(socketserver.StreamRequestHandler):
+    """Connection of a client: requests are read & submitted in this thread,
+    responses are written in order by another one
+    """
+
+    def handle(self):
+
+        # Functions waiting for the responses, in the order of the requests;
+        # the bound makes the client wait when too many requests are running
+        responses = queue.Queue(maxsize=cm.DAEMON_PIPELINE)
+        writer = threading.Thread(target=self.write_responses,
+                                  args=(responses,), daemon=True)
+        writer.start()
+
+        try:
+            while True:
+                line = self.rfile.readline(cm.DAEMON_MAX_REQUEST + 1)
+                if not line:
+                    break
+                if len(line) > cm.DAEMON_MAX_REQUEST:
+                    # The rest of the line can't be skipped: end of connection
+                    responses.put(lambda: {'id': None,
+                                           'error': "Request too large"})
+                    break
+                if line.strip():
+                    responses.put(self.server.submit(line))
+        finally:
+            responses.put(None)
+            writer.join()
+
+    def write_responses(self, responses):
+        """Write the responses of the connection, 1 JSON line each
+
+        :param: Queue of functions returning responses; None ends it.
+        :type: <queue.Queue>
+        """
+
+        connected = True
+        while True:
+            get_response = responses.get()
+            if get_response is None:
+                return
+
+            response = get_response()
+            if not connected:
+                # Responses are still consumed: the reader must not block
+                continue
+            try:
+                self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+            except OSError:
+                connected = False
+
+
+class Client():
+    """Connection to the daemon for Python scripts
+
+    ex:
+        with Client() as client:
+            rules = client.convert(open('noscript.txt', 'rb').read())
+    """
+
+    def __init__(self, socket_path=cm.DAEMON_SOCKET):
+        """
+        :param: Filepath of the Unix socket of the daemon.
+        :type: <str>
+        """
+
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.connect(socket_path)
+        self._file = self._socket.makefile('rwb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._file.close()
+        self._socket.close()
+
+    def convert(self, data, format=None, **options):
+        """Return uMatrix rules of the given export.
+
+        :param arg1: Content of the export.
+        :param arg2: Name of the format (see FORMATS); detected if None.
+        :param arg3: Options (see OPTIONS).
+        :type arg1: <bytes>
+        :type arg2: <str>
+        :return: uMatrix rules.
+        :rtype: <str>
+        :raises ValueError: The export is refused by the daemon.
+        """
+
+        self.send(data, format, **options)
+        response = self.receive()
+        if 'error' in response:
+            raise ValueError(response['error'])
+        return response['rules']
+
+    def send(self, data, format=None, request_id=None, **options):
+        """Send a request without waiting for its response (see
+        :meth:`receive`)
+        """
+
+        request = {
+            'id': request_id,
+            'format': format,
+            'data': base64.b64encode(data).decode('ascii'),
+            'options': options,
+        }
+        self._file.write(json.dumps(request).encode('utf-8') + b'\n')
+        self._file.flush()
+
+    def receive(self):
+        """Return the next response of the daemon
+
+        :rtype: <dict>
+        """
+
+        line = self._file.readline()
+        if not line:
+            raise ConnectionError("Connection closed by the daemon")
+        return json.loads(line.decode('utf-8'))
+
+
+def main():
+    """Serve conversions on a Unix socket until SIGTERM or Ctrl+C"""
+
+    arg_parser = argparse.ArgumentParser(
+        description="Daemon of conversions to uMatrix rules for local "
+                    "scripts (JSON lines on a Unix socket)."
+    )
+    arg_parser.add_argument('-S', '--socket', default=cm.DAEMON_SOCKET,
+                            help="Unix socket (default: %(default)s)")
+    arg_parser.add_argument('-j', '--processes', type=int,
+                            default=cm.DAEMON_PROCESSES,
+                            help="Number of conversion processes, 0 for "
+                                 "threads only (default: %(default)s)")
+    args = arg_parser.parse_args()
+
+    # Stop like Ctrl+C: the socket is removed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    server = ConversionServer(args.socket, args.processes)
+    LOGGER.info("Daemon:: listening on " + args.socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        LOGGER.info("Daemon:: stopped")
+
+
+if __name__ == "__main__":
+
+    main()
@@ -20,18 +20,44 @@
 # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
-"""This module handles the SQLite database with SQLAlchemy."""
+"""This module handles the SQLite database with SQLAlchemy.
+
+Read-only queries don't need the ORM: see :meth:`readonly_connection`.
+"""
 
 import os
-from sqlalchemy import *
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.orm import scoped_session
-from sqlalchemy.ext.declarative import declarative_base
+import sqlite3
+import tempfile
+from contextlib import contextmanager
+from urllib.request import pathname2url
+
+# SQLAlchemy is imported on first use of the ORM: read-only connections
+# only need sqlite3 (its import is much slower)
+_base = None
+
+
+def __getattr__(name):
+    """Lazy attributes of the module: Base"""
+
+    if name == 'Base':
+        return declarative_base()
+    raise AttributeError("module {!r} has no attribute {!r}".format(
+        __name__, name))
+
+
+def declarative_base():
+    """Return the declarative base of SQLAlchemy Object Mapping
+
+    .. warning:: It MUST BE CALLED before the definition of Profile class
+        that inherits from it, and before any loading of SQL Engine.
+    """
+
+    global _base
+    if _base is None:
+        from sqlalchemy.ext import declarative
+        _base = declarative.declarative_base()
+    return _base
 
-# /!\ initialization for SQL Alchemy Object Mapping
-# /!\ This line MUST BE before Profile class that inherits from it
-# /!\ This line MUST BE CALLED before any loading of SQL Engine
-Base = declarative_base()
 
 class SQLA_Wrapper():
     """Context manager for DB wrapper
@@ -62,13 +88,19 @@ class SQLA_Wrapper():
 
         """
 
-        if (exc_type is not None) and (exc_type is not SystemExit):
-#            LOGGER.error("Rollback the database")
-            self._session.rollback()
-            return
+        try:
+            if (exc_type is not None) and (exc_type is not SystemExit):
+#                LOGGER.error("Rollback the database")
+                self._session.rollback()
+                return
 
-        self._session.flush()
-        self._session.commit()
+            self._session.flush()
+            self._session.commit()
+        finally:
+            # Release the connection pool (and its file handles)
+            engine = self._session.get_bind()
+            self._session.close()
+            engine.dispose()
 
 
 def loading_sql(**kwargs):
@@ -89,8 +121,11 @@ def loading_sql(**kwargs):
     if not os.path.isfile(db_file):
         raise FileNotFoundError
 
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker, scoped_session
+
     engine = create_engine('sqlite:///' + db_file, echo=False)
-    Base.metadata.create_all(engine)
+    declarative_base().metadata.create_all(engine)
 
     #returns an object for building the particular session you want
 
@@ -111,3 +146,76 @@ def loading_sql(**kwargs):
     # PAY ATTENTION HERE:
     # http://stackoverflow.com/questions/21078696/why-is-my-scoped-session-raising-an-attributeerror-session-object-has-no-attr
     return scoped_session(sessionmaker(bind=engine, autoflush=True))
+
+
+@contextmanager
+def readonly_connection(db_file, immutable=False):
+    """Open a read-only connection to the given SQLite database.
+
+    No engine, no schema creation and no ORM session are involved;
+    the connection is closed on exit.
+
+    .. note:: immutable flag disables all the locking mechanisms;
+        use it only on files that can't be modified by another process
+        (uploads, temporary copies), since WAL files are ignored.
+
+    :param arg1: Filepath of the database.
+    :param arg2: The file will not change during the connection.
+    :type arg1: <str>
+    :type arg2: <bool>
+    :return: sqlite3 connection.
+    :rtype: <sqlite3.Connection>
+    """
+
+    if not os.path.isfile(db_file):
+        raise FileNotFoundError
+
+    uri = 'file:' + pathname2url(os.path.abspath(db_file)) + '?mode=ro'
+    if immutable:
+        uri += '&immutable=1'
+
+    connection = sqlite3.connect(uri, uri=True)
+    try:
+        yield connection
+    finally:
+        connection.close()
+
+
+@contextmanager
+def memory_connection(data):
+    """Open a read-only connection to a SQLite database given as bytes.
+
+    The database is loaded in memory with sqlite3 deserialize API
+    (Python 3.11+); nothing is written on disk. With older versions of Python,
+    the data is copied to a temporary file removed on exit.
+
+    :param: Content of the database file.
+    :type: <bytes>, <bytearray> or <memoryview>
+    :return: sqlite3 connection.
+    :rtype: <sqlite3.Connection>
+    """
+
+    if not data:
+        raise sqlite3.DatabaseError("file is not a database")
+
+    if not hasattr(sqlite3.Connection, 'deserialize'):
+        with tempfile.NamedTemporaryFile(suffix='.sqlite') as tmp_fd:
+            tmp_fd.write(data)
+            tmp_fd.flush()
+            with readonly_connection(tmp_fd.name, immutable=True) as connection:
+                yield connection
+        return
+
+    # WAL databases can't be opened in memory: switch the header of the file
+    # to the legacy journal mode (bytes 18 & 19: write/read versions)
+    if bytes(data[18:20]) == b'\x02\x02':
+        data = bytearray(data)
+        data[18:20] = b'\x01\x01'
+
+    connection = sqlite3.connect(':memory:')
+    try:
+        connection.deserialize(data)
+        connection.execute('PRAGMA query_only = ON')
+        yield connection
+    finally:
+        connection.close()
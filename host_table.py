@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+# MIT License
+#
+# Copyright (c) 2017 Ysard
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""This module handles a compact storage of the entries of parsers.
+
+Hosts are interned in a table that gives them integer ids; entries of a
+section are stored as arrays of ids:
+
+    - 'I' array for single hosts;
+    - 'Q' array for (origin, destination) pairs (origin id << 32 | dest id).
+
+Arrays are deduplicated & sorted lazily, on first read access after writes.
+NumPy is used for this step if it is available.
+"""
+
+# Standard imports
+from array import array
+from bisect import bisect_left
+
+# Under this number of ids, sorting with NumPy is not worth it
+NUMPY_THRESHOLD = 10000
+
+# NumPy module, None if it is not installed (imported on first use: it is
+# not needed by small exports and its import is slow)
+_numpy = False
+
+
+def numpy():
+    """Return NumPy module or None if it is not available"""
+
+    global _numpy
+    if _numpy is False:
+        try:
+            import numpy as np
+        except ImportError:
+            np = None
+        _numpy = np
+    return _numpy
+
+
+class HostTable():
+    """Interned hosts identified by integers
+
+    A table can be shared by several parsers; a host seen in many sections
+    or many exports is stored only once.
+
+    .. note:: Ids are given in order of insertion; the list of hosts
+        (id => host) is rebuilt from the dict only when it is needed.
+    """
+
+    def __init__(self):
+        self._ids = dict()
+        self._hosts = list()
+
+    def intern(self, host):
+        """Return the id of the given host; add it if it is unknown.
+
+        :param: Host.
+        :type: <str>
+        :return: Id of the host.
+        :rtype: <int>
+        """
+
+        ids = self._ids
+        return ids.setdefault(host, len(ids))
+
+    def get_id(self, host):
+        """Return the id of the given host, None if it is unknown"""
+        return self._ids.get(host)
+
+    def host(self, host_id):
+        """Return the host of the given id"""
+
+        if host_id >= len(self._hosts):
+            self._hosts = list(self._ids)
+        return self._hosts[host_id]
+
+    def hosts(self):
+        """Return the list of hosts indexed by their ids"""
+
+        if len(self._hosts) != len(self._ids):
+            self._hosts = list(self._ids)
+        return self._hosts
+
+    def __len__(self):
+        return len(self._ids)
+
+
+def _unique_sorted(ids):
+    """Return a new array of sorted unique ids"""
+
+    np = numpy() if len(ids) > NUMPY_THRESHOLD else None
+    if np is not None:
+        dtype = np.uint32 if ids.typecode == 'I' else np.uint64
+        unique = np.unique(np.frombuffer(ids, dtype=dtype))
+        result = array(ids.typecode)
+        result.frombytes(unique.tobytes())
+        return result
+
+    return array(ids.typecode, sorted(set(ids)))
+
+
+class Section():
+    """Set-like container of the entries of a section
+
+    Entries are hosts (str) or pairs of hosts (tuple); other entries
+    (ex: tuples of 3 hosts) are rare and kept in a regular set.
+    Iteration gives hosts first, then pairs, then other entries.
+    """
+
+    def __init__(self, host_table):
+        """
+        :param: Table of interned hosts.
+        :type: <HostTable>
+        """
+
+        self._table = host_table
+        self._hosts = array('I')
+        self._pairs = array('Q')
+        self._others = set()
+        self._compacted = True
+
+    def add(self, entry):
+        """Add a host or a tuple of hosts"""
+
+        intern = self._table.intern
+        if entry.__class__ is str:
+            self._hosts.append(intern(entry))
+        elif len(entry) == 2:
+            self._pairs.append(intern(entry[0]) << 32 | intern(entry[1]))
+        else:
+            self._others.add(entry)
+            return
+        self._compacted = False
+
+    def update(self, entries):
+        """Add many hosts or tuples of hosts
+
+        .. note:: Faster than successive calls of :meth:`add`.
+        """
+
+        # Inlined version of HostTable.intern()
+        ids = self._table._ids
+        get_id = ids.get
+        hosts_append = self._hosts.append
+        pairs_append = self._pairs.append
+        for entry in entries:
+            if entry.__class__ is str:
+                host_id = get_id(entry)
+                if host_id is None:
+                    host_id = ids[entry] = len(ids)
+                hosts_append(host_id)
+            elif len(entry) == 2:
+                ori, dest = entry
+                ori_id = get_id(ori)
+                if ori_id is None:
+                    ori_id = ids[ori] = len(ids)
+                dest_id = get_id(dest)
+                if dest_id is None:
+                    dest_id = ids[dest] = len(ids)
+                pairs_append(ori_id << 32 | dest_id)
+            else:
+                self._others.add(entry)
+        self._compacted = False
+
+    def update_hosts(self, hosts):
+        """Add many hosts at once
+
+        .. note:: Faster than :meth:`update` for lists of single hosts:
+            hosts are interned by bulk dict operations.
+
+        :param: Hosts.
+        :type: <list <str>>
+        """
+
+        ids = self._table._ids
+        new_hosts = [host for host in dict.fromkeys(hosts) if host not in ids]
+        ids.update(zip(new_hosts, range(len(ids), len(ids) + len(new_hosts))))
+        self._hosts.extend(map(ids.__getitem__, hosts))
+        self._compacted = False
+
+    def _compact(self):
+        """Deduplicate & sort the ids added since the last compaction"""
+
+        if self._compacted:
+            return
+        self._hosts = _unique_sorted(self._hosts)
+        self._pairs = _unique_sorted(self._pairs)
+        self._compacted = True
+
+    def host_ids(self):
+        """Return the sorted array of ids of single hosts"""
+
+        self._compact()
+        return self._hosts
+
+    def pair_ids(self):
+        """Return the sorted array of encoded pairs of ids"""
+
+        self._compact()
+        return self._pairs
+
+    def __iter__(self):
+
+        self._compact()
+        hosts = self._table.hosts()
+
+        for host_id in self._hosts:
+            yield hosts[host_id]
+
+        for pair_id in self._pairs:
+            yield hosts[pair_id >> 32], hosts[pair_id & 0xFFFFFFFF]
+
+        yield from self._others
+
+    def __len__(self):
+
+        self._compact()
+        return len(self._hosts) + len(self._pairs) + len(self._others)
+
+    def __bool__(self):
+        return bool(self._hosts or self._pairs or self._others)
+
+    def __contains__(self, entry):
+
+        get_id = self._table.get_id
+        if isinstance(entry, str):
+            ids, key = self.host_ids(), get_id(entry)
+        elif isinstance(entry, tuple) and len(entry) == 2:
+            ori_id, dest_id = get_id(entry[0]), get_id(entry[1])
+            if ori_id is None or dest_id is None:
+                return False
+            ids, key = self.pair_ids(), ori_id << 32 | dest_id
+        else:
+            return entry in self._others
+
+        if key is None:
+            return False
+        index = bisect_left(ids, key)
+        return index < len(ids) and ids[index] == key
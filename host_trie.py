@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+# MIT License
+#
+# Copyright (c) 2017 Ysard
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""This module handles an index of hosts by domain hierarchy.
+
+Hosts are stored in a trie of reversed labels (suffix index):
+
+    'cdn.example.com' => 'com' -> 'example' -> 'cdn'
+
+Like in uMatrix, a rule on 'example.com' applies to 'cdn.example.com', and
+a rule on '*' applies to all hosts; IP addresses have no parent but '*'
+(see :meth:`ruleset.broader_hostname`).
+
+All the operations only walk the labels of the given host or the nodes
+below it: building & querying the index stay linear with the number of hosts.
+"""
+
+# Standard imports
+import re
+
+# Key of the host stored in a node (labels are always strings)
+HOST = None
+# IPv4 & IPv6 hosts have no broader hostname than '*'
+IP_PATTERN = re.compile(r'^\d+\.\d+\.\d+\.\d+$|^\[[0-9a-fA-F:]+\]$')
+
+
+def host_labels(hostname):
+    """Return the labels of the given host from the broadest to the narrowest
+
+    ex: 'a.b.com' => ['com', 'b', 'a'], '*' => [], '1.2.3.4' => ['1.2.3.4']
+    """
+
+    if hostname == '*':
+        return []
+    # Cheap test before the regex
+    if (hostname[-1:].isdigit() or hostname[:1] == '[') \
+            and IP_PATTERN.match(hostname):
+        return [hostname]
+    return hostname.split('.')[::-1]
+
+
+class HostTrie():
+    """Set of hosts indexed by domain hierarchy
+
+    Each node is a dict of children nodes by label; the host ending at a node
+    is stored under the :attr:`HOST` key.
+    """
+
+    def __init__(self, hosts=()):
+        """
+        :param: Iterable of hosts.
+        """
+
+        self._root = dict()
+        self._size = 0
+        self.update(hosts)
+
+    def add(self, hostname):
+        """Add the given host"""
+
+        node = self._root
+        for label in host_labels(hostname):
+            child = node.get(label)
+            if child is None:
+                child = node[label] = dict()
+            node = child
+
+        if HOST not in node:
+            node[HOST] = hostname
+            self._size += 1
+
+    def update(self, hosts):
+        """Add the given hosts"""
+
+        for hostname in hosts:
+            self.add(hostname)
+
+    def _find(self, hostname):
+        """Return the node of the given host, None if it is not in the trie"""
+
+        node = self._root
+        for label in host_labels(hostname):
+            node = node.get(label)
+            if node is None:
+                return None
+        return node
+
+    def __contains__(self, hostname):
+        node = self._find(hostname)
+        return node is not None and HOST in node
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        """Yield hosts, broader hosts before the hosts below them"""
+        return _iter_hosts(self._root)
+
+    def covering(self, hostname):
+        """Return the narrowest host of the trie which covers the given one
+
+        .. note:: The given host itself is not taken into account.
+
+        ex: with 'example.com' & '*': 'cdn.example.com' => 'example.com'
+
+        :param: Host.
+        :type: <str>
+        :return: Ancestor host or None.
+        :rtype: <str>
+        """
+
+        labels = host_labels(hostname)
+        if not labels:
+            # Nothing is broader than '*'
+            return None
+
+        node = self._root
+        found = node.get(HOST)
+        for label in labels[:-1]:
+            node = node.get(label)
+            if node is None:
+                break
+            found = node.get(HOST, found)
+        return found
+
+    def iter_covering(self, hostname):
+        """Yield the hosts of the trie which cover the given one, from the
+        broadest to the narrowest, the given host included
+
+        ex: with '*', 'example.com' & 'cdn.example.com':
+            'cdn.example.com' => '*', 'example.com', 'cdn.example.com'
+
+        :param: Host.
+        :type: <str>
+        :return: Generator of hosts.
+        :rtype: <generator <str>>
+        """
+
+        node = self._root
+        if HOST in node:
+            yield node[HOST]
+        for label in host_labels(hostname):
+            node = node.get(label)
+            if node is None:
+                return
+            if HOST in node:
+                yield node[HOST]
+
+    def iter_under(self, hostname, include_self=True):
+        """Yield the hosts of the trie covered by the given one
+
+        ex: 'example.com' => 'example.com', 'cdn.example.com', ...
+
+        :param arg1: Host.
+        :param arg2: Also yield the given host if it is in the trie.
+        :return: Generator of hosts.
+        :rtype: <generator <str>>
+        """
+
+        node = self._find(hostname)
+        if node is None:
+            return
+        hosts = _iter_hosts(node)
+        if not include_self and HOST in node:
+            next(hosts)
+        yield from hosts
+
+    def roots(self):
+        """Yield the hosts which are not covered by a broader host of the trie
+
+        A rule made for each of these hosts applies to all the hosts of the
+        trie; nodes below a stored host are not walked.
+
+        :return: Generator of hosts.
+        :rtype: <generator <str>>
+        """
+
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            hostname = node.get(HOST)
+            if hostname is not None:
+                yield hostname
+                continue
+            stack.extend(node.values())
+
+    def collapse(self, min_children, min_labels=2):
+        """Return hosts where sibling subdomains are replaced by their parent
+
+        A domain with at least min_children hosts directly below it (after
+        the collapse of its own subdomains) replaces them.
+        Unlike :meth:`roots`, this widens the scope of the hosts: a rule on
+        the parent applies to all its subdomains, even unknown ones.
+
+        ex: with min_children=2:
+            'a.example.com', 'b.example.com', 'c.org' => 'example.com', 'c.org'
+
+        :param arg1: Minimum number of sibling hosts to be collapsed.
+        :param arg2: Minimum number of labels of a parent; prevents collapses
+            into top-level domains.
+        :type arg1: <int>
+        :type arg2: <int>
+        :return: List of hosts.
+        :rtype: <list <str>>
+        """
+
+        hosts = list()
+        for label, child in self._root.items():
+            if label is HOST:
+                # '*' covers everything
+                return [child]
+            hosts.extend(_collapse(child, label, 1, min_children, min_labels))
+        return hosts
+
+
+def _iter_hosts(node):
+    """Yield hosts stored in the given node & below it (depth-first)"""
+
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        hostname = node.get(HOST)
+        if hostname is not None:
+            yield hostname
+        stack.extend(child for label, child in node.items() if label is not HOST)
+
+
+def _collapse(node, domain, depth, min_children, min_labels):
+    """Return the collapsed hosts of the given node (see :meth:`collapse`)
+
+    :param arg1: Node of the trie.
+    :param arg2: Domain of the node.
+    :param arg3: Number of labels of the domain.
+    """
+
+    hostname = node.get(HOST)
+    if hostname is not None:
+        # Hosts below are already covered
+        return [hostname]
+
+    # Children are collapsed first (bottom-up)
+    children_hosts = list()
+    direct_children = 0
+    for label, child in node.items():
+        child_hosts = _collapse(child, label + '.' + domain, depth + 1,
+                                min_children, min_labels)
+        children_hosts.extend(child_hosts)
+        if len(child_hosts) == 1 and child_hosts[0] == label + '.' + domain:
+            direct_children += 1
+
+    if depth >= min_labels and direct_children >= min_children:
+        return [domain]
+    return children_hosts
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+# MIT License
+#
+# Copyright (c) 2017 Ysard
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""This module handles incremental conversions of exports.
+
+A snapshot keeps the entries of the previous conversion of an export;
+the entries of a new export are compared to it, and only the rules of the
+added & removed entries are made. They form a patch:
+
+    - example.com * cookie allow
+    + example.org * cookie allow
+
+that can be applied on the previous uMatrix ruleset (see :meth:`apply_patch`).
+
+.. note:: Each entry of an export gives its own rules (see the entry rules
+    makers in uMatrix_converter), so the rules of removed entries are not
+    made by other entries of the same export.
+"""
+
+# Standard imports
+import os
+import zlib
+import tempfile
+
+# Custom imports
+from uMatrix_converter import PARSER_CLASSES
+
+
+def encode_entry(section, entry):
+    """Return the given entry as a line 'section\thost[\thost]'"""
+
+    if isinstance(entry, str):
+        return section + '\t' + entry
+    return section + '\t' + '\t'.join(entry)
+
+
+def decode_entry(line):
+    """Return the tuple (section, entry) of the given encoded entry"""
+
+    section, *hosts = line.split('\t')
+    return section, hosts[0] if len(hosts) == 1 else tuple(hosts)
+
+
+class Snapshot():
+    """Set of the entries of a converted export
+
+    Entries are kept as encoded strings (see :meth:`encode_entry`); on disk,
+    they are sorted & compressed.
+    """
+
+    def __init__(self, kind, advanced=False, entries=()):
+        """
+        :param arg1: Kind of export (name of the class of the parser).
+        :param arg2: Advanced rules flag used for the conversion.
+        :param arg3: Iterable of encoded entries.
+        :type arg1: <str>
+        :type arg2: <bool>
+        """
+
+        self.kind = kind
+        self.advanced = advanced
+        self._entries = set(entries)
+
+    @classmethod
+    def from_parser(cls, parser, advanced=False):
+        """Return the snapshot of the content of the given parser"""
+
+        return cls(
+            type(parser).__name__, advanced,
+            (
+                encode_entry(section, entry)
+                for section, content in parser.content.items()
+                for entry in content
+            )
+        )
+
+    @classmethod
+    def from_export(cls, parser, filepath, advanced=False):
+        """Return the snapshot of an export read by the given parser.
+
+        .. note:: The content of the parser is not filled.
+
+        :param arg1: RequestPolicy, NoScript or Firefox permissions parser.
+        :param arg2: Filepath or file object of the export.
+        :param arg3: Advanced rules flag used for the conversion.
+        :rtype: <Snapshot>
+        """
+
+        return cls(
+            type(parser).__name__, advanced,
+            (
+                encode_entry(section, entry)
+                for section, entry in parser.iter_entries(filepath)
+            )
+        )
+
+    @classmethod
+    def load(cls, filepath):
+        """Load a snapshot saved with :meth:`save`.
+
+        :param: Filepath of the snapshot.
+        :return: Snapshot.
+        :rtype: <Snapshot>
+        :raise FileNotFoundError: If there is no snapshot.
+        :raise ValueError: If the file is not a valid snapshot.
+        """
+
+        with open(filepath, 'rb') as fd:
+            data = fd.read()
+
+        try:
+            header, *entries = zlib.decompress(data).decode('utf-8').split('\n')
+            kind, advanced = header.split('\t')
+        except (zlib.error, UnicodeDecodeError, ValueError):
+            raise ValueError("Invalid snapshot: " + str(filepath))
+
+        return cls(kind, advanced == '1', filter(None, entries))
+
+    def save(self, filepath):
+        """Save the snapshot in the given file.
+
+        .. note:: Atomic write: a previous snapshot is replaced only when the
+            new one is complete.
+
+        :param: Filepath of the snapshot.
+        """
+
+        header = self.kind + '\t' + ('1' if self.advanced else '0')
+        data = zlib.compress(
+            '\n'.join([header, *sorted(self._entries)]).encode('utf-8')
+        )
+
+        fd, tmp_filepath = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(filepath)), suffix='.tmp'
+        )
+        try:
+            with os.fdopen(fd, 'wb') as tmp_fd:
+                tmp_fd.write(data)
+            os.replace(tmp_filepath, filepath)
+        except:
+            if os.path.exists(tmp_filepath):
+                os.unlink(tmp_filepath)
+            raise
+
+    def __contains__(self, entry):
+        return entry in self._entries
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def diff(self, previous):
+        """Return the entries added & removed since the previous snapshot.
+
+        :param: Previous snapshot.
+        :type: <Snapshot>
+        :return: Sorted lists of encoded entries (added, removed).
+        :rtype: <tuple <list>, <list>>
+        """
+
+        return (
+            sorted(self._entries - previous._entries),
+            sorted(previous._entries - self._entries),
+        )
+
+
+def delta_rules(snapshot, previous):
+    """Return the rules to add & to remove since the previous snapshot.
+
+    .. note:: If the advanced flag has changed, all the rules are remade.
+
+    :param arg1: Snapshot of the new export.
+    :param arg2: Snapshot of the previous export of the same kind.
+    :type arg1: <Snapshot>
+    :type arg2: <Snapshot>
+    :return: Lists of uMatrix rules (added, removed).
+    :rtype: <tuple <list <str>>, <list <str>>>
+    :raise ValueError: If snapshots are not of the same kind.
+    """
+
+    if snapshot.kind != previous.kind:
+        raise ValueError("Snapshots of different exports: " +
+                         snapshot.kind + ", " + previous.kind)
+
+    if snapshot.advanced == previous.advanced:
+        added, removed = snapshot.diff(previous)
+    else:
+        added, removed = sorted(snapshot), sorted(previous)
+
+    def make_rules(entries, advanced):
+        # Kind of snapshot: name of the parser
+        entry_rules = PARSER_CLASSES[snapshot.kind].entry_rules
+        return [
+            rule
+            for section, entry in map(decode_entry, entries)
+            for rule in entry_rules(section, entry, advanced=advanced)
+        ]
+
+    added_rules = make_rules(added, snapshot.advanced)
+    # Rules made again by added entries are kept
+    kept_rules = set(added_rules)
+    removed_rules = [
+        rule for rule in make_rules(removed, previous.advanced)
+        if rule not in kept_rules
+    ]
+    return added_rules, removed_rules
+
+
+def iter_patch(added_rules, removed_rules):
+    """Yield the lines of a patch: removed rules first, then added rules
+
+    :param arg1: Iterable of rules to add (lines ending with '\n').
+    :param arg2: Iterable of rules to remove (lines ending with '\n').
+    :return: Generator of lines '- rule' & '+ rule' (ending with '\n').
+    :rtype: <generator <str>>
+    """
+
+    for rule in removed_rules:
+        yield '- ' + rule
+    for rule in added_rules:
+        yield '+ ' + rule
+
+
+def apply_patch(lines, patch):
+    """Yield the lines of a ruleset modified by the given patch.
+
+    Removed rules are dropped, added rules are appended at the end
+    (if they are not already in the ruleset).
+
+    :param arg1: Iterable of lines of a uMatrix ruleset.
+    :param arg2: Iterable of lines of a patch (see :meth:`iter_patch`).
+    :return: Generator of lines (ending with '\n').
+    :rtype: <generator <str>>
+    """
+
+    removed, added = set(), dict()
+    for line in patch:
+        line = line.rstrip('\n')
+        if line.startswith('- '):
+            removed.add(line[2:])
+            added.pop(line[2:], None)
+        elif line.startswith('+ '):
+            added[line[2:]] = None
+            removed.discard(line[2:])
+
+    for line in lines:
+        line = line.rstrip('\n')
+        if not line or line in removed:
+            continue
+        added.pop(line, None)
+        yield line + '\n'
+
+    for line in added:
+        yield line + '\n'
@@ -0,0 +1,368 @@
+# -*- coding: utf-8 -*-
+# MIT License
+#
+# Copyright (c) 2017 Ysard
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""This module handles metrics of the website in the Prometheus text format.
+
+Each process (gunicorn workers & their conversion processes) records its
+own counters & histograms, and writes them regularly in its file of a
+directory shared by all the processes; the metrics of the website are the
+sums of all these files (see :meth:`Registry.collect`).
+
+    with metrics.timer('parse', parser='NoScriptParser'):
+        parser.read_file(filepath)
+
+.. note:: Files of dead processes are kept: counters don't decrease when a
+    worker is restarted; their gauges are ignored since they describe a state
+    that no longer exists. The directory must be emptied when the whole
+    service is (re)started.
+"""
+
+# Standard imports
+import os
+import json
+import time
+import tempfile
+import threading
+from math import inf
+from functools import wraps
+from contextlib import contextmanager
+
+# Durations of stages (seconds)
+TIME_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                1, 2.5, 5, 10, inf)
+# Sizes of inputs (bytes)
+SIZE_BUCKETS = (1024, 10 * 1024, 100 * 1024, 1024 * 1024,
+                10 * 1024 * 1024, 100 * 1024 * 1024, inf)
+# Min time between 2 writes of the file of a process (seconds); skipped
+# updates are written at the end of the interval
+WRITE_INTERVAL = 1
+
+# Name: (type, help)
+DESCRIPTIONS = {
+    'umatrix_stage_seconds':
+        ('histogram', "Duration of the stages of conversions"),
+    'umatrix_input_bytes':
+        ('histogram', "Size of the converted exports"),
+    'umatrix_rules_total':
+        ('counter', "Number of emitted uMatrix rules"),
+    'umatrix_conversions_total':
+        ('counter', "Number of conversions"),
+    'umatrix_errors_total':
+        ('counter', "Number of failed conversions"),
+    'umatrix_rejected_uploads_total':
+        ('counter', "Number of requests aborted while files were received"),
+    'umatrix_refused_requests_total':
+        ('counter', "Number of requests refused by the admission control"),
+    'umatrix_result_cache_hits_total':
+        ('counter', "Number of conversions found in the result cache"),
+    'umatrix_result_cache_misses_total':
+        ('counter', "Number of conversions not found in the result cache"),
+    'umatrix_result_cache_entries':
+        ('gauge', "Number of results in the memory of the workers"),
+    'umatrix_result_cache_size':
+        ('gauge', "Number of characters of results in the memory of the "
+                  "workers"),
+}
+
+
+def process_alive(pid):
+    """Return True if a process with the given pid exists"""
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Process of another user
+        return True
+    return True
+
+
+class Registry():
+    """Counters & histograms of the current process
+
+    Series are identified by a name & sorted labels; a histogram is a list
+    of counts per bucket (not cumulative), followed by the sum & the count.
+    """
+
+    def __init__(self, directory=None):
+        """
+        :param: Directory shared by the processes (None: metrics are kept in
+            memory only).
+        :type: <str>
+        """
+
+        self._directory = directory
+        self._reset()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # A forked process (conversion process) starts with empty metrics:
+        # metrics of its parent are already in the file of the parent
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+
+        self._counters = dict()
+        self._histograms = dict()
+        self._buckets = dict()
+        self._lock = threading.Lock()
+        self._last_write = 0.
+        # Write of skipped updates (even if the process becomes idle)
+        self._timer = None
+
+    def inc(self, name, value=1, **labels):
+        """Increment a counter"""
+
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+        self._write()
+
+    def set(self, name, value, **labels):
+        """Set the value of a gauge, or of a counter kept by another object
+
+        Like counters, values of all the processes are summed.
+        """
+
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = value
+        self._write()
+
+    def observe(self, name, value, buckets=TIME_BUCKETS, **labels):
+        """Add a value to a histogram"""
+
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(buckets) + 2)
+                self._buckets[name] = buckets
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[index] += 1
+                    break
+            histogram[-2] += value
+            histogram[-1] += 1
+        self._write()
+
+    @contextmanager
+    def timer(self, stage, **labels):
+        """Observe the duration of the block in 'umatrix_stage_seconds'"""
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('umatrix_stage_seconds',
+                         time.perf_counter() - start, stage=stage, **labels)
+
+    def timed(self, stage, **labels):
+        """Decorator version of :meth:`timer`"""
+
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(stage, **labels):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def snapshot(self):
+        """Return the metrics of the process as a JSON serializable dict"""
+
+        with self._lock:
+            return {
+                'counters': [
+                    [name, labels, value]
+                    for (name, labels), value in self._counters.items()
+                ],
+                'histograms': [
+                    [name, labels, self._buckets[name], list(histogram)]
+                    for (name, labels), histogram in self._histograms.items()
+                ],
+            }
+
+    def flush(self):
+        """Write the file of the process now"""
+        self._write(force=True)
+
+    def _write(self, force=False):
+        """Write the file of the process (at most every WRITE_INTERVAL)
+
+        .. note:: Atomic write: readers never see a partial file.
+        """
+
+        if not self._directory:
+            return
+        now = time.monotonic()
+        delay = self._last_write + WRITE_INTERVAL - now
+        if not force and delay > 0:
+            self._schedule_write(delay)
+            return
+        self._last_write = now
+
+        data = json.dumps(self.snapshot())
+        fd, tmp_filepath = tempfile.mkstemp(dir=self._directory,
+                                            suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as tmp_fd:
+                tmp_fd.write(data)
+            os.replace(tmp_filepath, os.path.join(
+                self._directory, str(os.getpid()) + '.json'))
+        except OSError:
+            if os.path.exists(tmp_filepath):
+                os.unlink(tmp_filepath)
+
+    def _schedule_write(self, delay):
+        """Write the file at the end of the interval, if not already planned
+
+        .. note:: With gevent, the timer is a greenlet.
+        """
+
+        with self._lock:
+            if self._timer is not None:
+                return
+            self._timer = threading.Timer(delay, self._deferred_write)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _deferred_write(self):
+
+        with self._lock:
+            self._timer = None
+        self._write(force=True)
+
+    def collect(self):
+        """Return the sum of the metrics of all the processes.
+
+        .. note:: Without directory, only the metrics of the current process
+            are given.
+        .. note:: Gauges of dead processes are skipped; their counters &
+            histograms are still summed.
+
+        :return: Snapshot of the metrics (see :meth:`Registry.snapshot`).
+        :rtype: <dict>
+        """
+
+        if not self._directory:
+            return self.snapshot()
+
+        self.flush()
+        counters, histograms = dict(), dict()
+        gauges = {name for name, (kind, _) in DESCRIPTIONS.items()
+                  if kind == 'gauge'}
+
+        for filename in os.listdir(self._directory):
+            if not filename.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self._directory, filename)) as fd:
+                    snapshot = json.load(fd)
+            except (OSError, ValueError):
+                continue
+
+            pid = filename[:-len('.json')]
+            alive = not pid.isdigit() or process_alive(int(pid))
+
+            for name, labels, value in snapshot['counters']:
+                if not alive and name in gauges:
+                    continue
+                key = (name, tuple(map(tuple, labels)))
+                counters[key] = counters.get(key, 0) + value
+
+            for name, labels, buckets, histogram in snapshot['histograms']:
+                key = (name, tuple(map(tuple, labels)), tuple(buckets))
+                total = histograms.get(key)
+                if total is None:
+                    histograms[key] = list(histogram)
+                else:
+                    histograms[key] = [a + b for a, b in zip(total, histogram)]
+
+        return {
+            'counters': [
+                [name, labels, value]
+                for (name, labels), value in counters.items()
+            ],
+            'histograms': [
+                [name, labels, list(buckets), histogram]
+                for (name, labels, buckets), histogram in histograms.items()
+            ],
+        }
+
+
+def _format_labels(labels, **extra):
+    """Return labels as '{a="1",b="2"}' ('' without label)"""
+
+    labels = list(labels) + list(extra.items())
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(key, str(value).replace('\\', '\\\\')
+                         .replace('"', '\\"'))
+        for key, value in labels
+    ) + '}'
+
+
+def _format_number(value):
+    if value == inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def exposition(snapshot):
+    """Return metrics in the Prometheus text format.
+
+    :param: Snapshot of metrics (see :meth:`Registry.collect`).
+    :type: <dict>
+    :return: Text of the /metrics page.
+    :rtype: <str>
+    """
+
+    series = dict()
+    for name, labels, value in sorted(snapshot['counters']):
+        series.setdefault(name, list()).append(
+            name + _format_labels(labels) + ' ' + _format_number(value)
+        )
+
+    for name, labels, buckets, histogram in sorted(snapshot['histograms']):
+        lines = series.setdefault(name, list())
+        cumulative = 0
+        for bound, count in zip(buckets, histogram):
+            cumulative += count
+            lines.append(
+                name + '_bucket' +
+                _format_labels(labels, le=_format_number(bound)) +
+                ' ' + str(cumulative)
+            )
+        lines.append(name + '_sum' + _format_labels(labels) + ' ' +
+                     _format_number(histogram[-2]))
+        lines.append(name + '_count' + _format_labels(labels) + ' ' +
+                     str(histogram[-1]))
+
+    text = list()
+    for name in sorted(series):
+        type_, help_ = DESCRIPTIONS.get(name, ('untyped', name))
+        text.append('# HELP {} {}\n'.format(name, help_))
+        text.append('# TYPE {} {}\n'.format(name, type_))
+        text.extend(line + '\n' for line in series[name])
+    return ''.join(text)
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+# MIT License
+#
+# Copyright (c) 2017 Ysard
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""This module handles a cache of uMatrix rules generated from uploaded files.
+
+Results are addressed by a hash of (kind of export, file content, advanced
+flag).
+The cache has 2 tiers:
+
+    - an LRU cache in memory, local to the process;
+    - an optional directory shared by all the processes (gunicorn workers).
+
+Both are bounded in size (number of characters of the stored rules for the
+memory, number of bytes for the directory).
+"""
+
+# Standard imports
+import os
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+# Number of writes in the shared directory between 2 evictions
+EVICTION_INTERVAL = 100
+
+
+def make_key(kind, data, advanced):
+    """Return the key of the given upload.
+
+    :param arg1: Kind of export (name of its parser).
+    :param arg2: Content of the uploaded file.
+    :param arg3: Advanced rules flag.
+    :type arg1: <str>
+    :type arg2: <bytes>
+    :type arg3: <bool>
+    :return: Hexadecimal SHA-256 digest.
+    :rtype: <str>
+    """
+
+    sha = hashlib.sha256()
+    sha.update(kind.encode() + b'\0' + (b'1' if advanced else b'0') + b'\0')
+    sha.update(data)
+    return sha.hexdigest()
+
+
+class ResultCache():
+    """Cache of uMatrix rules addressed by the content of the uploads"""
+
+    def __init__(self, max_size, directory=None, max_disk_size=0):
+        """Initialize the tiers of the cache.
+
+        :param arg1: Maximum size of the memory tier (number of characters);
+            0 disables this tier.
+        :param arg2: Directory of the shared tier; None disables this tier.
+        :param arg3: Maximum size of the shared tier (number of bytes).
+        :type arg1: <int>
+        :type arg2: <str>
+        :type arg3: <int>
+        """
+
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        self._max_size = max_size
+        self._directory = directory
+        self._max_disk_size = max_disk_size
+        self._disk_writes = 0
+        # Flask app may be served by several threads
+        self._lock = threading.Lock()
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def get(self, key):
+        """Return the rules stored for the given key, None if not found.
+
+        .. note:: A hit in the shared tier promotes the rules in memory.
+
+        :param: Key (see :meth:`make_key`).
+        :type: <str>
+        :return: uMatrix rules or None.
+        :rtype: <str>
+        """
+
+        with self._lock:
+            rules = self._memory.get(key)
+            if rules is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return rules
+
+        rules = self._disk_get(key)
+
+        with self._lock:
+            if rules is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+
+        self._memory_set(key, rules)
+        return rules
+
+    def set(self, key, rules):
+        """Store the rules of the given key in all the tiers.
+
+        :param arg1: Key (see :meth:`make_key`).
+        :param arg2: uMatrix rules.
+        :type arg1: <str>
+        :type arg2: <str>
+        """
+
+        self._memory_set(key, rules)
+        self._disk_set(key, rules)
+
+    def stats(self):
+        """Return counters of the cache.
+
+        :return: Hits by tier, misses, number of entries & size in memory.
+        :rtype: <dict>
+        """
+
+        with self._lock:
+            return {
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'memory_entries': len(self._memory),
+                'memory_size': self._memory_size,
+            }
+
+    def _memory_set(self, key, rules):
+        """Store rules in memory & evict least recently used entries"""
+
+        if len(rules) > self._max_size:
+            return
+
+        with self._lock:
+            previous = self._memory.pop(key, None)
+            if previous is not None:
+                self._memory_size -= len(previous)
+
+            self._memory[key] = rules
+            self._memory_size += len(rules)
+
+            while self._memory_size > self._max_size:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_size -= len(evicted)
+
+    def _disk_path(self, key):
+        return os.path.join(self._directory, key + '.txt')
+
+    def _disk_get(self, key):
+        """Read rules from the shared directory"""
+
+        if not self._directory:
+            return None
+
+        filepath = self._disk_path(key)
+        try:
+            with open(filepath, 'r', encoding='utf-8') as fd:
+                rules = fd.read()
+            # Recently used entries are evicted last
+            os.utime(filepath)
+        except OSError:
+            return None
+        return rules
+
+    def _disk_set(self, key, rules):
+        """Write rules in the shared directory
+
+        .. note:: Atomic write: other processes never see a partial file.
+        """
+
+        if not self._directory or len(rules) > self._max_disk_size:
+            return
+
+        fd, tmp_filepath = tempfile.mkstemp(dir=self._directory,
+                                            suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as tmp_fd:
+                tmp_fd.write(rules)
+            os.replace(tmp_filepath, self._disk_path(key))
+        except OSError:
+            if os.path.exists(tmp_filepath):
+                os.unlink(tmp_filepath)
+            return
+
+        with self._lock:
+            self._disk_writes += 1
+            evict = self._disk_writes % EVICTION_INTERVAL == 1
+
+        if evict:
+            self._disk_evict()
+
+    def _disk_evict(self):
+        """Remove the least recently used files of the shared directory until
+        its size is under the limit."""
+
+        entries = list()
+        total_size = 0
+        for entry in os.scandir(self._directory):
+            if not entry.name.endswith('.txt'):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                # Removed by another process
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total_size += stat.st_size
+
+        entries.sort()
+        for _, size, filepath in entries:
+            if total_size <= self._max_disk_size:
+                break
+            try:
+                os.unlink(filepath)
+            except OSError:
+                pass
+            total_size -= size
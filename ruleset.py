@@ -0,0 +1,554 @@
+# -*- coding: utf-8 -*-
+# MIT License
+#
+# Copyright (c) 2017 Ysard
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""This module handles uMatrix rules made by converters.
+
+A rule is a line 'source destination type action'; rules are indexed by
+(source, destination, type) cells, like in uMatrix.
+
+The optimizer removes rules which don't change the behaviour of uMatrix:
+
+    - exact duplicates (ex: same cookie rule made from 2 exports);
+    - rules covered by a broader rule with the same action, if no rule with
+      the opposite action overlaps their scope.
+      ex: 'a.com cdn.com * allow' is covered by '* cdn.com * allow'.
+
+.. note:: The second point is deliberately conservative: in uMatrix, the most
+    specific rule wins but block rules at broader destinations may override
+    narrower allow rules; removing a rule is only safe if all the rules that
+    could be consulted in its scope share its action.
+
+Rules of several exports may conflict: 2 rules with opposite actions which
+apply to the same requests, while none of them is an exception of the other
+(its scope is not included in the scope of the other rule).
+ex: 'example.com * cookie block' (Cookie Monster) & '* example.com * allow'
+(RequestPolicy) both apply to cookies of example.com on its own pages.
+Conflicts can be resolved with one of the CONFLICT_POLICIES
+(see :meth:`RuleSet.resolve_conflicts`).
+
+.. note:: Only requests of a site to itself (same source & destination) are
+    taken into account: the scopes of 'example.com * cookie block' &
+    '* cdn.net * allow' overlap on cookies of cdn.net on example.com, but
+    every cookie rule would conflict with every destination rule.
+    Rules with unrelated source & destination ('a.com b.com * allow') only
+    conflict with the rule of the opposite action on the same cell.
+"""
+
+# Standard imports
+from itertools import chain, product
+from collections import defaultdict
+
+# Custom imports
+from host_trie import HostTrie, IP_PATTERN
+
+ACTIONS = ('allow', 'block')
+# Resolutions of conflicts:
+#   - keep: all the rules are kept;
+#   - allow, block: rules with the opposite action are removed;
+#   - first, last: of 2 conflicting rules, the rule added first (or last) is
+#     kept, ex: exports given in order of priority.
+CONFLICT_POLICIES = ('keep', 'allow', 'block', 'first', 'last')
+
+
+def broader_hostname(hostname):
+    """Return the broader hostname of the given one, '' after '*'
+
+    ex: 'a.b.com' => 'b.com' => 'com' => '*' => ''
+    """
+
+    if hostname == '*':
+        return ''
+    # Cheap test before the regex
+    if (hostname[-1:].isdigit() or hostname[:1] == '[') \
+            and IP_PATTERN.match(hostname):
+        return '*'
+    pos = hostname.find('.')
+    if pos != -1:
+        return hostname[pos + 1:]
+    return '*' if hostname else ''
+
+
+def ancestors(hostname):
+    """Yield the broader hostnames of the given one, up to '*' included"""
+
+    hostname = broader_hostname(hostname)
+    while hostname:
+        yield hostname
+        hostname = broader_hostname(hostname)
+
+
+class HostnameChains(dict):
+    """Cache of hostnames & their ancestors
+
+    ex: chains['a.b.com'] => ('a.b.com', 'b.com', 'com', '*')
+    """
+
+    def __missing__(self, hostname):
+        chain = self[hostname] = (hostname, *ancestors(hostname))
+        return chain
+
+
+def covers(broad, hostname):
+    """Return True if a rule on broad applies to hostname"""
+
+    if broad == '*' or broad == hostname:
+        return True
+    if IP_PATTERN.match(hostname):
+        return False
+    return hostname.endswith('.' + broad)
+
+
+def contains(broad_rule, rule):
+    """Return True if the scope of broad_rule includes the scope of rule"""
+
+    return covers(broad_rule[0], rule[0]) \
+        and covers(broad_rule[1], rule[1]) \
+        and broad_rule[2] in ('*', rule[2])
+
+
+def parse_rule(line):
+    """Return the tuple (source, destination, type, action) of the given line
+
+    :param: Line of uMatrix rules.
+    :type: <str>
+    :return: Rule or None if the line is not a rule handled here
+        (switches, comments, '1st-party' destination, etc.).
+    :rtype: <tuple <str>>
+    """
+
+    fields = line.split()
+    if len(fields) != 4 or fields[3] not in ACTIONS \
+            or fields[1] == '1st-party':
+        return None
+    return tuple(fields)
+
+
+class RuleSet():
+    """Ordered set of uMatrix rules indexed by (source, destination, type)
+
+    Lines which are not rules are kept as is, in order.
+    """
+
+    def __init__(self, lines=()):
+        """
+        :param: Optional iterable of lines of rules.
+        """
+
+        # Rules & other lines, in order of insertion (values are unused)
+        self._lines = dict()
+        # (source, destination, type) => set of actions
+        self._cells = defaultdict(set)
+        self._chains = HostnameChains()
+        # Hosts of rules indexed by domain hierarchy (see :meth:`_tries`)
+        self._host_tries = None
+        # Host => rules on it as source or destination (see :meth:`iter_under`)
+        self._rules_by_host = None
+        # Rules which are not modeled here ('1st-party' destination)
+        self._unhandled_rules = False
+        self.update(lines)
+
+    def add(self, line):
+        """Add a line of rules; exact duplicates are ignored"""
+
+        rule = parse_rule(line)
+        if rule is None:
+            line = line.rstrip('\n')
+            if line:
+                self._lines[line] = None
+                if ' 1st-party ' in line:
+                    self._unhandled_rules = True
+            return
+
+        self._lines[rule] = None
+        self._cells[rule[:3]].add(rule[3])
+        self._host_tries = self._rules_by_host = None
+
+    def update(self, lines):
+        """Add many lines of rules"""
+
+        for line in lines:
+            self.add(line)
+
+    def rules(self):
+        """Return the list of rules (tuples)"""
+        return [rule for rule in self._lines if isinstance(rule, tuple)]
+
+    def __iter__(self):
+        """Yield lines of rules (ending with '\\n')"""
+
+        for rule in self._lines:
+            if isinstance(rule, tuple):
+                yield ' '.join(rule) + '\n'
+            else:
+                yield rule + '\n'
+
+    def __len__(self):
+        return len(self._lines)
+
+    def _tries(self):
+        """Return the sources & the destinations of rules indexed by domain
+        hierarchy (see :class:`HostTrie`)
+
+        The tries are built on first use after the last added rule; hosts of
+        rules removed since then are still indexed.
+
+        :rtype: <tuple <HostTrie>, <HostTrie>>
+        """
+
+        if self._host_tries is None:
+            rules = self.rules()
+            self._host_tries = (HostTrie({rule[0] for rule in rules}),
+                                HostTrie({rule[1] for rule in rules}))
+        return self._host_tries
+
+    def iter_under(self, hostname):
+        """Yield rules whose source or destination is the given host or a
+        host below it.
+
+        ex: 'example.com' => 'example.com * cookie block',
+            '* cdn.example.com * allow', ...
+
+        :param: Host ('*' for all the rules).
+        :type: <str>
+        :return: Generator of rules (tuples), in order of insertion.
+        :rtype: <generator <tuple <str>>>
+        """
+
+        if hostname == '*':
+            yield from self.rules()
+            return
+
+        if self._rules_by_host is None:
+            self._rules_by_host = defaultdict(list)
+            for rule in self.rules():
+                self._rules_by_host[rule[0]].append(rule)
+                if rule[1] != rule[0]:
+                    self._rules_by_host[rule[1]].append(rule)
+
+        sources, destinations = self._tries()
+        hosts = chain(sources.iter_under(hostname),
+                      destinations.iter_under(hostname))
+        # Removed rules are still indexed
+        rules = dict.fromkeys(
+            rule for host in hosts for rule in self._rules_by_host[host]
+            if rule in self._lines
+        )
+        if len(rules) < 2:
+            yield from rules
+            return
+        positions = {rule: position
+                     for position, rule in enumerate(self._lines)}
+        yield from sorted(rules, key=positions.__getitem__)
+
+    def iter_sorted(self):
+        """Yield lines of rules in canonical order (sorted by source,
+        destination, type & action)
+        """
+
+        yield from sorted(self)
+
+    def _anchor(self, rule):
+        """Return the narrowest host of the given rule, None if its source &
+        destination are unrelated (the rule never applies to requests of a
+        site to itself).
+        """
+
+        source, destination = rule[0], rule[1]
+        if destination in self._chains[source]:
+            return source
+        if source in self._chains[destination]:
+            return destination
+        return None
+
+    def conflicts(self):
+        """Return pairs of conflicting rules (see the module docstring)
+
+        Rules on the same cell with both actions always conflict. Otherwise,
+        both rules apply to the requests of the site of the narrowest host of
+        the 2 rules: rules are indexed by their narrowest host (anchor) and
+        each rule is compared to the rules of the opposite action anchored
+        on its own anchor or its ancestors.
+
+        ex: 'example.com * cookie block' & '* example.com * allow',
+            'example.com * * block' & '* cdn.example.com script allow'
+
+        :return: Pairs of rules (tuples), in order of insertion of the rules.
+        :rtype: <list <tuple <tuple <str>>, <tuple <str>>>>
+        """
+
+        rules_by_anchor = defaultdict(list)
+        anchors = dict()
+        for rule in self.rules():
+            anchor = self._anchor(rule)
+            if anchor is not None:
+                anchors[rule] = anchor
+                rules_by_anchor[anchor].append(rule)
+
+        positions = {rule: position
+                     for position, rule in enumerate(self._lines)}
+        # Cells with both actions, whatever the hosts
+        conflicts = {
+            tuple(sorted((cell + ACTIONS[:1], cell + ACTIONS[1:]),
+                         key=positions.__getitem__))
+            for cell, actions in self._cells.items() if len(actions) > 1
+        }
+        for rule, anchor in anchors.items():
+            for hostname in self._chains[anchor]:
+                for other in rules_by_anchor.get(hostname, ()):
+                    if other[3] == rule[3] \
+                            or '*' not in (rule[2], other[2]) \
+                            and rule[2] != other[2]:
+                        continue
+                    # Exceptions are not conflicts (same cell: both are True)
+                    if contains(rule, other) != contains(other, rule):
+                        continue
+                    conflicts.add(tuple(sorted(
+                        (rule, other), key=positions.__getitem__
+                    )))
+
+        return sorted(conflicts,
+                      key=lambda pair: tuple(map(positions.__getitem__, pair)))
+
+    def resolve_conflicts(self, policy='keep'):
+        """Remove rules which conflict with a rule that is kept.
+
+        With 'allow' & 'block' policies, the rules of the opposite action
+        involved in a conflict are removed; with 'first' & 'last' policies,
+        the rule added last (or first) of each conflicting pair is removed,
+        unless the other rule of the pair is already removed: pairs are
+        resolved in order of priority of their kept rule.
+
+        .. note:: Must be called before :meth:`optimize`.
+
+        :param: Policy (see CONFLICT_POLICIES).
+        :type: <str>
+        :return: Number of removed rules.
+        :rtype: <int>
+        """
+
+        if policy not in CONFLICT_POLICIES:
+            raise ValueError("Unknown policy of conflicts: " + policy)
+
+        if policy == 'keep':
+            return 0
+        conflicts = self.conflicts()
+
+        if policy in ACTIONS:
+            removed = {rule for pair in conflicts for rule in pair
+                       if rule[3] != policy}
+        else:
+            # Pairs are ordered by the first addition of the rules:
+            # (kept rule, removed rule) in order of priority of the kept rule
+            if policy == 'first':
+                pairs = conflicts
+            else:
+                positions = {rule: position
+                             for position, rule in enumerate(self._lines)}
+                pairs = sorted(
+                    ((second, first) for first, second in conflicts),
+                    key=lambda pair: positions[pair[0]], reverse=True
+                )
+            removed = set()
+            for kept, loser in pairs:
+                if kept not in removed:
+                    removed.add(loser)
+
+        for rule in removed:
+            del self._lines[rule]
+            actions = self._cells[rule[:3]]
+            actions.discard(rule[3])
+            if not actions:
+                del self._cells[rule[:3]]
+
+        return len(removed)
+
+    def _is_covered(self, rule):
+        """Return True if a broader rule with the same action exists.
+
+        Only the ancestors which are hosts of rules are looked up
+        (see :class:`HostTrie`).
+
+        .. note:: Broader rules on an ancestor destination with a specific
+            type are not used: uMatrix may not consult them.
+        """
+
+        source, destination, type_, action = rule
+        cells = self._cells
+        sources, destinations = self._tries()
+        all_types = (type_, '*') if type_ != '*' else ('*',)
+        destinations = list(destinations.iter_covering(destination))
+
+        # Broadest rules are the most common coverers
+        for broad_source in sources.iter_covering(source):
+            for broad_destination in destinations:
+                if broad_destination == destination \
+                        or broad_destination == '*':
+                    types = all_types
+                else:
+                    types = ('*',)
+
+                for broad_type in types:
+                    actions = cells.get(
+                        (broad_source, broad_destination, broad_type)
+                    )
+                    if actions and action in actions and (
+                            broad_source != source
+                            or broad_destination != destination
+                            or broad_type != type_):
+                        return True
+        return False
+
+    def optimize(self):
+        """Remove duplicates & rules covered by broader ones.
+
+        .. note:: Coverage & conflicts are evaluated against the initial set
+            of rules; covering is transitive so a rule removed thanks to a
+            rule which is removed later stays covered by a remaining one.
+
+        .. note:: Only duplicates are removed if there are '1st-party' rules.
+
+        :return: Number of removed rules (duplicates are not counted since
+            they are never stored).
+        :rtype: <int>
+        """
+
+        if self._unhandled_rules:
+            return 0
+
+        rules = self.rules()
+        covered = [rule for rule in rules if self._is_covered(rule)]
+
+        if len({rule[3] for rule in rules}) == 1:
+            # No possible conflict
+            removed = covered
+        else:
+            removed = list()
+            for action in ACTIONS:
+                queries = [rule for rule in covered if rule[3] == action]
+                if not queries:
+                    continue
+                index = _ConflictIndex(
+                    self._chains,
+                    (rule for rule in rules if rule[3] != action),
+                    queries
+                )
+                removed.extend(
+                    rule for rule in queries if not index.overlaps(rule)
+                )
+
+        for rule in removed:
+            del self._lines[rule]
+        # Cells are kept: removed rules are still covered by remaining ones
+
+        return len(removed)
+
+
+class _ConflictIndex():
+    """Rules indexed by hosts to find rules overlapping a given scope
+
+    2 hosts are related if one is an ancestor of the other (or if they are
+    equal); for a query (source, destination), overlapping rules are:
+
+        - rules on ancestors of both hosts ('exact' dict);
+        - rules on an ancestor source & under the destination,
+          rules under the source & on an ancestor destination
+          ('destination_below' & 'source_below' dicts);
+        - rules under both hosts ('both_below' dict).
+
+    Keys of 'below' dicts are restricted to the hosts of the queries given
+    at the creation of the index: their size doesn't grow with the
+    product of the chains of hostnames.
+    Values are the sets of types of the registered rules.
+    """
+
+    def __init__(self, chains, rules, queries):
+        """
+        :param arg1: Cache of hostnames & their ancestors.
+        :param arg2: Iterable of indexed rules.
+        :param arg3: Rules which will be given to :meth:`overlaps`.
+        :type arg1: <HostnameChains>
+        """
+
+        self._chains = chains
+        self._exact = defaultdict(set)
+        self._source_below = defaultdict(set)
+        self._destination_below = defaultdict(set)
+        self._both_below = defaultdict(set)
+
+        query_sources = {query[0] for query in queries}
+        query_destinations = {query[1] for query in queries}
+        query_cells = {(query[0], query[1]) for query in queries}
+
+        for source, destination, type_, _ in rules:
+            self._exact[source, destination].add(type_)
+
+            sources = [hostname for hostname in chains[source]
+                       if hostname in query_sources]
+            destinations = [hostname for hostname in chains[destination]
+                            if hostname in query_destinations]
+
+            for hostname in sources:
+                self._source_below[hostname, destination].add(type_)
+            for hostname in destinations:
+                self._destination_below[source, hostname].add(type_)
+            for cell in product(sources, destinations):
+                if cell in query_cells:
+                    self._both_below[cell].add(type_)
+
+    def overlaps(self, rule):
+        """Return True if a rule of the index overlaps the scope of the
+        given rule (related source, related destination, related type).
+        """
+
+        source, destination, type_ = rule[0], rule[1], rule[2]
+        sources = self._chains[source]
+        destinations = self._chains[destination]
+
+        # Lazy lookups: the first overlap stops the search
+        types_lists = chain(
+            (self._both_below.get((source, destination)),),
+            (self._source_below.get((source, hostname))
+             for hostname in destinations),
+            (self._destination_below.get((hostname, destination))
+             for hostname in sources),
+            (self._exact.get(cell) for cell in product(sources, destinations)),
+        )
+
+        return any(
+            types and (type_ == '*' or '*' in types or type_ in types)
+            for types in types_lists
+        )
+
+
+def iter_optimized_rules(lines):
+    """Yield the given lines of rules without redundant rules.
+
+    .. note:: All the lines are loaded before the first one is yielded.
+
+    :param: Iterable of lines of uMatrix rules.
+    :return: Generator of lines of rules (ending with '\n').
+    :rtype: <generator <str>>
+    """
+
+    ruleset = RuleSet(lines)
+    ruleset.optimize()
+    yield from ruleset
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+# MIT License
+#
+# Copyright (c) 2017 Ysard
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Tests of the index of hosts by domain hierarchy.
+
+Like in uMatrix, '*' covers all hosts and IP addresses have no parent but
+'*' (see :meth:`ruleset.broader_hostname`).
+"""
+
+# Standard imports
+import io
+import unittest
+
+# Custom imports
+from host_trie import HostTrie, host_labels
+from ruleset import RuleSet, broader_hostname
+from uMatrix_converter import NoScriptParser
+
+HOSTS = ('example.com', 'cdn.example.com', 'a.cdn.example.com',
+         'b.example.com', 'c.org', '1.2.3.4', '[fe80::1]')
+
+
+class TestHostTrie(unittest.TestCase):
+
+    def test_labels(self):
+
+        self.assertEqual(host_labels('a.b.com'), ['com', 'b', 'a'])
+        self.assertEqual(host_labels('*'), [])
+        self.assertEqual(host_labels('1.2.3.4'), ['1.2.3.4'])
+        self.assertEqual(host_labels('[fe80::1]'), ['[fe80::1]'])
+        self.assertEqual(broader_hostname('[fe80::1]'), '*')
+        self.assertEqual(broader_hostname('[2001:DB8::1]'), '*')
+
+    def test_covering(self):
+
+        trie = HostTrie(HOSTS)
+        self.assertEqual(trie.covering('a.cdn.example.com'),
+                         'cdn.example.com')
+        self.assertEqual(trie.covering('x.b.example.com'), 'b.example.com')
+        # The host itself is not taken into account
+        self.assertEqual(trie.covering('example.com'), None)
+        self.assertEqual(trie.covering('other.net'), None)
+        # IP addresses are not domains
+        self.assertEqual(trie.covering('1.2.3.4'), None)
+        self.assertEqual(trie.covering('5.1.2.3.4'), None)
+        self.assertEqual(trie.covering('*'), None)
+
+        trie.add('*')
+        self.assertEqual(trie.covering('other.net'), '*')
+        self.assertEqual(trie.covering('[fe80::1]'), '*')
+        self.assertEqual(trie.covering('*'), None)
+
+    def test_iter_covering(self):
+
+        trie = HostTrie(HOSTS + ('*',))
+        self.assertEqual(
+            list(trie.iter_covering('x.a.cdn.example.com')),
+            ['*', 'example.com', 'cdn.example.com', 'a.cdn.example.com']
+        )
+        self.assertEqual(list(trie.iter_covering('[fe80::1]')),
+                         ['*', '[fe80::1]'])
+        self.assertEqual(list(trie.iter_covering('*')), ['*'])
+
+    def test_iter_under(self):
+
+        trie = HostTrie(HOSTS)
+        self.assertEqual(
+            sorted(trie.iter_under('cdn.example.com')),
+            ['a.cdn.example.com', 'cdn.example.com']
+        )
+        self.assertEqual(
+            sorted(trie.iter_under('cdn.example.com', include_self=False)),
+            ['a.cdn.example.com']
+        )
+        # The given host doesn't have to be in the trie
+        self.assertEqual(sorted(trie.iter_under('com')),
+                         ['a.cdn.example.com', 'b.example.com',
+                          'cdn.example.com', 'example.com'])
+        self.assertEqual(list(trie.iter_under('1.2.3.4')), ['1.2.3.4'])
+        self.assertEqual(list(trie.iter_under('2.3.4')), [])
+        self.assertEqual(sorted(trie.iter_under('*')), sorted(HOSTS))
+
+    def test_roots(self):
+
+        trie = HostTrie(HOSTS)
+        self.assertEqual(sorted(trie.roots()),
+                         ['1.2.3.4', '[fe80::1]', 'c.org', 'example.com'])
+
+        trie.add('*')
+        self.assertEqual(list(trie.roots()), ['*'])
+
+    def test_collapse(self):
+
+        trie = HostTrie(['a.example.com', 'b.example.com', 'x.y.net',
+                         'z.y.net', 'c.org', '1.2.3.4', '[fe80::1]'])
+        self.assertEqual(
+            sorted(trie.collapse(2)),
+            ['1.2.3.4', '[fe80::1]', 'c.org', 'example.com', 'y.net']
+        )
+        # Not enough siblings
+        self.assertEqual(sorted(trie.collapse(3)), sorted(trie))
+        # No collapse into top-level domains
+        trie = HostTrie(['a.co.uk', 'b.co.uk', 'c.org', 'd.org'])
+        self.assertEqual(sorted(trie.collapse(2)), ['c.org', 'co.uk',
+                                                     'd.org'])
+        self.assertEqual(sorted(trie.collapse(2, min_labels=3)),
+                         sorted(trie))
+        # 'uk' has 1 direct child: 'co.uk'
+        self.assertEqual(sorted(trie.collapse(2, min_labels=1)),
+                         ['co.uk', 'org'])
+
+        trie = HostTrie(['a.example.com', '*'])
+        self.assertEqual(trie.collapse(1), ['*'])
+
+    def test_section(self):
+
+        config = NoScriptParser()
+        config.read_file(io.StringIO(
+            'example.com\n[UNTRUSTED]\ncdn.example.com\n'))
+        self.assertEqual(list(config.host_trie('UNTRUSTED')),
+                         ['cdn.example.com'])
+        self.assertEqual(config.host_trie('UKN').covering('cdn.example.com'),
+                         'example.com')
+
+
+class TestRuleSetIndex(unittest.TestCase):
+
+    def test_iter_under(self):
+
+        lines = [
+            'example.com * cookie block',
+            '* cdn.example.com * allow',
+            '* c.org * allow',
+            '1.2.3.4 example.com script allow',
+            '* [fe80::1] * block',
+        ]
+        ruleset = RuleSet(lines)
+        self.assertEqual(
+            [' '.join(rule) for rule in ruleset.iter_under('example.com')],
+            [lines[0], lines[1], lines[3]]
+        )
+        self.assertEqual(
+            [' '.join(rule) for rule in ruleset.iter_under('[fe80::1]')],
+            [lines[4]]
+        )
+        self.assertEqual(len(list(ruleset.iter_under('*'))), len(lines))
+
+        # The index follows added & removed rules
+        ruleset.add('* x.c.org * allow')
+        ruleset.add('* c.org * block')
+        ruleset.resolve_conflicts('allow')
+        self.assertEqual(
+            [' '.join(rule) for rule in ruleset.iter_under('c.org')],
+            [lines[2], '* x.c.org * allow']
+        )
+
+    def test_optimize_ip(self):
+
+        # A rule on '*' covers IP addresses, a rule on a domain doesn't
+        ruleset = RuleSet(['* * script allow', '4.com * script allow',
+                           '1.2.3.4 * script allow', '[fe80::1] * * allow'])
+        ruleset.optimize()
+        self.assertEqual(list(ruleset), ['* * script allow\n',
+                                         '[fe80::1] * * allow\n'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+# MIT License
+#
+# Copyright (c) 2017 Ysard
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Tests of the sums of the metrics written by several processes."""
+
+# Standard imports
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+# Custom imports
+from metrics import Registry
+
+# Pid above the default pid_max of Linux: never a running process
+DEAD_PID = 4194305
+
+
+class TestCollect(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.registry = Registry(self.directory)
+        self.registry.inc('umatrix_conversions_total')
+        self.registry.set('umatrix_result_cache_entries', 3)
+        self.registry.flush()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def add_process(self, pid):
+        """Copy the metrics of the current process as those of another one"""
+        filename = os.path.join(self.directory, '{}.json')
+        with open(filename.format(os.getpid())) as fd:
+            snapshot = json.load(fd)
+        with open(filename.format(pid), 'w') as fd:
+            json.dump(snapshot, fd)
+
+    def values(self):
+        return {name: value
+                for name, _, value in self.registry.collect()['counters']}
+
+    def test_live_process(self):
+        """Counters & gauges of running processes are summed"""
+        self.add_process(os.getppid())
+        self.assertEqual(
+            self.values(),
+            {'umatrix_conversions_total': 2, 'umatrix_result_cache_entries': 6}
+        )
+
+    def test_dead_process(self):
+        """Gauges of dead processes are skipped, not their counters"""
+        self.add_process(DEAD_PID)
+        self.assertEqual(
+            self.values(),
+            {'umatrix_conversions_total': 2, 'umatrix_result_cache_entries': 3}
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
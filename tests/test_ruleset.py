@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+# MIT License
+#
+# Copyright (c) 2017 Ysard
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Randomized tests of the optimizer of rulesets.
+
+An optimized ruleset must give the same decision as the original one for
+every request (source, destination, type); decisions are made by a reference
+evaluator of uMatrix rules (evaluateCellZXY of uMatrix's matrix.js).
+
+Conflicts found with the index of rules must be the same as the conflicts
+found by comparing all the pairs of rules.
+"""
+
+# Standard imports
+import random
+import unittest
+
+# Custom imports
+from ruleset import RuleSet, parse_rule, broader_hostname, covers, contains
+
+HOSTS = ('*', 'a.com', 'x.a.com', 'y.x.a.com', 'b.org', 'c.b.org', 'com',
+         'd.net')
+TYPES = ('*', 'script', 'xhr', 'cookie')
+# Requests: hosts of rules, hosts below them & unrelated hosts
+REQUEST_HOSTS = HOSTS[1:] + ('z.y.x.a.com', 'z.c.b.org', 'e.fr')
+REQUEST_TYPES = TYPES[1:] + ('image',)
+ITERATIONS = 300
+
+# Decisions of cells
+BLOCK, ALLOW = 1, 2
+
+
+def evaluate_cell_z(cells, source, destination, type_):
+    """Decision of the first rule found for the source or its ancestors"""
+
+    while source:
+        decision = cells.get((source, destination, type_))
+        if decision:
+            return decision
+        source = broader_hostname(source)
+    return 0
+
+
+def evaluate_cell_zxy(cells, source, destination, type_, honor_ancestors):
+    """Decision of uMatrix for a request (0: no rule)
+
+    :param arg4: Allow rules of ancestors of the destination win over
+        broader block rules (both behaviours are tested).
+    """
+
+    decision = evaluate_cell_z(cells, source, destination, type_)
+    if decision:
+        return decision
+
+    any_type = evaluate_cell_z(cells, source, destination, '*')
+    if any_type == BLOCK:
+        return BLOCK
+
+    ancestor = destination
+    while True:
+        ancestor = broader_hostname(ancestor)
+        if ancestor in ('*', ''):
+            break
+        decision = evaluate_cell_z(cells, source, ancestor, type_)
+        if decision == BLOCK:
+            return BLOCK
+        if honor_ancestors and decision == ALLOW:
+            return ALLOW
+        if any_type != ALLOW:
+            any_type = evaluate_cell_z(cells, source, ancestor, '*')
+            if any_type == BLOCK:
+                return BLOCK
+
+    decision = evaluate_cell_z(cells, source, '*', type_)
+    if decision == BLOCK:
+        return BLOCK
+    if any_type == ALLOW:
+        return ALLOW
+    if decision == ALLOW:
+        return ALLOW
+    return evaluate_cell_z(cells, source, '*', '*')
+
+
+def cells_of(lines):
+    """Decisions of the cells of the given rules"""
+
+    cells = dict()
+    for line in lines:
+        rule = parse_rule(line)
+        if rule:
+            cells[rule[:3]] = BLOCK if rule[3] == 'block' else ALLOW
+    return cells
+
+
+def random_rules(rnd):
+    """Random rules; at most 1 action per cell (see resolve_conflicts)"""
+
+    rules = dict()
+    for _ in range(rnd.randrange(1, 12)):
+        cell = (rnd.choice(HOSTS), rnd.choice(HOSTS), rnd.choice(TYPES))
+        rules.setdefault(
+            cell, ' '.join(cell + (rnd.choice(('allow', 'allow', 'block')),))
+        )
+    return list(rules.values())
+
+
+class TestOptimizer(unittest.TestCase):
+
+    def test_same_decisions(self):
+
+        rnd = random.Random(1)
+        removed = 0
+
+        for _ in range(ITERATIONS):
+            lines = random_rules(rnd)
+            ruleset = RuleSet(lines)
+            removed += ruleset.optimize()
+            before, after = cells_of(lines), cells_of(ruleset)
+
+            for source in REQUEST_HOSTS:
+                for destination in REQUEST_HOSTS:
+                    for type_ in REQUEST_TYPES:
+                        for honor_ancestors in (True, False):
+                            args = (source, destination, type_,
+                                    honor_ancestors)
+                            self.assertEqual(
+                                evaluate_cell_zxy(after, *args),
+                                evaluate_cell_zxy(before, *args),
+                                "{} => {} for {}".format(
+                                    lines, list(ruleset), args)
+                            )
+
+        # The test is useless if nothing is optimized
+        self.assertGreater(removed, ITERATIONS // 4)
+
+    def test_duplicates(self):
+
+        ruleset = RuleSet(['a.com b.com script allow\n'] * 3 + ['# comment'])
+        self.assertEqual(list(ruleset), ['a.com b.com script allow\n',
+                                         '# comment\n'])
+
+
+def is_conflict(rule, other):
+    """Reference definition of conflicts (see the ruleset module)"""
+
+    if rule[3] == other[3]:
+        return False
+    if rule[:3] == other[:3]:
+        return True
+    if '*' not in (rule[2], other[2]) and rule[2] != other[2]:
+        return False
+    if contains(rule, other) != contains(other, rule):
+        return False
+    # Some site is covered by the 4 hosts
+    hosts = rule[:2] + other[:2]
+    return any(all(covers(host, site) for host in hosts) for site in hosts)
+
+
+class TestConflicts(unittest.TestCase):
+
+    def test_conflicts(self):
+
+        ruleset = RuleSet([
+            'h.com * cookie block',
+            '* h.com * allow',
+            # Unrelated source & destination
+            'o.com d.com * allow',
+            # Exception of a broader rule
+            '* x.h.com * block',
+        ])
+        self.assertEqual(
+            ruleset.conflicts(),
+            [(('h.com', '*', 'cookie', 'block'), ('*', 'h.com', '*', 'allow'))]
+        )
+
+        ruleset = RuleSet(['o.com d.com * allow', 'o.com d.com * block'])
+        self.assertEqual(len(ruleset.conflicts()), 1)
+
+    def test_resolve_conflicts(self):
+
+        lines = ['h.com * cookie block\n', '* h.com * allow\n',
+                 '* x.h.com * block\n']
+        expected = {
+            'keep': lines,
+            'allow': lines[1:],
+            'block': [lines[0], lines[2]],
+            'first': [lines[0], lines[2]],
+            'last': lines[1:],
+        }
+        for policy, expected_lines in expected.items():
+            ruleset = RuleSet(lines)
+            ruleset.resolve_conflicts(policy)
+            self.assertEqual(list(ruleset), expected_lines, policy)
+
+        # The block rule is removed: the last allow rule has no opponent left
+        lines = ['* h.com * allow\n', 'h.com * cookie block\n',
+                 '* h.com cookie allow\n']
+        for policy in ('first', 'last'):
+            ruleset = RuleSet(lines)
+            self.assertEqual(ruleset.resolve_conflicts(policy), 1)
+            self.assertEqual(list(ruleset), [lines[0], lines[2]], policy)
+
+    def test_same_conflicts(self):
+
+        rnd = random.Random(2)
+        found = 0
+
+        for _ in range(ITERATIONS):
+            lines = [
+                ' '.join((rnd.choice(HOSTS), rnd.choice(HOSTS),
+                          rnd.choice(TYPES), rnd.choice(('allow', 'block'))))
+                for _ in range(rnd.randrange(1, 12))
+            ]
+            ruleset = RuleSet(lines)
+            rules = ruleset.rules()
+            expected = [
+                (rule, other) for position, rule in enumerate(rules)
+                for other in rules[position + 1:] if is_conflict(rule, other)
+            ]
+            conflicts = ruleset.conflicts()
+            found += len(conflicts)
+            self.assertEqual(sorted(conflicts), sorted(expected), lines)
+
+            for policy in ('allow', 'block', 'first', 'last'):
+                ruleset = RuleSet(lines)
+                ruleset.resolve_conflicts(policy)
+                self.assertEqual(ruleset.conflicts(), [], (lines, policy))
+
+        self.assertGreater(found, ITERATIONS // 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+# MIT License
+#
+# Copyright (c) 2017 Ysard
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Differential tests of the chunked tokenizer of text exports.
+
+Entries of random exports, read by chunks of various sizes (chunk boundaries
+anywhere in lines & headers), must be the entries of the reference parsers:
+the regex implementations read line by line, before TextConfigParser.
+"""
+
+# Standard imports
+import io
+import re
+import random
+import tempfile
+import unittest
+
+# Custom imports
+from uMatrix_converter import RequestPolicyParser, NoScriptParser, \
+    BLOOM_CAPACITY, BLOOM_ENTRY_SIZE, bloom_capacity, iter_streamed_rules
+
+# Pieces of lines of random exports: hosts, urls, headers, broken headers
+PIECES = (
+    'a.com', 'http://b.org', 'https://c.net', 'about:blank', 'x:80',
+    'http://y:8', '[UNTRUSTED]', '[origins]', '[a]b]', '[nohdr', '', 'd|e',
+    'f|g|h', 'https://', 'http://a|b', '[]', ' [x]', 'z]',
+)
+CHUNK_SIZES = (1, 2, 3, 7, 64, 1 << 20)
+ITERATIONS = 3000
+
+SECTION_PATTERN = re.compile(r'\[(.*)\]')
+PROTOCOL_PATTERN = re.compile(r'(https?://)?([^:]*$)')
+
+
+def reference_request_policy(text):
+    """Entries of a RequestPolicy export, read line by line"""
+
+    section, entries = 'UKN', list()
+    for line in io.StringIO(text):
+        line = line.rstrip('\n')
+        match = SECTION_PATTERN.match(line)
+        if match is not None:
+            section = match.group(1)
+            continue
+        entries.append(
+            (section, tuple(line.split('|')) if '|' in line else line)
+        )
+    return entries
+
+
+def reference_noscript(text):
+    """Entries of a NoScript export, read line by line"""
+
+    section, entries = 'UKN', list()
+    for line in io.StringIO(text):
+        line = line.rstrip('\n')
+        match = SECTION_PATTERN.match(line)
+        if match is not None:
+            section = match.group(1)
+            continue
+        match = PROTOCOL_PATTERN.match(line)
+        if match is not None:
+            entries.append((section, match.group(2)))
+    return entries
+
+
+def chunked_entries(parser, text, chunk_size):
+    """Entries of the given export, read by chunks of the given size"""
+
+    return [
+        (section, entry)
+        for section, lines in parser.iter_blocks(io.StringIO(text), chunk_size)
+        for entry in parser.parse_lines(section, lines)
+    ]
+
+
+class TestChunkedTokenizer(unittest.TestCase):
+
+    def test_random_exports(self):
+
+        rnd = random.Random(0)
+        parsers = (
+            (RequestPolicyParser, reference_request_policy),
+            (NoScriptParser, reference_noscript),
+        )
+
+        for _ in range(ITERATIONS):
+            lines = [rnd.choice(PIECES) for _ in range(rnd.randrange(15))]
+            text = '\n'.join(lines) + rnd.choice(('', '\n', '\n\n'))
+
+            for parser_class, reference in parsers:
+                expected = reference(text)
+                for chunk_size in CHUNK_SIZES:
+                    # Stop at the first difference
+                    self.assertEqual(
+                        chunked_entries(parser_class(), text, chunk_size),
+                        expected,
+                        "{} by chunks of {}: {!r}".format(
+                            parser_class.__name__, chunk_size, text)
+                    )
+
+    def test_read_file(self):
+        """Sections of read_file() are the sets of streamed entries"""
+
+        text = "[a]\nhttp://x.com\ny.org\n[b]\nz.net\n[a]\nw.fr\n"
+        parser = NoScriptParser()
+        parser.read_file(io.StringIO(text))
+
+        self.assertEqual(set(parser.sections()), {'a', 'b'})
+        self.assertEqual(set(parser.section('a')), {'x.com', 'y.org', 'w.fr'})
+        self.assertEqual(set(parser.section('b')), {'z.net'})
+        self.assertEqual(
+            sorted(NoScriptParser().iter_entries(io.StringIO(text))),
+            sorted(reference_noscript(text))
+        )
+
+
+
+class TestDeduplication(unittest.TestCase):
+
+    def test_bloom_capacity(self):
+        """Bloom filters are sized from the size of regular files only"""
+
+        with tempfile.NamedTemporaryFile('w') as fd:
+            fd.write('a.com\n' * 100)
+            fd.flush()
+            self.assertEqual(bloom_capacity(fd.name), 600 // BLOOM_ENTRY_SIZE)
+            self.assertEqual(bloom_capacity(fd), 600 // BLOOM_ENTRY_SIZE)
+
+        self.assertEqual(bloom_capacity(io.StringIO('a.com\n')),
+                         BLOOM_CAPACITY)
+
+    def test_approximate(self):
+        """Rules of both deduplication modes are the same"""
+
+        random.seed(0)
+        text = "[a]\n" + "".join(
+            random.choice(PIECES) + "\n" for _ in range(ITERATIONS)
+        )
+        rules = {
+            dedup: list(iter_streamed_rules(NoScriptParser(),
+                                            io.StringIO(text), dedup))
+            for dedup in ('exact', 'approximate')
+        }
+        self.assertEqual(rules['exact'], rules['approximate'])
+
+
+if __name__ == '__main__':
+    unittest.main()
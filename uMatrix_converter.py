@@ -22,19 +22,141 @@
 # SOFTWARE.
 
 # Standard imports
-import re
-from collections import defaultdict
+import os
+import io
+import sys
+import stat
+import argparse
+from contextlib import contextmanager
+from itertools import islice, groupby, chain
+from operator import itemgetter
 import abc
 
 # Custom imports
-import database as db
+from bloom_filter import BloomFilter
+from host_table import HostTable, Section
+from host_trie import HostTrie
+from ruleset import RuleSet, CONFLICT_POLICIES
+
+# Number of rules grouped in each write
+RULES_BATCH_SIZE = 4096
+# Number of characters read at once in text exports
+READ_CHUNK_SIZE = 64 * 1024
+# Number of rows fetched at once in databases
+FETCH_BATCH_SIZE = 8192
+# Bloom filter settings of the approximate deduplication:
+# capacity when the size of the export is unknown (about 2.4MB),
+# min number of bytes of an entry in an export (see :meth:`bloom_capacity`)
+BLOOM_CAPACITY = 1000000
+BLOOM_ENTRY_SIZE = 16
+BLOOM_ERROR_RATE = 0.0001
+# Number of bytes read at the beginning of a file to guess its format
+SNIFF_SIZE = 4096
+# Header of SQLite databases
+SQLITE_MAGIC = b'SQLite format 3\x00'
+
+# Parsers available for conversions of any file, by name, in order of
+# detection (see :meth:`register_parser`)
+PARSER_CLASSES = dict()
+
+
+@contextmanager
+def open_file(target, mode='r'):
+    """Open the given filepath, or give back the given file object as is.
+
+    File objects are not closed on exit; their owner is in charge of them.
+
+    :param arg1: Filepath or file object (stream, text sink, etc.).
+    :param arg2: Opening mode used if a filepath is given.
+    :type arg1: <str> or <file object>
+    :type arg2: <str>
+    :return: File object.
+    :rtype: <file object>
+    """
+
+    if isinstance(target, (str, bytes, os.PathLike)):
+        with open(target, mode) as fd:
+            yield fd
+    else:
+        yield target
+
+
+def register_parser(parser_class):
+    """Class decorator which makes the given parser available for the
+    detection of formats (see :meth:`guess_parser`) & the conversions.
+
+    :param: Parser class with a :meth:`ConfigParser.sniff` method & an
+        :attr:`ConfigParser.entry_rules` maker of rules.
+    :return: The same class.
+    """
+
+    if parser_class.entry_rules is None:
+        raise TypeError(parser_class.__name__ + " has no maker of rules")
+    PARSER_CLASSES[parser_class.__name__] = parser_class
+    return parser_class
+
+
+def guess_parser(head):
+    """Return the parser of a file according to its first bytes.
+
+    Only the sniffers of registered parsers are used: the file is not parsed.
+
+    :param: First bytes of the file (at most SNIFF_SIZE bytes).
+    :type: <bytes>
+    :return: Parser class or None if the format is unknown.
+    :rtype: <class>
+    """
+
+    # Permissive sniffers last (registration order otherwise)
+    parser_classes = sorted(PARSER_CLASSES.values(),
+                            key=lambda parser_class: parser_class.fallback)
+    for parser_class in parser_classes:
+        if parser_class.sniff(head):
+            return parser_class
+    return None
 
 
 class ConfigParser(abc.ABC):
-    """Basic class that can handle dump files from various addons"""
+    """Basic class that can handle dump files from various addons
+
+    Hosts are interned in a table of integer ids which can be shared between
+    parsers; sections are compact set-like containers (see :class:`Section`).
+    """
+
+    # Name of the addon in messages
+    label = None
+    # Maker of uMatrix rules from one entry: function (section, entry,
+    # **kwargs) => tuple of rules
+    entry_rules = None
+    # Sections converted by :meth:`iter_rules`, in order
+    # (None: all the sections, in order of creation)
+    rules_sections = None
+    # The sniffer accepts a broad format: it is tried after the sniffers of
+    # the other parsers (see :meth:`guess_parser`)
+    fallback = False
+
+    def __init__(self, host_table=None):
+        """
+        :param: Optional table of hosts shared with other parsers.
+        :type: <HostTable>
+        """
+
+        self._host_table = HostTable() if host_table is None else host_table
+        self._content = dict()
+
+    @classmethod
+    def sniff(cls, head):
+        """Return True if the given beginning of a file looks like an export
+        handled by this parser.
 
-    def __init__(self):
-        self._content = defaultdict(set)
+        Sniffers are cheap: a few KB are tested, a file accepted here may
+        still be erroneous.
+
+        :param: First bytes of the file (at most SNIFF_SIZE bytes).
+        :type: <bytes>
+        :rtype: <bool>
+        """
+        return False
 
     def sections(self):
         return self._content.keys()
@@ -46,130 +168,262 @@ class ConfigParser(abc.ABC):
     def content(self):
         return self._content
 
-    @abc.abstractclassmethod
-    def read_file(self, filepath):
-        """Open an export file"""
-        return
+    @property
+    def host_table(self):
+        return self._host_table
+
+    def host_trie(self, section):
+        """Return the hosts of the given section indexed by domain hierarchy.
+
+        .. note:: Sections are not mixed: in a trie of 'allow' & 'block'
+            hosts, :meth:`HostTrie.roots` would cover hosts of one section
+            with hosts of the other one.
+
+        .. seealso:: :class:`HostTrie`
+
+        :param: Name of the section.
+        :type: <str>
+        :return: Hosts of single entries & of tuples of hosts.
+        :rtype: <HostTrie>
+        """
+
+        trie = HostTrie()
+        for entry in self.section(section):
+            if isinstance(entry, str):
+                trie.add(entry)
+            else:
+                trie.update(entry)
+        return trie
 
+    def add(self, section, entry):
+        """Add an entry (host or tuple of hosts) to the given section"""
 
-class RequestPolicyParser(ConfigParser):
-    """Parser of RequestPolicy export"""
+        self._get_or_create_section(section).add(entry)
 
     def read_file(self, filepath):
-        """Open RequestPolicy export
+        """Open an export file & set content variable.
 
-        .. note:: 4 sections: 'UKN', 'origins-to-destinations', 'destinations'
-            & 'origins'
+        :param: Filepath or file object of the export.
         """
 
-        section_pattern = re.compile('\[(.*)\]')
+        # Consecutive entries of the same section are added at once
+        for section, entries in groupby(self.iter_entries(filepath),
+                                        key=itemgetter(0)):
+            self._get_or_create_section(section).update(
+                map(itemgetter(1), entries)
+            )
 
-        with open(filepath, 'r') as fd:
+    def _get_or_create_section(self, name):
 
-            section = 'UKN'
+        content = self._content.get(name)
+        if content is None:
+            content = self._content[name] = Section(self._host_table)
+        return content
 
-            for line in fd:
-                line = line.rstrip('\n')
+    @abc.abstractmethod
+    def iter_entries(self, filepath):
+        """Yield entries of an export file as soon as they are read.
 
-                m = section_pattern.match(line)
+        Nothing is kept in memory: duplicates are yielded as they appear in
+        the file (see :meth:`unique_entries`).
 
-                # Detect sections
-                if m is not None:
-                    section = m.group(1)
-                    continue
+        :param: Filepath or file object of the export.
+        :return: Generator of tuples (section, entry).
+        :rtype: <generator <tuple <str>, <str> or <tuple>>>
+        """
+        return
 
-                # Detect origin => destination pattern
-                if '|' in line:
-                    self._content[section].add(tuple(line.split('|')))
-                else:
 
-                    self._content[section].add(line)
+class TextConfigParser(ConfigParser):
+    """Basic class for exports in text format, made of sections
+
+    A section starts with a header line '[name]'; lines before the first
+    header belong to the 'UKN' section.
+
+    The file is read by large chunks, cut into blocks of consecutive lines of
+    the same section; header lines are found with plain string searches
+    instead of a regex per line. Subclasses only have to convert a whole
+    block of lines into entries (see :meth:`parse_lines`).
+    """
+
+    @staticmethod
+    def sniff_lines(head):
+        """Return the complete lines of the beginning of a text file.
 
+        :param: First bytes of the file (at most SNIFF_SIZE bytes).
+        :type: <bytes>
+        :return: Non-empty lines without surrounding spaces;
+            None if the file is not UTF-8 text.
+        :rtype: <list <str>>
+        """
 
-class NoScriptParser(ConfigParser):
-    """Parser of NoScript export"""
+        if b'\x00' in head:
+            return None
+        if len(head) >= SNIFF_SIZE:
+            # The last line (& its last character) may be cut
+            head = head[:head.rfind(b'\n') + 1]
+        try:
+            text = head.decode('utf-8')
+        except UnicodeDecodeError:
+            return None
+        return [line for line in map(str.strip, text.splitlines()) if line]
 
     def read_file(self, filepath):
-        """Open NoScript export
+        """Open an export file & set content variable.
+
+        :param: Filepath or text file object of the export.
+        """
+
+        for section, lines in self.iter_blocks(filepath):
+            self._get_or_create_section(section).update(
+                self.parse_lines(section, lines)
+            )
+
+    def iter_entries(self, filepath):
+        """Yield entries of an export file as soon as they are read.
 
-        .. note:: 2 sections: 'UKN' & 'UNTRUSTED'
+        :param: Filepath or text file object of the export.
+        :return: Generator of tuples (section, entry).
+        :rtype: <generator <tuple <str>, <str> or <tuple>>>
         """
 
-        section_pattern = re.compile('\[(.*)\]')
-        # Remove http://, https://, about:blank urls
-        protocol_pattern = re.compile('(https?://)?([^:]*$)')
+        for section, lines in self.iter_blocks(filepath):
+            for entry in self.parse_lines(section, lines):
+                yield section, entry
 
-        with open(filepath, 'r') as fd:
+    def iter_blocks(self, filepath, chunk_size=READ_CHUNK_SIZE):
+        """Yield blocks of consecutive lines of the same section.
 
-            section = 'UKN'
+        :param arg1: Filepath or text file object of the export.
+        :param arg2: Number of characters read at once.
+        :return: Generator of tuples (section, lines without line breaks).
+        :rtype: <generator <tuple <str>, <list <str>>>>
+        """
 
-            for line in fd:
-                line = line.rstrip('\n')
+        section = 'UKN'
+        # Incomplete line at the end of the previous chunk
+        pending = ''
 
-                m = section_pattern.match(line)
+        with open_file(filepath, 'r') as fd:
+            while True:
+                chunk = fd.read(chunk_size)
+                if not chunk:
+                    break
 
-                # Detect sections
-                if m is not None:
-                    section = m.group(1)
+                chunk = pending + chunk
+                end = chunk.rfind('\n')
+                if end == -1:
+                    pending = chunk
                     continue
 
-                # Insert hosts
-                m = protocol_pattern.match(line)
-                if m is not None:
-                    # print(m.groups())
-                    self._content[section].add(m.group(2))
+                pending = chunk[end + 1:]
+                section = yield from self._iter_text_blocks(chunk[:end],
+                                                            section)
 
+        # Last line without line break
+        if pending:
+            yield from self._iter_text_blocks(pending, section)
 
-class FirefoxPermissionsParser(ConfigParser):
-    """Parser of Cookie Monster/Firefox export
+    @staticmethod
+    def _iter_text_blocks(text, section):
+        """Cut text made of complete lines into blocks of sections.
 
-    .. note:: Since Cookie Monster is a wrapper of Firefox features, we need
-        to get data from permissions.sqlite.
+        :param arg1: Complete lines, without the last line break.
+        :param arg2: Current section at the beginning of the text.
+        :return: Generator of tuples (section, lines); its return value is
+            the current section at the end of the text.
+        """
 
-        In 'moz_perms' table we need to retrieve:
-            - type: cookie
-            - permission:
-                1: Autoriser, 2: Bloquer, 8: Autoriser pour la session
-    """
+        def next_header(position):
+            """Start of the next line beginning with '[' (or -1)"""
+            if text.startswith('[', position):
+                return position
+            position = text.find('\n[', position)
+            return position if position == -1 else position + 1
 
-    def read_file(self, filepath):
-        """Open permisssions.sqlite & set content variable.
+        block_start = 0
+        header_start = next_header(0)
 
-        .. note:: 2 sections: 'allow' & 'block'
+        while header_start != -1:
+
+            header_end = text.find('\n', header_start)
+            if header_end == -1:
+                header_end = len(text)
+
+            closing = text.rfind(']', header_start, header_end)
+            if closing == -1:
+                # Not a header: the line is a regular line of the block
+                header_start = next_header(header_end + 1) \
+                    if header_end < len(text) else -1
+                continue
+
+            if header_start > block_start:
+                yield section, text[block_start:header_start - 1].split('\n')
+
+            section = text[header_start + 1:closing]
+            block_start = header_end + 1
+            header_start = next_header(block_start) \
+                if block_start <= len(text) else -1
+
+        if block_start <= len(text):
+            yield section, text[block_start:].split('\n')
+
+        return section
+
+    @abc.abstractmethod
+    def parse_lines(self, section, lines):
+        """Convert a block of lines of the given section into entries.
+
+        :param arg1: Section of the lines.
+        :param arg2: Lines without line breaks.
+        :return: Iterable of entries (hosts or tuples of hosts).
+        :rtype: <iterable>
         """
+        return
 
-        # Initialize database
-        with db.SQLA_Wrapper(db_file=filepath) as session:
 
-            # Query
-            res = session.execute(
-                'SELECT origin, permission '
-                'FROM moz_perms '
-                'WHERE type == \'cookie\''
-            )
+def strip_protocol(url):
+    """Remove http:// or https:// prefix of the given url
 
-            # Remove http://, https://, about:blank urls
-            protocol_pattern = re.compile('(https?://)?([^:]*$)')
+    Urls with other protocols or with a port (about:blank, file:///...,
+    host:8080) are not hosts.
 
-            for origin, permission in res:
+    :param: Url.
+    :type: <str>
+    :return: Host or None.
+    :rtype: <str>
+    """
 
-                m = protocol_pattern.match(origin)
-                if m is None:
-                    # Unknown host
-                    continue
+    if ':' not in url:
+        return url
+    for prefix in ('http://', 'https://'):
+        if url.startswith(prefix) and ':' not in url[len(prefix):]:
+            return url[len(prefix):]
+    return None
 
-                # Allow
-                if permission == 1:
-                    self._content['allow'].add(m.group(2))
 
-                # Block/Allow for the session
-                elif permission == 8 or permission == 2:
-                    self._content['block'].add(m.group(2))
+def strip_protocols(urls):
+    """Remove http:// or https:// prefixes of many urls at once
 
+    Bulk version of :meth:`strip_protocol`: urls which are not hosts are
+    removed from the result.
 
-def request_policy_converter(request_policy_parser, output_filepath,
-                             advanced=False):
-    """Convert and write content of RequestPolicy to uMatrix rules file.
+    :param: Urls.
+    :type: <list <str>>
+    :return: Hosts.
+    :rtype: <list <str>>
+    """
+
+    hosts = [
+        url[8:] if url[:8] == 'https://' else
+        url[7:] if url[:7] == 'http://' else url
+        for url in urls
+    ]
+    return [host for host in hosts if ':' not in host]
+
+
+def request_policy_entry_rules(section, entry, advanced=False):
+    """Return uMatrix rules made from one entry of RequestPolicy.
 
     types of requests for uMatrix:
         xhr, frame, cookie, media, image, css, script
@@ -188,47 +442,44 @@ def request_policy_converter(request_policy_parser, output_filepath,
             'destinations': * destination xhr allow
             'origins': None
 
+    :param arg1: Section of the entry.
+    :param arg2: Entry (host or tuple (origin, destination)).
+    :param arg3: Trigger advanced rules.
+    :return: uMatrix rules (lines ending with '\n').
+    :rtype: <tuple <str>>
     """
 
-    with open(output_filepath, 'a') as fd:
-
-        # Origin => Destination
-        section = request_policy_parser.section('origins-to-destinations')
+    # Origin => Destination
+    if section == 'origins-to-destinations':
+        ori, dest = entry
 
-        for ori, dest in section:
-
-            if advanced:
-                fd.write("{} {} xhr allow\n".format(ori, dest))
-                fd.write("{} {} script allow\n".format(ori, dest))
-            else:
-                fd.write("{} {} * allow\n".format(ori, dest))
-
-
-        # Destinations
-        section = request_policy_parser.section('destinations')
-
-        for dest in section:
-            if advanced:
-                fd.write("* {} xhr allow\n".format(dest))
-#                fd.write("* {} script allow\n".format(dest))
-            else:
-                fd.write("* {} * allow\n".format(dest))
+        if advanced:
+            return (
+                "{} {} xhr allow\n".format(ori, dest),
+                "{} {} script allow\n".format(ori, dest),
+            )
+        return ("{} {} * allow\n".format(ori, dest),)
 
+    # Destinations
+    if section == 'destinations':
+        if advanced:
+            return ("* {} xhr allow\n".format(entry),)
+#            "* {} script allow\n".format(entry)
+        return ("* {} * allow\n".format(entry),)
 
-        # Origins
-        section = request_policy_parser.section('origins')
+    # Origins
+    if section == 'origins':
+        if advanced:
+            return ()
+#            "{} * xhr allow\n".format(entry)
+#            "{} * script allow\n".format(entry)
+        return ("{} * * allow\n".format(entry),)
 
-        for ori in section:
-            if advanced:
-                pass
-#                fd.write("{} * xhr allow\n".format(ori))
-#                fd.write("{} * script allow\n".format(ori))
-            else:
-                fd.write("{} * * allow\n".format(ori))
+    return ()
 
 
-def noscript_converter(noscript_parser, output_filepath, **kwargs):
-    """Convert and write content of NoScript to uMatrix rules file.
+def noscript_entry_rules(section, entry, **kwargs):
+    """Return uMatrix rules made from one entry of NoScript.
 
     types of requests for uMatrix:
         script
@@ -237,26 +488,26 @@ def noscript_converter(noscript_parser, output_filepath, **kwargs):
 
     .. note:: Basic rules of NoScript are 'allow' rules, others are explicitly
         'block' rules.
-    """
-
-    with open(output_filepath, 'a') as fd:
 
-        # UKN (allow)
-        section = noscript_parser.section('UKN')
+    :param arg1: Section of the entry.
+    :param arg2: Host.
+    :return: uMatrix rules (lines ending with '\n').
+    :rtype: <tuple <str>>
+    """
 
-        for host in section:
-            fd.write("{} {} script allow\n".format(host, host))
+    # UKN (allow)
+    if section == 'UKN':
+        return ("{} {} script allow\n".format(entry, entry),)
 
-        # UNTRUSTED (block)
-        section = noscript_parser.section('UNTRUSTED')
+    # UNTRUSTED (block)
+    if section == 'UNTRUSTED':
+        return ("* {} script block\n".format(entry),)
 
-        for host in section:
-            fd.write("* {} script block\n".format(host))
+    return ()
 
 
-def cookie_monster_converter(firefox_permissions_parser, output_filepath,
-                             **kwargs):
-    """Convert and write content of Firefox permissions to uMatrix rules file.
+def cookie_monster_entry_rules(section, entry, **kwargs):
+    """Return uMatrix rules made from one entry of Firefox permissions.
 
     types of requests for uMatrix:
         cookie
@@ -264,39 +515,628 @@ def cookie_monster_converter(firefox_permissions_parser, output_filepath,
         allow, block
 
     .. note:: 'Authorized for the session' rules are converted to 'block' rules.
+
+    :param arg1: Section of the entry ('allow' or 'block').
+    :param arg2: Host.
+    :return: uMatrix rules (lines ending with '\n').
+    :rtype: <tuple <str>>
     """
 
-    with open(output_filepath, 'a') as fd:
+    return ("{} * cookie {}\n".format(entry, section),)
 
-        # allow
-        for section, content in firefox_permissions_parser.content.items():
 
-            for host in content:
-                fd.write("{} * cookie {}\n".format(host, section))
+@register_parser
+class RequestPolicyParser(TextConfigParser):
+    """Parser of RequestPolicy export
 
+    .. note:: 4 sections: 'UKN', 'origins-to-destinations', 'destinations'
+        & 'origins'
+    """
 
+    label = 'RequestPolicy'
+    entry_rules = staticmethod(request_policy_entry_rules)
+    rules_sections = ('origins-to-destinations', 'destinations', 'origins')
+    HEADERS = ('[origins-to-destinations]', '[destinations]', '[origins]')
 
-if __name__ == "__main__":
+    @classmethod
+    def sniff(cls, head):
+        """Lines of hosts with headers of RequestPolicy or 'origin|destination'
+        lines; the 'UKN' section alone gives no rule.
+        """
+
+        lines = cls.sniff_lines(head)
+        return bool(lines) \
+            and all(len(line.split()) == 1 for line in lines) \
+            and any(line in cls.HEADERS or '|' in line for line in lines)
+
+    def parse_lines(self, section, lines):
+        """Hosts & tuples of origin => destination"""
+
+        return [
+            tuple(line.split('|')) if '|' in line else line
+            for line in lines
+        ]
+
+
+@register_parser
+class NoScriptParser(TextConfigParser):
+    """Parser of NoScript export
+
+    .. note:: 2 sections: 'UKN' & 'UNTRUSTED'
+    """
+
+    label = 'NoScript'
+    entry_rules = staticmethod(noscript_entry_rules)
+    rules_sections = ('UKN', 'UNTRUSTED')
+    # Any list of hosts looks like a NoScript export
+    fallback = True
+
+    @classmethod
+    def sniff(cls, head):
+        """Lines of hosts or urls, without RequestPolicy's headers & tuples"""
+
+        lines = cls.sniff_lines(head)
+        return bool(lines) and all(
+            len(line.split()) == 1 and '|' not in line
+            and line not in RequestPolicyParser.HEADERS
+            for line in lines
+        )
+
+    def parse_lines(self, section, lines):
+        """Hosts without http://, https:// prefixes; other urls are ignored"""
+
+        # Most of lines are bare hosts
+        hosts = [
+            line if ':' not in line else strip_protocol(line)
+            for line in lines
+        ]
+        return [host for host in hosts if host is not None]
+
+
+@register_parser
+class FirefoxPermissionsParser(ConfigParser):
+    """Parser of Cookie Monster/Firefox export
+
+    .. note:: Since Cookie Monster is a wrapper of Firefox features, we need
+        to get data from permissions.sqlite.
+
+        In 'moz_perms' table we need to retrieve:
+            - type: cookie
+            - permission:
+                1: Autoriser, 2: Bloquer, 8: Autoriser pour la session
+    """
+
+    label = 'Firefox permissions'
+    entry_rules = staticmethod(cookie_monster_entry_rules)
+
+    @classmethod
+    def sniff(cls, head):
+        """Header of SQLite databases"""
+        return head.startswith(SQLITE_MAGIC)
+
+    # Sections & their values of permission
+    # (1: allow; 2: block, 8: block for the current session)
+    SECTIONS = (('allow', (1,)), ('block', (2, 8)))
+    # Origins of a section: permissions are bucketed by SQLite, only 1 column
+    # crosses into Python (an index on (type, permission, origin) is used if
+    # the database has one)
+    QUERY = (
+        'SELECT origin '
+        'FROM moz_perms '
+        'WHERE type == \'cookie\' AND permission IN ({})'
+    )
+
+    def read_file(self, filepath, immutable=False):
+        """Read permissions.sqlite & set content variable.
+
+        Hosts of each batch of rows are added at once to their section
+        (see :meth:`iter_batches`).
+
+        :param arg1: Filepath, binary file object or content (bytes) of the
+            database.
+        :param arg2: The database can't be modified during the reading
+            (see :meth:`database.readonly_connection`).
+        """
 
-    import os
-    os.remove('data/uMatrix-rules.txt')
+        for section, hosts in self.iter_batches(filepath, immutable):
+            self._get_or_create_section(section).update_hosts(hosts)
 
-    config = FirefoxPermissionsParser()
-    config.read_file('data/permissions.sqlite')
-    cookie_monster_converter(config, 'data/uMatrix-rules.txt')
+    def iter_entries(self, filepath, immutable=False):
+        """Read permisssions.sqlite
 
-    config = RequestPolicyParser()
-    config.read_file('data/requestpolicy-settings.txt')
-    request_policy_converter(config, 'data/uMatrix-rules.txt', advanced=True)
+        .. note:: 2 sections: 'allow' & 'block'
+
+        .. note:: Entries of a batch of rows are grouped by section
+            (see :meth:`iter_batches`).
+
+        :param arg1: Filepath, binary file object or content (bytes) of the
+            database.
+        :param arg2: The database can't be modified during the reading
+            (see :meth:`database.readonly_connection`).
+        """
+
+        for section, hosts in self.iter_batches(filepath, immutable):
+            for host in hosts:
+                yield section, host
+
+    def iter_batches(self, filepath, immutable=False,
+                     batch_size=FETCH_BATCH_SIZE):
+        """Yield hosts of permissions.sqlite by batches of rows.
+
+        Rows are not handled one by one: origins of each section are queried
+        separately & each batch is cleaned of protocols with list
+        comprehensions (see :meth:`strip_protocols`).
+
+        .. note:: A given binary file object (or bytes) is loaded in memory,
+            without any write on disk (see :meth:`database.memory_connection`).
+
+        :param arg1: Filepath, binary file object or content (bytes) of the
+            database.
+        :param arg2: The database can't be modified during the reading
+            (see :meth:`database.readonly_connection`).
+        :param arg3: Number of rows fetched at once.
+        :return: Generator of tuples (section, non-empty list of hosts).
+        :rtype: <generator <tuple <str>, <list <str>>>>
+        """
+
+        # Imported on first use: conversions of text exports don't need it
+        import database as db
+
+        if isinstance(filepath, (str, os.PathLike)):
+            # Read-only access, without SQLAlchemy engine nor ORM session
+            connection_manager = db.readonly_connection(filepath, immutable)
+        else:
+            if not isinstance(filepath, (bytes, bytearray, memoryview)):
+                filepath = filepath.read()
+            connection_manager = db.memory_connection(filepath)
+
+        with connection_manager as connection:
+
+            # Same snapshot of the database for all the sections
+            connection.execute('BEGIN')
+
+            for section, permissions in self.SECTIONS:
+                cursor = connection.execute(
+                    self.QUERY.format(', '.join('?' * len(permissions))),
+                    permissions
+                )
+
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+
+                    # Remove http://, https://, about:blank urls
+                    hosts = strip_protocols([origin for origin, in rows])
+                    if hosts:
+                        yield section, hosts
+
+
+def bloom_capacity(filepath):
+    """Return the max number of entries of the given export, from its size.
+
+    The Bloom filter of the 'approximate' deduplication is sized from this
+    number: its memory footprint is about 15% of the size of the export.
+
+    :param: Filepath or file object of the export.
+    :return: Number of entries; BLOOM_CAPACITY if the size is unknown
+        (pipes, files in memory).
+    :rtype: <int>
+    """
+
+    try:
+        if hasattr(filepath, 'fileno'):
+            status = os.fstat(filepath.fileno())
+        else:
+            status = os.stat(filepath)
+    except (OSError, ValueError):
+        return BLOOM_CAPACITY
+
+    if not stat.S_ISREG(status.st_mode):
+        return BLOOM_CAPACITY
+    return max(1, status.st_size // BLOOM_ENTRY_SIZE)
+
+
+def unique_entries(entries, dedup='exact', capacity=BLOOM_CAPACITY,
+                   error_rate=BLOOM_ERROR_RATE):
+    """Filter out duplicated entries of a stream returned by a parser.
+
+    .. note:: 'exact' mode keeps a set of all the entries already seen;
+        'approximate' mode uses a Bloom filter with a fixed memory footprint:
+        a small fraction of unique entries (error_rate) may be dropped.
+
+    :param arg1: Iterable of tuples (section, entry).
+    :param arg2: Deduplication mode: 'exact', 'approximate' or None
+        (entries are given back as is).
+    :param arg3: Expected number of unique entries ('approximate' mode).
+    :param arg4: Acceptable false positive rate ('approximate' mode).
+    :return: Generator of tuples (section, entry).
+    :rtype: <generator <tuple>>
+    """
+
+    if dedup is None:
+        yield from entries
+        return
+
+    if dedup == 'exact':
+        seen = set()
+    elif dedup == 'approximate':
+        seen = BloomFilter(capacity, error_rate)
+    else:
+        raise ValueError("Unknown deduplication mode: " + str(dedup))
+
+    for section_entry in entries:
+        if section_entry in seen:
+            continue
+        seen.add(section_entry)
+        yield section_entry
+
+
+def iter_request_policy_rules(request_policy_parser, advanced=False):
+    """Yield uMatrix rules made from content of RequestPolicy.
+
+    .. seealso:: :meth:`iter_rules`, :meth:`request_policy_entry_rules`
+
+    :param arg1: RequestPolicy parser.
+    :param arg2: Trigger advanced rules.
+    :return: Generator of uMatrix rules (lines ending with '\n').
+    :rtype: <generator <str>>
+    """
+
+    return iter_rules(request_policy_parser, advanced=advanced)
+
+
+def iter_noscript_rules(noscript_parser, **kwargs):
+    """Yield uMatrix rules made from content of NoScript.
+
+    .. seealso:: :meth:`iter_rules`, :meth:`noscript_entry_rules`
+
+    :param: NoScript parser.
+    :return: Generator of uMatrix rules (lines ending with '\n').
+    :rtype: <generator <str>>
+    """
+
+    return iter_rules(noscript_parser, **kwargs)
+
+
+def iter_cookie_monster_rules(firefox_permissions_parser, **kwargs):
+    """Yield uMatrix rules made from content of Firefox permissions.
+
+    .. seealso:: :meth:`iter_rules`, :meth:`cookie_monster_entry_rules`
+
+    :param: Firefox permissions parser.
+    :return: Generator of uMatrix rules (lines ending with '\n').
+    :rtype: <generator <str>>
+    """
+
+    # allow/block
+    return iter_rules(firefox_permissions_parser, **kwargs)
+
+
+def iter_rules(parser, **kwargs):
+    """Yield uMatrix rules made from the content of any supported parser.
+
+    Rules are made by the :attr:`ConfigParser.entry_rules` maker of the
+    parser, for its :attr:`ConfigParser.rules_sections`.
+
+    :param arg1: Parser (RequestPolicy, NoScript, Firefox permissions or
+        any registered parser, see :meth:`register_parser`).
+    :param arg2: Keyword arguments given to the rules maker
+        (ex: advanced=True).
+    :return: Generator of uMatrix rules (lines ending with '\n').
+    :rtype: <generator <str>>
+    """
+
+    entry_rules = parser.entry_rules
+    sections = parser.rules_sections
+    if sections is None:
+        sections = list(parser.sections())
+
+    for section in sections:
+        for entry in parser.section(section):
+            yield from entry_rules(section, entry, **kwargs)
+
+
+def export_source(parser_class, data):
+    """Return the content of an export in memory as expected by its parser
+
+    Text exports are decoded on the fly, databases are given as bytes.
+
+    :param arg1: Class of the parser.
+    :param arg2: Content of the export.
+    :type arg2: <bytes>
+    :return: Text file object or bytes.
+    """
+
+    if not issubclass(parser_class, TextConfigParser):
+        return data
+    return io.TextIOWrapper(io.BytesIO(data), encoding='utf-8')
+
+
+@contextmanager
+def _untimed(stage):
+    """Default timer of :meth:`convert_export`: nothing is measured"""
+    yield
+
+
+def convert_export(kind, data, advanced=False, optimize=False,
+                   timer=_untimed):
+    """Parse the given export in memory and return uMatrix rules.
 
-    config = NoScriptParser()
-    config.read_file('data/noscript_whitelist_export.txt')
-    noscript_converter(config, 'data/uMatrix-rules.txt')
+    Used by the website & the conversion daemon; the export is never
+    written on disk.
 
-    #print(config.sections())
-    #print(config.content())
+    :param arg1: Name of the parser (see PARSER_CLASSES).
+    :param arg2: Content of the export.
+    :param arg3: Trigger advanced rules for request policy.
+    :param arg4: Remove duplicated & redundant rules.
+    :param arg5: Function (stage) returning a context manager which
+        measures the 'parse' & 'convert' stages (ex: timers of metrics).
+    :type arg1: <str>
+    :type arg2: <bytes>
+    :type arg3: <bool>
+    :type arg4: <bool>
+    :return: uMatrix rules.
+    :rtype: <str>
+    """
+
+    parser_class = PARSER_CLASSES[kind]
+    parser = parser_class()
+    with timer('parse'):
+        parser.read_file(export_source(parser_class, data))
+
+    with timer('convert'):
+        if optimize:
+            rules = iter_merged_rules([parser], optimize=True,
+                                      advanced=advanced)
+        else:
+            rules = iter_rules(parser, advanced=advanced)
+        return ''.join(rules)
+
+
+def iter_streamed_rules(parser, filepath, dedup='exact', capacity=None,
+                        **kwargs):
+    """Yield uMatrix rules while the given export is read.
+
+    Contrary to :meth:`iter_rules`, the content of the parser is not filled:
+    the conversion starts before the end of the parsing and the memory
+    footprint does not depend on the size of the export
+    (except for 'exact' deduplication).
+
+    .. note:: Rules are yielded in the order of the export,
+        not grouped by section.
+
+    :param arg1: RequestPolicy, NoScript or Firefox permissions parser.
+    :param arg2: Filepath or file object of the export.
+    :param arg3: Deduplication mode of entries: 'exact', 'approximate' or None.
+        See :meth:`unique_entries`.
+    :param arg4: Expected number of unique entries ('approximate' mode);
+        by default, estimated from the size of the export
+        (see :meth:`bloom_capacity`).
+    :param arg5: Keyword arguments given to the rules maker
+        (ex: advanced=True).
+    :return: Generator of uMatrix rules (lines ending with '\n').
+    :rtype: <generator <str>>
+    """
+
+    entry_rules = parser.entry_rules
+
+    if dedup == 'approximate' and capacity is None:
+        capacity = bloom_capacity(filepath)
+
+    entries = unique_entries(parser.iter_entries(filepath), dedup,
+                             capacity or BLOOM_CAPACITY)
+    for section, entry in entries:
+        yield from entry_rules(section, entry, **kwargs)
+
+
+def merge_rules(sources, conflicts='keep', optimize=False, **kwargs):
+    """Merge the rules of many exports into 1 ruleset, in one pass.
+
+    Exports may be of any type, many of them may be of the same type.
+
+    :param arg1: Iterable of sources of rules: parsers (filled with their
+        export), iterables of lines of rules or texts of rules
+        (ex: rules already converted).
+    :param arg2: Policy of resolution of conflicts (see
+        :meth:`ruleset.RuleSet.resolve_conflicts`).
+    :param arg3: Remove duplicated & redundant rules.
+    :param arg4: Keyword arguments given to the rules generator of parsers
+        (ex: advanced=True).
+    :type arg2: <str>
+    :type arg3: <bool>
+    :return: Indexed ruleset.
+    :rtype: <RuleSet>
+    """
+
+    ruleset = RuleSet()
+    for source in sources:
+        if isinstance(source, ConfigParser):
+            source = iter_rules(source, **kwargs)
+        elif isinstance(source, str):
+            source = source.splitlines()
+        ruleset.update(source)
+
+    ruleset.resolve_conflicts(conflicts)
+    if optimize:
+        ruleset.optimize()
+    return ruleset
+
+
+def iter_merged_rules(sources, conflicts='keep', optimize=False, **kwargs):
+    """Yield the rules of many exports merged in 1 ruleset, in canonical order.
+
+    .. seealso:: :meth:`merge_rules`
 
+    .. note:: All the rules are loaded before the first one is yielded.
 
+    :return: Generator of uMatrix rules (lines ending with '\n').
+    :rtype: <generator <str>>
+    """
+
+    yield from merge_rules(sources, conflicts, optimize, **kwargs).iter_sorted()
+
+
+def batched_lines(rules, batch_size=RULES_BATCH_SIZE):
+    """Group rules into large text chunks.
+
+    Used to reduce the number of writes on files or on the network.
+
+    :param arg1: Iterable of uMatrix rules (lines ending with '\n').
+    :param arg2: Number of rules per chunk.
+    :return: Generator of text chunks.
+    :rtype: <generator <str>>
+    """
+
+    rules = iter(rules)
+    while True:
+        batch = ''.join(islice(rules, batch_size))
+        if not batch:
+            return
+        yield batch
 
 
+def write_rules(rules, output_filepath, batch_size=RULES_BATCH_SIZE):
+    """Write rules to the given file by batches.
+
+    :param arg1: Iterable of uMatrix rules (lines ending with '\n').
+    :param arg2: Filepath (opened in append mode) or text file object.
+    :param arg3: Number of rules per write.
+    :return: Number of written rules.
+    :rtype: <int>
+    """
+
+    count = 0
+    with open_file(output_filepath, 'a') as fd:
+        for batch in batched_lines(rules, batch_size):
+            fd.write(batch)
+            count += batch.count('\n')
+    return count
+
+
+def request_policy_converter(request_policy_parser, output_filepath,
+                             advanced=False):
+    """Convert and write content of RequestPolicy to uMatrix rules file.
+
+    .. seealso:: :meth:`iter_request_policy_rules`
+
+    :param arg1: RequestPolicy parser.
+    :param arg2: Filepath (opened in append mode) or text file object.
+    :param arg3: Trigger advanced rules.
+    """
+
+    write_rules(
+        iter_request_policy_rules(request_policy_parser, advanced=advanced),
+        output_filepath
+    )
+
+
+def noscript_converter(noscript_parser, output_filepath, **kwargs):
+    """Convert and write content of NoScript to uMatrix rules file.
+
+    .. seealso:: :meth:`iter_noscript_rules`
+
+    :param arg1: NoScript parser.
+    :param arg2: Filepath (opened in append mode) or text file object.
+    """
+
+    write_rules(iter_noscript_rules(noscript_parser), output_filepath)
+
+
+def cookie_monster_converter(firefox_permissions_parser, output_filepath,
+                             **kwargs):
+    """Convert and write content of Firefox permissions to uMatrix rules file.
+
+    .. seealso:: :meth:`iter_cookie_monster_rules`
+
+    :param arg1: Firefox permissions parser.
+    :param arg2: Filepath (opened in append mode) or text file object.
+    """
+
+    write_rules(
+        iter_cookie_monster_rules(firefox_permissions_parser),
+        output_filepath
+    )
+
+
+def main():
+    """Convert the given exports and write uMatrix rules on stdout or in a file
+    """
+
+    arg_parser = argparse.ArgumentParser(
+        description="Convert CookieMonster, RequestPolicy and NoScript "
+                    "configurations to uMatrix rules."
+    )
+    arg_parser.add_argument('-p', '--permissions',
+                            help="Firefox permissions.sqlite file")
+    arg_parser.add_argument('-r', '--requestpolicy',
+                            help="RequestPolicy export")
+    arg_parser.add_argument('-n', '--noscript',
+                            help="NoScript export")
+    arg_parser.add_argument('-a', '--advanced', action='store_true',
+                            help="Make restricted rules for RequestPolicy")
+    arg_parser.add_argument('-o', '--output', default='-',
+                            help="uMatrix rules file (default: stdout)")
+    arg_parser.add_argument('-s', '--stream', action='store_true',
+                            help="Convert exports while they are read; "
+                                 "for very large exports")
+    arg_parser.add_argument('-O', '--optimize', action='store_true',
+                            help="Remove duplicated & redundant rules "
+                                 "(all rules are kept in memory)")
+    arg_parser.add_argument('-c', '--conflicts', default='keep',
+                            choices=CONFLICT_POLICIES,
+                            help="Resolution of conflicting rules (opposite "
+                                 "actions on the same requests); 'first' & "
+                                 "'last' follow the order -p, -r, -n "
+                                 "(default: keep)")
+    arg_parser.add_argument('--dedup', default='exact',
+                            choices=('exact', 'approximate', 'none'),
+                            help="Deduplication of entries in stream mode "
+                                 "(default: exact)")
+    arg_parser.add_argument('--dedup-capacity', type=int,
+                            help="Expected number of unique entries of each "
+                                 "export with '--dedup approximate' "
+                                 "(default: estimated from the size of the "
+                                 "export, else %d)" % BLOOM_CAPACITY)
+    args = arg_parser.parse_args()
+    dedup = None if args.dedup == 'none' else args.dedup
+
+    exports = (
+        (FirefoxPermissionsParser, args.permissions),
+        (RequestPolicyParser, args.requestpolicy),
+        (NoScriptParser, args.noscript),
+    )
+
+    if not any(filepath for _, filepath in exports):
+        arg_parser.error("at least 1 export is required")
+
+    def iter_exports_rules():
+        """Rules of each export"""
+        for parser_class, filepath in exports:
+            if not filepath:
+                continue
+
+            config = parser_class()
+            if args.stream:
+                yield iter_streamed_rules(config, filepath, dedup=dedup,
+                                          capacity=args.dedup_capacity,
+                                          advanced=args.advanced)
+            else:
+                config.read_file(filepath)
+                yield iter_rules(config, advanced=args.advanced)
+
+    if args.optimize or args.conflicts != 'keep':
+        # 1 indexed ruleset, emitted in canonical order
+        rules = iter_merged_rules(iter_exports_rules(), args.conflicts,
+                                  args.optimize)
+    else:
+        rules = chain.from_iterable(iter_exports_rules())
+
+    with open_file(sys.stdout if args.output == '-' else args.output,
+                   'w') as fd:
+        write_rules(rules, fd)
+
+
+if __name__ == "__main__":
 
+    main()
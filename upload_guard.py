@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+# MIT License
+#
+# Copyright (c) 2017 Ysard
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""This module validates uploaded files while they are received.
+
+Werkzeug parses the multipart body of a request chunk by chunk; here, each
+chunk of a file is checked before being stored:
+
+    - size of the file against the cap of its form field;
+    - format of its first bytes (see :meth:`uMatrix_converter.guess_parser`);
+    - for text exports, UTF-8 encoding, NUL bytes & length of lines.
+
+The request is aborted at the first bad chunk: the rest of the body is
+neither read nor buffered (the connection is closed by the error response).
+
+Settings are read in the config of the Flask app:
+
+    - UPLOAD_PARSERS: form field => expected parser class (None: any
+      supported export; fields not listed are refused);
+    - MAX_FILE_LENGTHS: form field => max size in bytes.
+"""
+
+# Standard imports
+import io
+import codecs
+from flask import Request, current_app
+from werkzeug.exceptions import BadRequest
+from werkzeug.formparser import FormDataParser, MultiPartParser
+from werkzeug import secure_filename
+
+# Custom imports
+from uMatrix_converter import TextConfigParser, SNIFF_SIZE, guess_parser
+
+# Longest line accepted in text exports (hosts, urls & tuples of hosts)
+MAX_LINE_LENGTH = 1024
+
+
+class RejectedUpload(BadRequest):
+    """Upload refused while it was received"""
+
+    def __init__(self, reason, filename, message):
+        """
+        :param arg1: Short reason for metrics & logs ('size', 'format',
+            'encoding', 'line', 'field').
+        :param arg2: Name of the uploaded file.
+        :param arg3: Message for the user (HTML).
+        """
+
+        super().__init__(
+            "The file &lt;" + secure_filename(filename) + "&gt; " + message
+        )
+        self.reason = reason
+
+
+class UploadTooLarge(RejectedUpload):
+    """Uploaded file bigger than the cap of its field"""
+    code = 413
+
+
+class GuardedFile(io.BytesIO):
+    """In-memory file which validates the data written in it
+
+    The expected format is checked as soon as SNIFF_SIZE bytes are received;
+    :meth:`finish` must be called at the end of the upload.
+    """
+
+    def __init__(self, field, filename, parser_class, max_length):
+        """
+        :param arg1: Form field.
+        :param arg2: Name of the uploaded file.
+        :param arg3: Expected parser class (None: any supported export).
+        :param arg4: Max size of the file in bytes (None: no cap).
+        """
+
+        super().__init__()
+        self.field = field
+        self.filename = filename
+        self.parser_class = parser_class
+        self.max_length = max_length
+        self.length = 0
+        # Set once the format is known
+        self._decoder = None
+        self._sniffed = False
+        # Number of characters of the current line of text
+        self._line_length = 0
+
+    def write(self, data):
+        """Check & store the given chunk
+
+        :raises RejectedUpload: The file is too big or malformed.
+        """
+
+        self.length += len(data)
+        if self.max_length is not None and self.length > self.max_length:
+            raise UploadTooLarge(
+                'size', self.filename,
+                "is too big (max {} KB) !".format(self.max_length // 1024)
+            )
+
+        if self._sniffed:
+            self._check_text(data)
+            return super().write(data)
+
+        written = super().write(data)
+        if self.length >= SNIFF_SIZE:
+            self._sniff(self.getbuffer()[:SNIFF_SIZE].tobytes())
+            self._check_text(self.getvalue())
+        return written
+
+    def finish(self):
+        """Check the end of the upload
+
+        :raises RejectedUpload: The file is malformed.
+        """
+
+        if not self.filename:
+            # Empty field of the form
+            return
+        if not self._sniffed:
+            self._sniff(self.getvalue())
+            self._check_text(self.getvalue())
+        self._check_text(b'', final=True)
+
+    def _sniff(self, head):
+        """Check the format of the file & prepare the checks of text"""
+
+        self._sniffed = True
+        if self.parser_class is None:
+            self.parser_class = guess_parser(head)
+            if self.parser_class is None:
+                raise RejectedUpload(
+                    'format', self.filename,
+                    "<strong>is not a supported export</strong> !"
+                )
+        elif not self.parser_class.sniff(head):
+            raise RejectedUpload(
+                'format', self.filename,
+                "<strong>is not a " + self.parser_class.label +
+                " export</strong> !"
+            )
+
+        if issubclass(self.parser_class, TextConfigParser):
+            self._decoder = codecs.getincrementaldecoder('utf-8')()
+
+    def _check_text(self, data, final=False):
+        """Check encoding & lines of a chunk of a text export"""
+
+        if self._decoder is None:
+            return
+
+        try:
+            self._decoder.decode(data, final)
+        except UnicodeDecodeError:
+            raise RejectedUpload(
+                'encoding', self.filename,
+                "<strong>is not</strong> a UTF-8 text file !"
+            )
+        if b'\x00' in data:
+            raise RejectedUpload(
+                'encoding', self.filename,
+                "<strong>is not</strong> a text/plain file !"
+            )
+
+        # Lengths in bytes (an upper bound of lengths in characters);
+        # the first part continues the current line
+        lengths = [len(part) for part in data.split(b'\n')]
+        lengths[0] += self._line_length
+        self._line_length = lengths[-1]
+
+        if max(lengths) > MAX_LINE_LENGTH:
+            raise RejectedUpload(
+                'line', self.filename,
+                "has too long lines (max {} characters) !".format(
+                    MAX_LINE_LENGTH)
+            )
+
+
+class GuardedMultiPartParser(MultiPartParser):
+    """Multipart parser which stores files in :class:`GuardedFile` objects"""
+
+    def __init__(self, parsers, max_lengths, *args, **kwargs):
+        """
+        :param arg1: Form field => expected parser class (or None).
+        :param arg2: Form field => max size of its files.
+        :param arg3: Arguments of :class:`MultiPartParser`.
+        """
+
+        super().__init__(*args, **kwargs)
+        self.parsers = parsers
+        self.max_lengths = max_lengths
+        self._field = None
+        self._file = None
+
+    def parse_lines(self, *args, **kwargs):
+        """Events of the multipart stream (see :class:`MultiPartParser`);
+        fields of files are noted & files are checked at their end.
+        """
+
+        for event, value in super().parse_lines(*args, **kwargs):
+            if event == 'begin_file':
+                # (headers, name, filename)
+                self._field = value[1]
+                if self._field not in self.parsers:
+                    raise RejectedUpload(
+                        'field', value[2], "is sent in an unknown field !"
+                    )
+            elif event == 'end' and self._file is not None:
+                self._file.finish()
+                self._file = None
+            yield event, value
+
+    def start_file_streaming(self, filename, headers, total_content_length):
+        """Return the filename & a :class:`GuardedFile` for the current file"""
+
+        if isinstance(filename, bytes):
+            filename = filename.decode(self.charset, self.errors)
+        filename = self._fix_ie_filename(filename)
+
+        self._file = GuardedFile(
+            self._field, filename,
+            self.parsers[self._field], self.max_lengths.get(self._field)
+        )
+        return filename, self._file
+
+
+class GuardedFormDataParser(FormDataParser):
+    """Form parser which checks files while they are received
+
+    .. note:: Contrary to :class:`FormDataParser`, the rest of the body is
+        not read if an upload is rejected.
+    """
+
+    def __init__(self, parsers, max_lengths, *args, **kwargs):
+        """
+        :param arg1: Form field => expected parser class (or None).
+        :param arg2: Form field => max size of its files.
+        :param arg3: Arguments of :class:`FormDataParser`.
+        """
+
+        super().__init__(*args, **kwargs)
+        self.parsers = parsers
+        self.max_lengths = max_lengths
+
+    def _parse_multipart(self, stream, mimetype, content_length, options):
+
+        parser = GuardedMultiPartParser(
+            self.parsers,
+            self.max_lengths,
+            self.stream_factory,
+            self.charset,
+            self.errors,
+            max_form_memory_size=self.max_form_memory_size,
+            cls=self.cls,
+        )
+        boundary = options.get('boundary')
+        if boundary is None:
+            raise ValueError("Missing boundary")
+        if isinstance(boundary, str):
+            boundary = boundary.encode('ascii')
+        form, files = parser.parse(stream, boundary, content_length)
+
+        # Valid body: consume the end of the stream like Werkzeug
+        while stream.read(64 * 1024):
+            pass
+        return stream, form, files
+
+    parse_functions = dict(FormDataParser.parse_functions)
+    parse_functions['multipart/form-data'] = _parse_multipart
+
+
+class GuardedRequest(Request):
+    """Flask request which checks uploaded files while they are received
+
+    .. seealso:: UPLOAD_PARSERS & MAX_FILE_LENGTHS settings of the app.
+    """
+
+    def make_form_data_parser(self):
+
+        config = current_app.config
+        return GuardedFormDataParser(
+            config.get('UPLOAD_PARSERS', dict()),
+            config.get('MAX_FILE_LENGTHS', dict()),
+            self._get_file_stream,
+            self.charset,
+            self.encoding_errors,
+            self.max_form_memory_size,
+            self.max_content_length,
+            self.parameter_storage_class,
+        )
@@ -26,15 +26,24 @@ This modules handles flask app
 
 # Standard imports
 from flask import Flask, render_template, request, flash, \
-    session, send_from_directory
+    session, Response, g
 from werkzeug import secure_filename
-from sqlalchemy.exc import DatabaseError
+from sqlite3 import DatabaseError
 import os
+import sys
 import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 # Custom imports
 import commons as cm
+import result_cache
+import metrics
+import upload_guard
+import admission
 from uMatrix_converter import *
+from incremental import Snapshot, delta_rules, iter_patch
 
 LOGGER = cm.logger()
 
@@ -57,43 +66,120 @@ app.secret_key = '80ca847ebbc7b195ef5781b114379d79'
 # In case of client_max_body_size 100k; restriction not set in NGinx config
 app.config['MAX_CONTENT_LENGTH'] = cm.MAX_CONTENT_LENGTH
 
+# Files are checked while they are received (see upload_guard.py)
+app.request_class = upload_guard.GuardedRequest
+app.config['MAX_FILE_LENGTHS'] = cm.MAX_FILE_LENGTHS
+
+# Bounded pool for CPU-bound conversions (sync workers)
+CONVERSION_EXECUTOR = ThreadPoolExecutor(max_workers=cm.CONVERSION_WORKERS)
+
+# Timings, sizes & counts of all the processes (see the /metrics page)
+METRICS = metrics.Registry(cm.METRICS_DIR)
+
+# Pool of processes of the current worker (see conversion_process_pool())
+_PROCESS_POOL = None
+_PROCESS_POOL_PID = None
+# Threads of the admission control of the current worker (see run_blocking())
+_BLOCKING_POOL = None
+_BLOCKING_POOL_PID = None
+
+# Rules already generated for identical uploads
+RESULT_CACHE = result_cache.ResultCache(
+    cm.RESULT_CACHE_SIZE,
+    cm.RESULT_CACHE_DIR,
+    cm.RESULT_CACHE_DISK_SIZE
+)
+
+# Rate limits & conversion slots shared by the workers
+ADMISSION = admission.Admission(
+    cm.ADMISSION_DB,
+    cm.RATE_LIMIT,
+    cm.RATE_BURST,
+    cm.MAX_IN_FLIGHT,
+    cm.MAX_WAITING,
+    cm.ADMISSION_WAIT,
+    # run_blocking() is defined below
+    run_blocking=lambda func, *args: run_blocking(func, *args)
+)
+
+# Snapshots of previous uploads for incremental conversions
+if cm.SNAPSHOT_DIR is not None:
+    os.makedirs(cm.SNAPSHOT_DIR, exist_ok=True)
+
+
+def format_check(field, filename, head):
+    """Return the parser of the given upload according to its content.
+
+    Only the first bytes of the file are tested (see :meth:`guess_parser`):
+    files in a bad format are refused before being read & parsed.
+
+    :param arg1: Form field (see PARSERS).
+    :param arg2: Name of the uploaded file.
+    :param arg3: First bytes of the file (at most SNIFF_SIZE bytes).
+    :type arg1: <str>
+    :type arg2: <str>
+    :type arg3: <bytes>
+    :return: Parser class or None if the format is not expected
+        (a message is flashed).
+    :rtype: <class>
+    """
 
-def extension_check(field, filestorage):
-    """Check extension 'txt'/'sqlite' of the given file.filename.
+    LOGGER.info("Format check:: " + field + ": " + filename)
 
-    :param: File object.
-    :type: <FileStorage>
-    :return: True if txt or sqlite for Firefox data, False otherwise.
-    :rtype: <bool>
+    expected_class = PARSERS[field]
+    if expected_class is None:
+        # Generic field: any supported export
+        parser_class = guess_parser(head)
+        if parser_class is not None:
+            return parser_class
+        message = "is not a supported export"
+    elif expected_class.sniff(head):
+        return expected_class
+    else:
+        message = "is not a " + expected_class.label + " export"
+
+    METRICS.inc('umatrix_errors_total', field=field)
+    flash("The file &lt;" + secure_filename(filename) + "&gt; <strong>" +
+          message + "</strong> !", 'danger')
+    return None
+
+
+def client_id():
+    """Return the address of the client of the current request
+
+    Behind Nginx, the last address of X-Forwarded-For is the one of the
+    client connected to Nginx (previous ones are given by the client).
     """
 
-    extensions = {
-        'ns_fic': '.txt',
-        'rp_fic': '.txt',
-        'fp_fic': '.sqlite',
-    }
+    if request.access_route:
+        return request.access_route[-1]
+    return request.remote_addr or 'unknown'
 
-    # Don't test empty field
-    if not filestorage:
-        return False
 
-    LOGGER.info("Extension check:: " + filestorage.filename)
-    filename, file_extension = os.path.splitext(filestorage.filename)
+def take_conversion_slot():
+    """Take 1 of the conversion slots of all the workers for the request
 
-    if file_extension != extensions[field]:
-        flash("The file &lt;" + secure_filename(filestorage.filename) + \
-              "&gt; has a bad extension !", 'danger')
-        return False
+    The request may wait for its turn (see :meth:`admission.Admission.acquire`);
+    the slot is released by :meth:`release_conversion_slot`.
+    """
 
-    return True
+    with METRICS.timer('queue'):
+        g.slot_id = ADMISSION.acquire()
+
+
+@app.teardown_request
+def release_conversion_slot(error=None):
+    """Release the conversion slot of the request, even after an error"""
+
+    ADMISSION.release(g.pop('slot_id', None))
 
 
 def form_valid(files):
     """Check the validity of the form.
 
     Check if fields are present; if yes test filestorage exists.
-    Return False if ALL filestorage objects are empty or if at least 1 field is
-    missing.
+    Return False if ALL filestorage objects are empty, if at least 1 field is
+    missing or unknown. The generic field is optional.
 
     :param: Iterable of files in form.
     :type: <werkzeug.datastructures.ImmutableMultiDict>
@@ -101,67 +187,328 @@ def form_valid(files):
     :rtype: <bool>
     """
 
-    ids = ('ns_fic', 'rp_fic', 'fp_fic')
+    ids = [field for field, parser_class in PARSERS.items()
+           if parser_class is not None]
 
-    if len(ids) != len(files):
+    if any(field not in PARSERS for field in files):
         return False
 
     file_found = False
-    for id in ids:
-        # Get file in form (return None if expected id is not in fields)
-        filestorage = files.get(id, None)
-        if filestorage is None:
-            # 1 field absent (None) = danger
+    for id in PARSERS:
+        # Get files in form (empty list if expected id is not in fields)
+        filestorages = files.getlist(id)
+        if not filestorages and id in ids:
+            # 1 field absent = danger
             return False
-        elif filestorage:
+        elif any(filestorages):
             # Detect if all files are empty
             file_found = True
     return file_found
 
 
-def parse_config(field, filepath, uMatrix_path, advanced):
-    """Generates a uMatrix file with the given file.
+def run_conversion(func, *args):
+    """Run a CPU-bound function in the bounded pool of conversions.
+
+    With CONVERSION_PROCESSES, a pool of processes of the worker is used.
+    Otherwise, with an async gunicorn worker (gevent), the current greenlet
+    waits for the result while other connections are served; native threads
+    of the gevent hub are used. Otherwise, a regular pool of threads is used:
+    it bounds the number of concurrent conversions of the process.
+
+    :param arg1: Function.
+    :param arg2: Positional arguments.
+    :return: Result of the function (its exceptions are raised here).
+    """
+
+    return submit_conversion(func, *args)()
+
+
+def conversion_process_pool(reset=False):
+    """Return the pool of conversion processes of the current worker.
+
+    The pool is created on first use: gunicorn workers are forked after
+    the import of this module and each one must get its own pool.
+
+    :param: Replace the current pool (ex: a process was killed).
+    :return: Pool of CONVERSION_PROCESSES processes.
+    :rtype: <ProcessPoolExecutor>
+    """
+
+    global _PROCESS_POOL, _PROCESS_POOL_PID
+
+    if reset or _PROCESS_POOL is None or _PROCESS_POOL_PID != os.getpid():
+        _PROCESS_POOL = ProcessPoolExecutor(
+            max_workers=cm.CONVERSION_PROCESSES
+        )
+        _PROCESS_POOL_PID = os.getpid()
+    return _PROCESS_POOL
+
+
+def submit_conversion(func, *args):
+    """Start a CPU-bound function in the bounded pool of conversions.
+
+    With CONVERSION_PROCESSES, the function is run in a process of the
+    worker: arguments & result are pickled; otherwise native threads are used
+    (see :meth:`run_conversion`).
+
+    :param arg1: Function (defined at the module level).
+    :param arg2: Positional arguments.
+    :return: Function without argument which waits for the result
+        (exceptions of the function are raised by it).
+    """
+
+    if cm.CONVERSION_PROCESSES:
+        try:
+            return conversion_process_pool().submit(func, *args).result
+        except BrokenProcessPool:
+            LOGGER.error("submit_conversion:: broken pool of processes")
+            return conversion_process_pool(reset=True).submit(
+                func, *args).result
+
+    if gevent_patched():
+        import gevent
+        threadpool = gevent.get_hub().threadpool
+        threadpool.maxsize = cm.CONVERSION_WORKERS
+        return threadpool.spawn(func, *args).get
+
+    return CONVERSION_EXECUTOR.submit(func, *args).result
+
+
+def gevent_patched():
+    """Return True if the worker is an async gunicorn worker (gevent)"""
+
+    return 'gevent.monkey' in sys.modules and \
+        sys.modules['gevent.monkey'].is_module_patched('threading')
+
+
+def run_blocking(func, *args):
+    """Run a short blocking call (SQLite transaction of the admission control).
+
+    With an async gunicorn worker (gevent), the call is made by a small pool
+    of native threads of the worker: the hub keeps serving other connections
+    meanwhile, and the call doesn't wait behind the conversions which fill
+    the threadpool of the hub. Otherwise, the call is made directly.
+
+    Exceptions are expected (ex: refused requests): they are returned by
+    the thread & raised by the caller, since gevent logs a traceback for
+    each exception raised in its threads.
+
+    :param arg1: Function.
+    :param arg2: Positional arguments.
+    :return: Result of the function (its exceptions are raised here).
+    """
+
+    global _BLOCKING_POOL, _BLOCKING_POOL_PID
+
+    if not gevent_patched():
+        return func(*args)
+
+    if _BLOCKING_POOL is None or _BLOCKING_POOL_PID != os.getpid():
+        from gevent.threadpool import ThreadPool
+        _BLOCKING_POOL = ThreadPool(cm.ADMISSION_THREADS)
+        _BLOCKING_POOL_PID = os.getpid()
+
+    def call():
+        """Return a tuple (result, exception) of the function"""
+        try:
+            return func(*args), None
+        except Exception as error:
+            return None, error
+
+    result, error = _BLOCKING_POOL.apply(call)
+    if error is not None:
+        raise error
+    return result
 
-    The detection is made with the name of the form field.
 
-    :param arg1: Form field (ns_fic, rp_fic, fp_fic).
-    :param arg2: Filepath of an addon config export saved on the server.
-    :param arg3: Final filepath for uMatrix rules for the current session.
-    :param arg4: Trigger advanced rules for request policy.
+# Parsers by form field, in order of conversion;
+# the generic field accepts any supported export (see :meth:`guess_parser`)
+PARSERS = {
+    'ns_fic': NoScriptParser,
+    'rp_fic': RequestPolicyParser,
+    'fp_fic': FirefoxPermissionsParser,
+    'any_fic': None,
+}
+app.config['UPLOAD_PARSERS'] = PARSERS
+
+
+def convert_upload(kind, data, advanced):
+    """Parse the given upload and return uMatrix rules.
+
+    The parser is found by the detection of the format (see
+    :meth:`format_check`).
+    The upload is parsed from memory, nothing is written on the server.
+
+    .. note:: Executed out of the request context (see :meth:`run_conversion`).
+
+    :param arg1: Name of the parser (see PARSER_CLASSES).
+    :param arg2: Content of the uploaded file.
+    :param arg3: Trigger advanced rules for request policy.
     :type arg1: <str>
-    :type arg2: <str>
-    :type arg3: <str>
-    :type arg4: <bool>
+    :type arg2: <bytes>
+    :type arg3: <bool>
+    :return: uMatrix rules.
+    :rtype: <str>
     """
 
-    parsers = {
-        'ns_fic': NoScriptParser,
-        'rp_fic': RequestPolicyParser,
-        'fp_fic': FirefoxPermissionsParser,
-    }
+    METRICS.observe('umatrix_input_bytes', len(data), metrics.SIZE_BUCKETS,
+                    parser=kind)
+    rules = convert_export(
+        kind, data, advanced,
+        timer=lambda stage: METRICS.timer(stage, parser=kind)
+    )
 
-    converters = {
-        'ns_fic': noscript_converter,
-        'rp_fic': request_policy_converter,
-        'fp_fic': cookie_monster_converter,
-    }
+    METRICS.inc('umatrix_rules_total', rules.count('\n'), parser=kind)
+    METRICS.inc('umatrix_conversions_total', parser=kind)
+    # Conversion processes don't serve the /metrics page
+    METRICS.flush()
+    return rules
+
+
+def convert_upload_patch(kind, data, advanced, snapshot_filepath):
+    """Return the patch of uMatrix rules since the previous upload.
+
+    The snapshot of the current upload is not saved here: it replaces the
+    snapshot of the previous upload of the same kind only when the patches
+    of all the files of the request are sent (see :meth:`save_snapshots`).
 
-    LOGGER.info("parse_config:: " + field + ": " + filepath)
+    .. note:: Executed out of the request context (see :meth:`run_conversion`).
 
-    # Create Parser
-    parser = parsers[field]()
+    :param arg1: Name of the parser (see PARSER_CLASSES).
+    :param arg2: Content of the uploaded file.
+    :param arg3: Trigger advanced rules for request policy.
+    :param arg4: Filepath of the snapshot of the session for this kind.
+    :type arg1: <str>
+    :type arg2: <bytes>
+    :type arg3: <bool>
+    :type arg4: <str>
+    :return: Lines '- rule' & '+ rule', snapshot of the upload.
+    :rtype: <tuple <str>, <Snapshot>>
+    """
 
+    parser_class = PARSER_CLASSES[kind]
+
+    METRICS.observe('umatrix_input_bytes', len(data), metrics.SIZE_BUCKETS,
+                    parser=kind)
+    with METRICS.timer('parse', parser=kind):
+        snapshot = Snapshot.from_export(parser_class(),
+                                        export_source(parser_class, data),
+                                        advanced)
     try:
-        parser.read_file(filepath)
-    except DatabaseError:
-        flash("Sqlite file <strong>is not</strong> a database!", 'danger')
-        raise ValueError
-    except:
-        flash("File <strong>is not</strong> a text/plain file!", 'danger')
-        raise ValueError
+        previous = Snapshot.load(snapshot_filepath)
+    except (FileNotFoundError, ValueError):
+        # First upload: all the rules are added
+        previous = Snapshot(snapshot.kind, advanced)
+
+    with METRICS.timer('convert', parser=kind):
+        patch = ''.join(iter_patch(*delta_rules(snapshot, previous)))
 
-    # Convert parser content
-    converters[field](parser, uMatrix_path, advanced=advanced)
+    METRICS.inc('umatrix_rules_total', patch.count('\n'), parser=kind)
+    METRICS.inc('umatrix_conversions_total', parser=kind)
+    METRICS.flush()
+    return patch, snapshot
+
+
+def save_snapshots(snapshots):
+    """Replace the snapshots of the previous uploads of a session.
+
+    .. note:: Executed out of the request context (see :meth:`run_conversion`).
+
+    :param: Snapshots of the uploads & their filepaths.
+    :type: <list <tuple <Snapshot>, <str>>>
+    """
+
+    for snapshot, snapshot_filepath in snapshots:
+        with METRICS.timer('save', parser=snapshot.kind):
+            snapshot.save(snapshot_filepath)
+    METRICS.flush()
+
+
+def merge_blocks(blocks):
+    """Merge blocks of uMatrix rules into 1 ruleset in canonical order.
+
+    Conflicts are resolved (see MERGE_CONFLICTS), duplicated & redundant rules
+    are removed (see OPTIMIZE_RULES).
+
+    .. note:: Executed out of the request context (see :meth:`run_conversion`).
+
+    :param arg1: Blocks of uMatrix rules, one per file.
+    :type arg1: <list <str>>
+    :return: uMatrix rules.
+    :rtype: <str>
+    """
+
+    with METRICS.timer('merge'):
+        rules = ''.join(iter_merged_rules(blocks, cm.MERGE_CONFLICTS,
+                                          cm.OPTIMIZE_RULES))
+    METRICS.flush()
+    return rules
+
+
+def send_rules(blocks, sent=None):
+    """Yield blocks of rules to the client; the time of sending is measured
+
+    :param arg1: Blocks of uMatrix rules.
+    :param arg2: Optional event set once all the blocks are sent; it is not
+        set if the send is aborted (ex: the client disconnects).
+    :type arg2: <threading.Event>
+    :return: Generator of blocks.
+    :rtype: <generator <str>>
+    """
+
+    with METRICS.timer('send'):
+        yield from blocks
+    if sent is not None:
+        sent.set()
+
+
+def parse_config(field, kind, filename, data, advanced,
+                 snapshot_filepath=None):
+    """Start the generation of uMatrix rules with the given file.
+
+    Files of a request are converted concurrently: the result is waited
+    with the returned function.
+
+    :param arg1: Form field (see PARSERS).
+    :param arg2: Name of the parser of the file (see :meth:`format_check`).
+    :param arg3: Name of the uploaded file.
+    :param arg4: Content of the uploaded file.
+    :param arg5: Trigger advanced rules for request policy.
+    :param arg6: Optional filepath of the snapshot of the previous upload;
+        if it is given, only a patch is made (see :meth:`convert_upload_patch`).
+    :type arg1: <str>
+    :type arg2: <str>
+    :type arg3: <str>
+    :type arg4: <bytes>
+    :type arg5: <bool>
+    :type arg6: <str>
+    :return: Function without argument which returns uMatrix rules
+        (a patch & the snapshot of the upload with arg6);
+        it raises ValueError if the file is erroneous (a message is flashed).
+    :rtype: <function>
+    """
+
+    LOGGER.info("parse_config:: " + field + ": " + kind + ": " + filename)
+
+    if snapshot_filepath:
+        wait = submit_conversion(convert_upload_patch, kind, data, advanced,
+                                 snapshot_filepath)
+    else:
+        wait = submit_conversion(convert_upload, kind, data, advanced)
+
+    def get_rules():
+        try:
+            return wait()
+        except DatabaseError:
+            METRICS.inc('umatrix_errors_total', field=field)
+            flash("Sqlite file <strong>is not</strong> a database!", 'danger')
+            raise ValueError
+        except:
+            METRICS.inc('umatrix_errors_total', field=field)
+            flash("File <strong>is not</strong> a text/plain file!", 'danger')
+            raise ValueError
+
+    return get_rules
 
 
 @app.route(cm.NGINX_PREFIX, methods=['GET', 'POST'])
@@ -170,80 +517,226 @@ def index():
 
     if request.method == 'POST':
 
+        # Clients over their rate are refused before their upload is read
+        ADMISSION.take_token(client_id())
+
         # Check/set ID in session
         if 'ID' not in session:
             # random uuid
             session['ID'] = str(uuid.uuid4())
 
+        # Upload (the form is parsed on first access)
+        with METRICS.timer('upload'):
+            files = request.files
+
         # Form validation (fields)
-        valid = form_valid(request.files)
+        valid = form_valid(files)
         if valid:
 
-            # Build final uMatrix filepath with the help of the user session id
-            uMatrix_secure_path = \
-                cm.DIR_W_UPLOADS + '/' + session['ID'] + '_uMatrix-rules.txt'
+            # Bounded number of conversions in all the workers; the slot is
+            # held until the end of the request
+            take_conversion_slot()
 
-            # Remove previous uMatrix output file
-            if os.path.isfile(uMatrix_secure_path):
-                os.unlink(uMatrix_secure_path)
+            # Blocks of uMatrix rules, one per file
+            uMatrix_rules = list()
 
-            # Convert each file
-            for field, file in request.files.items():
+            # Make uMatrix rules
+            advanced = \
+                True if request.form.get('advanced', False) == 'true' else False
 
-                # Verify extension
-                if not extension_check(field, file):
-                    LOGGER.debug("Extension check:: " + file.filename + \
+            # Only changes since the previous upload of the session
+            incremental = cm.SNAPSHOT_DIR is not None and \
+                request.form.get('incremental', False) == 'true'
+
+            # Conversions of files, in a fixed order:
+            # (key in the result cache, rules or function waiting for them)
+            conversions = list()
+            # Kinds of exports of the request (1 snapshot per kind)
+            kinds = set()
+            # Snapshots of the uploads, saved only if all the patches are sent
+            snapshots = list()
+
+            # Start the conversion of each file
+            uploads = [(field, file) for field in PARSERS
+                       for file in files.getlist(field)]
+            for field, file in uploads:
+
+                # Don't test empty field
+                if not file:
+                    continue
+
+                # Verify format with the beginning of the file
+                head = file.read(SNIFF_SIZE)
+                parser_class = format_check(field, file.filename, head)
+                if parser_class is None:
+                    LOGGER.debug("Format check:: " + file.filename + \
                                  " refused")
                     continue
 
-                # Save user file on server
-                secure_name = secure_filename(file.filename)
-                secure_path = '{}/{}_{}'.format(
-                    cm.DIR_W_UPLOADS,
-                    session['ID'],
-                    secure_name
-                )
-                file.save(secure_path)
+                kind = parser_class.__name__
+                data = head + file.read()
 
-                # Make uMatrix rules
-                advanced = \
-                    True if request.form.get('advanced', False) == 'true' else False
+                if incremental:
+                    if kind in kinds:
+                        flash("Only 1 " + parser_class.label + " export can "
+                              "be sent for an incremental update !", 'danger')
+                        continue
+                    kinds.add(kind)
 
-                # Generate a uMatrix config file for the current user file
-                try:
-                    parse_config(field, secure_path,
-                                 uMatrix_secure_path, advanced
+                    snapshot_filepath = os.path.join(
+                        cm.SNAPSHOT_DIR, session['ID'] + '_' + kind + '.snapshot'
                     )
-                except ValueError:
-                    # If a uMatrix config was made before, we delete it
-                    if os.path.isfile(uMatrix_secure_path):
-                        os.unlink(uMatrix_secure_path)
-                    break
-                finally:
-                    # Remove uploaded user file from server
-                    os.unlink(secure_path)
-
-            # If at the end, the uMatrix file is empty,
+                    conversions.append((snapshot_filepath, parse_config(
+                        field, kind, file.filename, data, advanced,
+                        snapshot_filepath
+                    )))
+                    continue
+
+                # Identical uploads give identical rules
+                key = result_cache.make_key(kind, data, advanced)
+                rules = RESULT_CACHE.get(key)
+                if rules is not None:
+                    LOGGER.debug("Result cache:: hit for " + file.filename)
+                    conversions.append((None, rules))
+                    continue
+
+                # Generate uMatrix rules for the current user file
+                conversions.append((key, parse_config(
+                    field, kind, file.filename, data, advanced
+                )))
+
+            # Wait for all the conversions, merge them in order;
+            # key: key in the result cache, or filepath of the snapshot
+            failed = False
+            for key, rules in conversions:
+                if callable(rules):
+                    try:
+                        rules = rules()
+                    except ValueError:
+                        failed = True
+                        continue
+                if incremental:
+                    rules, snapshot = rules
+                    snapshots.append((snapshot, key))
+                elif key is not None:
+                    RESULT_CACHE.set(key, rules)
+                uMatrix_rules.append(rules)
+
+            if failed:
+                # If uMatrix rules were made for other files, we drop them;
+                # previous snapshots are kept: the next patch will have
+                # the changes of this upload
+                uMatrix_rules = list()
+                snapshots = list()
+
+            LOGGER.debug("Result cache:: " + str(RESULT_CACHE.stats()))
+            record_cache_stats()
+
+            # Rules of several files may overlap
+            if (cm.OPTIMIZE_RULES or cm.MERGE_CONFLICTS != 'keep') \
+                    and not incremental and any(uMatrix_rules):
+                uMatrix_rules = [run_conversion(merge_blocks, uMatrix_rules)]
+
+            if incremental and uMatrix_rules and not any(uMatrix_rules):
+                flash('No change since the last upload.', 'info')
+                # Snapshots are equivalent: nothing to save
+            # If at the end, there is no uMatrix rule,
             # the given file was erroneous
-            if not os.path.isfile(uMatrix_secure_path) or \
-                os.stat(uMatrix_secure_path).st_size == 0:
+            elif not any(uMatrix_rules):
                 flash('Erroneous files sent !', 'danger')
             else:
                 # flash('Configuration file generated!', 'success')
-                return send_from_directory(
-                    cm.DIR_W_UPLOADS,
-                    session['ID'] + '_uMatrix-rules.txt',
-                    as_attachment=True
+                sent = threading.Event()
+                response = Response(
+                    send_rules(uMatrix_rules, sent),
+                    mimetype='text/plain',
+                    headers={
+                        'Content-Disposition':
+                            'attachment; filename=uMatrix-rules.' +
+                            ('patch' if incremental else 'txt')
+                    }
                 )
+                if snapshots:
+                    # After the end of the response: an aborted download
+                    # keeps the previous snapshots
+                    response.call_on_close(
+                        lambda: sent.is_set() and
+                        run_conversion(save_snapshots, snapshots)
+                    )
+                return response
         else:
             flash("Please send at least <strong>1</strong> file !", 'danger')
 
+    return render_form()
+
+
+@app.errorhandler(upload_guard.RejectedUpload)
+@app.errorhandler(upload_guard.UploadTooLarge)
+def rejected_upload(error):
+    """Form with the reason of the rejection of an upload
+
+    The rest of the request body is not read: the connection is closed.
+    """
+
+    LOGGER.info("Upload rejected:: " + error.reason)
+    METRICS.inc('umatrix_rejected_uploads_total', reason=error.reason)
+    flash(error.description, 'danger')
+    return render_form(), error.code, {'Connection': 'close'}
+
+
+@app.errorhandler(admission.RateLimited)
+@app.errorhandler(admission.Overloaded)
+def refused_request(error):
+    """Form with the reason of the refusal of the admission control
+
+    The body of refused requests may not have been read: the connection
+    is closed.
+    """
+
+    LOGGER.info("Admission:: " + type(error).__name__ + " " + client_id())
+    METRICS.inc('umatrix_refused_requests_total',
+                reason=type(error).__name__)
+    flash(error.description, 'danger')
+    return render_form(), error.code, {
+        'Connection': 'close',
+        'Retry-After': str(error.retry_after),
+    }
+
+
+def record_cache_stats():
+    """Copy the counters of the result cache of the worker to its metrics"""
+
+    stats = RESULT_CACHE.stats()
+    METRICS.set('umatrix_result_cache_hits_total', stats['memory_hits'],
+                tier='memory')
+    METRICS.set('umatrix_result_cache_hits_total', stats['disk_hits'],
+                tier='disk')
+    METRICS.set('umatrix_result_cache_misses_total', stats['misses'])
+    METRICS.set('umatrix_result_cache_entries', stats['memory_entries'])
+    METRICS.set('umatrix_result_cache_size', stats['memory_size'])
+
+
+def render_form():
+    """Main page with the form & the flashed messages"""
+
     # With data caching: realtime
     return render_template('index.html',
+                           INCREMENTAL=cm.SNAPSHOT_DIR is not None,
+                           MERGED=cm.OPTIMIZE_RULES or
+                           cm.MERGE_CONFLICTS != 'keep',
                            PIWIK_URL=cm.PIWIK_URL,
                            PIWIK_SITE_ID=cm.PIWIK_SITE_ID)
 
 
+@app.route(cm.NGINX_PREFIX + '/metrics')
+def metrics_page():
+    """Metrics of all the processes, in the Prometheus text format"""
+
+    record_cache_stats()
+    return Response(metrics.exposition(METRICS.collect()),
+                    mimetype='text/plain; version=0.0.4')
+
+
 def main():
 
     app.run(debug=True)